@@ -0,0 +1,64 @@
+
+import sys
+import json
+import argparse
+
+"""
+    Compare two benchmark reports (see benchmarks.run) stage by stage.
+
+    USAGE:  python -m benchmarks.compare <baseline.json> <new.json> [--max-slowdown 1.2]
+
+    Exits with status 1 if any stage got slower (or used more memory) than the allowed ratio.
+"""
+
+
+def load_report(filepath):
+    with open(filepath, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare(baseline, new, max_slowdown=None, max_memory_growth=None):
+    """
+    :return: (rows, regressions) where rows are (stage, old s, new s, time ratio, old MB, new MB, memory ratio)
+    """
+    rows = []
+    regressions = []
+    for stage, new_result in new['stages'].items():
+        old_result = baseline['stages'].get(stage)
+        if old_result is None:
+            continue
+        time_ratio = new_result['seconds'] / max(old_result['seconds'], 1e-9)
+        # Reports from platforms without the resource module have no peak RSS (shown as nan)
+        old_mb, new_mb = [float('nan') if mb is None else mb for mb in (old_result['peak_rss_mb'], new_result['peak_rss_mb'])]
+        memory_ratio = new_mb / max(old_mb, 1e-9) if old_mb == old_mb else float('nan')
+        rows.append((stage, old_result['seconds'], new_result['seconds'], time_ratio, old_mb, new_mb, memory_ratio))
+
+        if max_slowdown and time_ratio > max_slowdown:
+            regressions.append('%s: %.2fx slower' % (stage, time_ratio))
+        if max_memory_growth and memory_ratio > max_memory_growth:
+            regressions.append('%s: %.2fx more memory' % (stage, memory_ratio))
+    return rows, regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports.')
+    parser.add_argument('baseline', type=str)
+    parser.add_argument('new', type=str)
+    parser.add_argument('--max-slowdown', type=float, default=None, help='Fail if a stage takes more than this ratio of its baseline time.')
+    parser.add_argument('--max-memory-growth', type=float, default=None, help='Fail if a stage uses more than this ratio of its baseline peak RSS.')
+    args = parser.parse_args()
+
+    baseline, new = load_report(args.baseline), load_report(args.new)
+    if baseline['params'] != new['params']:
+        sys.stderr.write('WARNING: the reports were produced with different parameters.\n')
+
+    print('%s -> %s' % (baseline.get('commit'), new.get('commit')))
+    print('%-20s %10s %10s %7s %10s %10s %7s' % ('stage', 'old s', 'new s', 'ratio', 'old MB', 'new MB', 'ratio'))
+    rows, regressions = compare(baseline, new, args.max_slowdown, args.max_memory_growth)
+    for row in rows:
+        print('%-20s %10.3f %10.3f %6.2fx %10.1f %10.1f %6.2fx' % row)
+
+    for regression in regressions:
+        print('REGRESSION: %s' % regression)
+    sys.exit(1 if regressions else 0)
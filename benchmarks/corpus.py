@@ -0,0 +1,91 @@
+
+import argparse
+import numpy as np
+
+"""
+    Synthetic password corpora for the benchmarks.
+
+    Real dumps are dominated by a small vocabulary of popular base words, often followed by digits, plus a long tail of
+    random-looking strings. The generator mimics that: every password is either a Zipf-distributed vocabulary word
+    (cut or padded with digits to its target length) or random characters, and the lengths follow a clipped normal
+    or uniform distribution.
+"""
+
+LOWER = 'abcdefghijklmnopqrstuvwxyz'
+UPPER = LOWER.upper()
+DIGITS = '0123456789'
+SYMBOLS = '!@#$%^&*._-'
+
+# Character classes of the random tail and their weights
+CHAR_CLASSES = ((LOWER, 0.70), (DIGITS, 0.20), (UPPER, 0.07), (SYMBOLS, 0.03))
+
+
+def _random_chars(rng, n, length):
+    alphabet = ''.join(chars for chars, _ in CHAR_CLASSES)
+    weights = np.concatenate([np.full(len(chars), weight / len(chars)) for chars, weight in CHAR_CLASSES])
+    codes = rng.choice(len(alphabet), size=(n, length), p=weights / weights.sum())
+    return np.array(list(alphabet), dtype='U1')[codes]
+
+
+def sample_lengths(rng, n, distribution='normal', length_mean=9.0, length_std=3.0, min_length=4, max_length=20):
+    if distribution == 'uniform':
+        return rng.integers(min_length, max_length + 1, size=n)
+    return np.clip(np.rint(rng.normal(length_mean, length_std, size=n)), min_length, max_length).astype(np.int64)
+
+
+def generate_passwords(n, distribution='normal', length_mean=9.0, length_std=3.0, min_length=4, max_length=20,
+                       vocab_size=5000, vocab_share=0.7, zipf_a=1.2, seed=0):
+    """
+    :return: list of n synthetic passwords
+    """
+    rng = np.random.default_rng(seed)
+    lengths = sample_lengths(rng, n, distribution, length_mean, length_std, min_length, max_length)
+
+    # Vocabulary of lowercase base words; popular words are drawn far more often (Zipf)
+    vocab_lengths = rng.integers(3, 9, size=vocab_size)
+    vocab_chars = np.array(list(LOWER), dtype='U1')[rng.integers(0, len(LOWER), size=(vocab_size, 8))]
+    vocab = [''.join(row[:length]) for row, length in zip(vocab_chars, vocab_lengths)]
+    ranks = np.minimum(rng.zipf(zipf_a, size=n) - 1, vocab_size - 1)
+    from_vocab = rng.random(n) < vocab_share
+
+    tail = _random_chars(rng, n, max_length)
+    digits = np.array(list(DIGITS), dtype='U1')[rng.integers(0, 10, size=(n, max_length))]
+
+    passwords = []
+    for i in range(n):
+        length = lengths[i]
+        if from_vocab[i]:
+            word = vocab[ranks[i]][:length]
+            passwords.append(word + ''.join(digits[i, :length - len(word)]))
+        else:
+            passwords.append(''.join(tail[i, :length]))
+    return passwords
+
+
+def write_corpus(filepath, n, **kwargs):
+    with open(filepath, 'w', encoding='utf-8') as f:
+        for pw in generate_passwords(n, **kwargs):
+            f.write('%s\n' % pw)
+    return filepath
+
+
+if __name__ == "__main__":
+    """
+    USAGE:  python -m benchmarks.corpus <output file> -n 1000000
+    """
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic password corpus.')
+    parser.add_argument('outfile', type=str)
+    parser.add_argument('-n', dest='words', type=int, default=100000, help='Number of passwords.')
+    parser.add_argument('--distribution', choices=('normal', 'uniform'), default='normal', help='Password length distribution.')
+    parser.add_argument('--length-mean', type=float, default=9.0)
+    parser.add_argument('--length-std', type=float, default=3.0)
+    parser.add_argument('--min-length', type=int, default=4)
+    parser.add_argument('--max-length', type=int, default=20)
+    parser.add_argument('--vocab-size', type=int, default=5000, help='Number of distinct base words.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_corpus(args.outfile, args.words, distribution=args.distribution, length_mean=args.length_mean,
+                 length_std=args.length_std, min_length=args.min_length, max_length=args.max_length,
+                 vocab_size=args.vocab_size, seed=args.seed)
@@ -0,0 +1,137 @@
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import subprocess
+import tempfile
+import multiprocessing
+
+from benchmarks.corpus import write_corpus
+from benchmarks.stages import STAGES, CORPUS
+from engine.utils import format_mb
+from engine.features import ENCODERS
+
+"""
+    Time and memory-profile every pipeline stage on a synthetic corpus and write the results as JSON.
+
+    USAGE:  python -m benchmarks.run -n 100000 -o benchmarks/results/base.json
+            python -m benchmarks.compare benchmarks/results/base.json benchmarks/results/new.json
+
+    Every stage runs in a fresh (spawned) process so that its peak RSS is its own; stages hand their artifacts to the
+    next stage through fixed file names in a temporary work directory.
+"""
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCH_PATH)
+
+
+def _run_stage(name, work_dir, params, verbose):
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    os.chdir(work_dir)
+
+    from engine.utils import peak_rss_mb
+    start = time.perf_counter()
+    result = STAGES[name](params)
+    result['seconds'] = time.perf_counter() - start
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['items_per_second'] = result['items'] / max(result['seconds'], 1e-9)
+    return result
+
+
+def run_stage(name, work_dir, params, verbose=False):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_run_stage, (name, work_dir, params, verbose))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(params, stages=None, repeat=1, work_dir=None, verbose=False):
+    """
+    :return: the JSON-serializable benchmark report
+    """
+    stages = stages if stages else list(STAGES)
+    keep_work_dir = bool(work_dir)
+    work_dir = work_dir if work_dir else tempfile.mkdtemp(prefix='pwbench_')
+    for sub_dir in ('results', 'validators'):
+        os.makedirs(os.path.join(work_dir, sub_dir), exist_ok=True)
+
+    start = time.perf_counter()
+    write_corpus(os.path.join(work_dir, CORPUS), params['words'], distribution=params['distribution'],
+                 length_mean=params['length_mean'], length_std=params['length_std'],
+                 min_length=params['min_length'], max_length=params['max_length'],
+                 vocab_size=params['vocab_size'], seed=params['seed'])
+    sys.stderr.write('Generated corpus of %s passwords (%.1fs)\n' % (params['words'], time.perf_counter() - start))
+
+    results = {}
+    try:
+        for name in stages:
+            # Stages overwrite their own artifacts, so repeats keep the fastest run
+            runs = [run_stage(name, work_dir, params, verbose) for _ in range(repeat)]
+            results[name] = min(runs, key=lambda r: r['seconds'])
+            sys.stderr.write('%-20s %9.3fs %9s %14.0f items/s\n' % (
+                name, results[name]['seconds'], format_mb(results[name]['peak_rss_mb']),
+                results[name]['items_per_second']))
+    finally:
+        if not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': params,
+        'stages': results,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the password analysis pipeline stages.')
+    parser.add_argument('-n', dest='words', type=int, default=100000, help='Passwords in the synthetic corpus.')
+    parser.add_argument('--distribution', choices=('normal', 'uniform'), default='normal', help='Password length distribution.')
+    parser.add_argument('--length-mean', type=float, default=9.0)
+    parser.add_argument('--length-std', type=float, default=3.0)
+    parser.add_argument('--min-length', type=int, default=4)
+    parser.add_argument('--max-length', type=int, default=20)
+    parser.add_argument('--vocab-size', type=int, default=5000, help='Number of distinct base words in the corpus.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=500000, help='Chunk size passed to the counting stages.')
+    parser.add_argument('--pw-length', type=int, default=10, help='Length of generated passwords.')
+    parser.add_argument('--passwords', type=int, default=100000, help='Passwords generated by generate_batch (and classified).')
+    parser.add_argument('--legacy-passwords', type=int, default=1000, help='Passwords generated by the per-password generate_pw_from_mm.')
+    parser.add_argument('--validator', choices=('svm', 'sgd', 'iforest'), default='svm')
+    parser.add_argument('--features', choices=sorted(ENCODERS), default='ord100', help='Feature encoding of the validator stages.')
+    parser.add_argument('--validator-sample', type=int, default=10000, help='Training sample of validator_train.')
+    parser.add_argument('--similarity-words', type=int, default=100000, help='Words per list compared by the similarity stage.')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=None, help='Only run these stages (they still need the artifacts of earlier ones).')
+    parser.add_argument('--repeat', type=int, default=1, help='Run every stage N times and keep the fastest.')
+    parser.add_argument('--work-dir', type=str, default=None, help='Work directory, kept afterwards (default: a temporary directory that is removed).')
+    parser.add_argument('-v', dest='verbose', action='store_true', help='Keep the debug logging of the stages.')
+    parser.add_argument('-o', dest='outfile', type=str, default=None, help='JSON output file (default: benchmarks/results/<commit>_<words>.json).')
+    args = parser.parse_args()
+
+    params = dict((key, value) for key, value in vars(args).items()
+                  if key not in ('stages', 'repeat', 'work_dir', 'verbose', 'outfile'))
+    report = run(params, stages=args.stages, repeat=args.repeat, work_dir=args.work_dir, verbose=args.verbose)
+
+    outfile = args.outfile
+    if not outfile:
+        outfile = os.path.join(BENCH_PATH, 'results', '%s_%s.json' % (report['commit'] or 'nocommit', args.words))
+    os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+    with open(outfile, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    sys.stderr.write('Results written to %s\n' % outfile)
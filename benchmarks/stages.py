@@ -0,0 +1,106 @@
+
+import os
+
+from collections import OrderedDict
+
+import settings
+from engine.base import NGramGenerator, NGramCounter
+from engine.analytics import NGramAnalyzer
+from engine.validation import PasswordVerifier
+from engine.utils import write_counts
+from engine.reader import read_lines, count_lines
+from toolkit import ToolKit
+
+"""
+    Benchmarked stages. Every stage runs in the benchmark work directory, reads the artifacts of the stages before it
+    (fixed file names below) and returns {'items': <number of units processed>} plus any extra figures.
+"""
+
+CORPUS = 'corpus.txt'
+NGRAMS = 'corpus.ngram'
+NGCOUNTS = 'corpus.ngcounts'
+MODEL = 'corpus.model'
+GENERATED = 'generated.txt'
+VALIDATOR = 'validator.pkl'
+
+
+def _read_words(filepath, limit=None):
+    return read_lines(filepath, limit=limit)
+
+
+def ngram_generator(params):
+    ngg = NGramGenerator(CORPUS, chunk_size=params['chunk_size'])
+    ngg.run()
+    os.replace(ngg.destination_file, NGRAMS)
+    return {'items': params['words'], 'ngrams': count_lines(NGRAMS)}
+
+
+def count_ngrams(params):
+    counter = NGramCounter(NGRAMS, chunk_size=params['chunk_size'])
+    counter.count_ngrams()
+    return {'items': count_lines(NGRAMS)}
+
+
+def top_db_ngrams(params):
+    counter = NGramCounter(NGRAMS, chunk_size=params['chunk_size'], use_db=False)
+    counter.init_db(settings.DB_NAME, remove_existing=False)
+    counts = [item for chunk in counter.get_next_top_db_ngrams(n=counter.chunk_size) for item in chunk]
+    write_counts(dict(counts), NGCOUNTS)
+    return {'items': len(counts)}
+
+
+def markov_matrix(params):
+    NGramAnalyzer(NGCOUNTS).generate_markov_matrix(savefile=MODEL)
+    return {'items': count_lines(NGCOUNTS)}
+
+
+def generate_legacy(params):
+    nga = NGramAnalyzer(None)
+    n = params['legacy_passwords']
+    for _ in range(n):
+        nga.generate_pw_from_mm(params['pw_length'], filepath=MODEL)
+    return {'items': n}
+
+
+def generate_batch(params):
+    sampler = NGramAnalyzer(MODEL).load_sampler(seed=params['seed'])
+    passwords = sampler.generate_batch(params['passwords'], params['pw_length'])
+    with open(GENERATED, 'w', encoding='utf-8') as f:
+        f.writelines('%s\n' % pw for pw in passwords)
+    return {'items': len(passwords)}
+
+
+def validator_train(params):
+    verifier = PasswordVerifier(backend=params['validator'], features=params['features'])
+    verifier.train_model(CORPUS, chunk_size=params['validator_sample'])
+    verifier.save_model(VALIDATOR)
+    return {'items': verifier.training_stats['trained_on'], 'model_mb': os.path.getsize(VALIDATOR) / 2 ** 20}
+
+
+def validator_classify(params):
+    verifier = PasswordVerifier(backend=params['validator'], features=params['features'])
+    verifier.load_model(VALIDATOR)
+    passwords = _read_words(GENERATED)
+    accepted = sum(verifier.classify_passwords(passwords))
+    return {'items': len(passwords), 'accepted': int(accepted)}
+
+
+def similarity(params):
+    limit = params['similarity_words']
+    _, _, summary = ToolKit().calc_similarity(_read_words(GENERATED, limit), _read_words(CORPUS, limit))
+    result = {'items': summary['words']}
+    result.update(('within_%s' % d, share) for d, share in summary['within'].items())
+    return result
+
+
+STAGES = OrderedDict([
+    ('ngram_generator', ngram_generator),
+    ('count_ngrams', count_ngrams),
+    ('top_db_ngrams', top_db_ngrams),
+    ('markov_matrix', markov_matrix),
+    ('generate_legacy', generate_legacy),
+    ('generate_batch', generate_batch),
+    ('validator_train', validator_train),
+    ('validator_classify', validator_classify),
+    ('similarity', similarity),
+])
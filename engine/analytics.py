@@ -2,13 +2,14 @@
 import logging
 import numpy as np
 
-from itertools import islice
-
-import settings
-from engine.utils import generate_ngrams, load_obj, save_obj
+from engine.utils import generate_ngrams
+from engine.model import MarkovModel
+from engine.sampling import MarkovSampler
+from engine.index import NGramIndex
+from engine.metrics import metrics
+from engine.reader import iter_line_chunks
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG if settings.DEBUG else logging.ERROR)
 
 
 class NGramAnalyzer(object):
@@ -20,76 +21,103 @@ class NGramAnalyzer(object):
 
     pw_ng_filepath = None
     chunk_size = 500000
+    index = None
 
     def __init__(self, pw_ng_filepath, chunk_size=500000):
         self.pw_ng_filepath = pw_ng_filepath
         self.chunk_size = chunk_size
 
-    def compare(self, word):
-        logger.debug('Generating n-grams for %s' % word)
-        word_ngrams = generate_ngrams([word])
-
-        similar_ngrams = []
-        total_ngrams_checked = 0
-
-        logger.debug('Comparing to common password n-grams...')
-
-        with open(self.pw_ng_filepath) as f:
-
-            data_chunk = ['test', ]
-            iteration = 0
-            while data_chunk:
-                data_chunk = list(islice(f, self.chunk_size))
-                sanitized = [str(ng).strip('\n\r') for ng in data_chunk]
-                total_ngrams_checked += len(sanitized)
+    def get_index(self, rebuild=False):
+        """
+        Memory-mapped index over the counted n-gram file, built on first use (see NGramIndex).
+        """
+        if not self.index or rebuild:
+            self.index = NGramIndex.open(self.pw_ng_filepath, rebuild=rebuild)
+        return self.index
 
-                for ng in word_ngrams:
-                    similar_ngrams = similar_ngrams + [x for x in sanitized if str(ng) == str(x)]
+    def compare(self, word):
+        """
+        Look up the n-grams of word in the counted n-gram file.
+        :return: (word n-grams, [(n-gram, count), ...] for the n-grams that are known, total n-grams in the file)
+        """
+        return self.compare_many([word])[0]
 
-                logger.debug('Completed iteration %s (chunk-size=%s)' % (iteration, self.chunk_size))
-                iteration += 1
+    def compare_many(self, words):
+        """
+        Batch version of compare: all n-grams of all words are resolved with a single index lookup.
+        """
+        index = self.get_index()
+        word_ngrams = [generate_ngrams([word]) for word in words]
+        with metrics.timer('analyzer.lookup'):
+            counts = index.lookup([ng for ngrams in word_ngrams for ng in ngrams])
+        metrics.inc('analyzer.compared', len(words))
+
+        results = []
+        pos = 0
+        for ngrams in word_ngrams:
+            ng_counts = counts[pos:pos+len(ngrams)]
+            pos += len(ngrams)
+            similar_ngrams = [(ng, int(ng_count)) for ng, ng_count in zip(ngrams, ng_counts) if ng_count > 0]
+            results.append((ngrams, similar_ngrams, len(index)))
+        return results
+
+    def iter_ngram_counts(self, ng_filepath=None):
+        """
+        Yield (ngram, count) pairs from a counted n-gram file.
+        """
+        ng_fp = ng_filepath if ng_filepath else self.pw_ng_filepath
 
-        return word_ngrams, similar_ngrams, total_ngrams_checked
+        for data_chunk in iter_line_chunks(ng_fp, self.chunk_size, metric='analyzer.bytes_read'):
+            if metrics.enabled:
+                metrics.inc('analyzer.ngrams', len(data_chunk))
+                metrics.report()
 
-    def generate_markov_matrix(self, savefile=None, ng_filepath=None):
+            for line in data_chunk:
+                # rpartition: the n-gram itself may contain a tab
+                ng, _, ng_count = line.rpartition('\t')
+                yield ng, int(ng_count)
 
-        logger.debug('Generating Markov Matrix from n-grams...')
+    def build_markov_counts(self, ngram_counts):
+        """
+        Count first characters and character transitions from an iterable of (ngram, count) pairs (in any order).
+        :return: (char_freqs, mm) with mm = {ch1: {ch2: count}}
+        """
         mm = {}
         char_freqs = {}
-        ng_fp = ng_filepath if ng_filepath else self.pw_ng_filepath
 
+        for ng, ng_count in ngram_counts:
+            if len(ng) < 2:
+                if len(ng) == 1:
+                    # Count the frequencies of single chars
+                    char_freqs[ng] = int(ng_count)
+                # Don't want to consider ngrams that have a length less than 2
+                continue
 
-        with open(ng_fp, encoding='utf-8') as f:
+            ng_ngrams = generate_ngrams([ng], max_size=2)
+            for ch1, ch2 in ng_ngrams:
+                ng_matrix = mm.get(ch1, {})
+                curr_ng_count = ng_matrix.get(ch2, 0)
+                ng_matrix[ch2] = int(ng_count) + curr_ng_count
+                mm[ch1] = ng_matrix
 
-            data_chunk = ['test', ]
-            iteration = 0
-            while data_chunk:
-                data_chunk = list(islice(f, self.chunk_size))
-                sanitized = [str(ng).strip('\n\r').split('\t') for ng in data_chunk if len(str(ng)) > 0]
+        return char_freqs, mm
 
-                for i, item in enumerate(sanitized):
-                    ng, ng_count = item
-                    if len(ng) < 2:
-                        if len(ng) == 1:
-                            # Count the frequencies of single chars
-                            char_freqs[ng] = int(ng_count)
-                        # Don't want to consider ngrams that have a length less than 2
-                        continue
-
-                    ng_ngrams = generate_ngrams([ng], max_size=2)
-                    for ch1, ch2 in ng_ngrams:
-                        ng_matrix = mm.get(ch1, {})
-                        curr_ng_count = ng_matrix.get(ch2, 0)
-                        ng_matrix[ch2] = int(ng_count) + curr_ng_count
-                        mm[ch1] = ng_matrix
+    def build_markov_matrix(self, ngram_counts):
+        """
+        Build the markov matrix from an iterable of (ngram, count) pairs (in any order).
+        :return: (char_freqs, p_mm)
+        """
+        char_freqs, mm = self.build_markov_counts(ngram_counts)
+        return char_freqs, self._calculate_markov_probabilities(mm)
 
-                logger.debug('Completed iteration %s (chunk-size=%s)' % (iteration, self.chunk_size))
-                iteration += 1
+    def generate_markov_matrix(self, savefile=None, ng_filepath=None):
 
+        logger.debug('Generating Markov Matrix from n-grams...')
+        char_freqs, mm = self.build_markov_counts(self.iter_ngram_counts(ng_filepath))
         p_mm = self._calculate_markov_probabilities(mm)
 
         if savefile:
-            save_obj((char_freqs, p_mm), savefile)
+            MarkovModel.from_counts(char_freqs, mm).save(savefile)
 
         return char_freqs, p_mm
 
@@ -110,10 +138,17 @@ class NGramAnalyzer(object):
 
         return p_mm
 
+    def load_sampler(self, prune=False, threshold=0.1, mutation_rate=0.1, filepath=None, **kwargs):
+        """
+        Load the markov model once and compile it for batch generation (see MarkovSampler.generate_batch).
+        """
+        mm_fp = filepath if filepath else self.pw_ng_filepath
+        return MarkovSampler.from_file(mm_fp, prune=prune, threshold=threshold, mutation_rate=mutation_rate, **kwargs)
+
     def generate_pw_from_mm(self, pw_length, prune=False, threshold=0.1, mutation_rate=0.1, filepath=None, **kwargs):
 
         mm_fp = filepath if filepath else self.pw_ng_filepath
-        char_freqs, mm = load_obj(mm_fp)
+        char_freqs, mm = MarkovModel.load(mm_fp).to_dicts()
 
         # Special select of first character based on derived password frequency distribution (comes with markov model)
         char_freqs_total = sum(char_freqs.values())
@@ -132,6 +167,7 @@ class NGramAnalyzer(object):
             next_char = self._get_next_char_from_mm(prev_char, mm, prune=prune, threshold=threshold, mutation_rate=mutation_rate)
             generated_password += str(next_char)
 
+        metrics.inc('generate.candidates')
         return generated_password
 
     def _get_next_char_from_mm(self, current_char, mm, prune=False, threshold=0.1, mutation_rate=0.01):
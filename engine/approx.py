@@ -0,0 +1,176 @@
+
+import math
+import logging
+import numpy as np
+
+from collections import Counter
+
+from engine.base import NGramCounter
+from engine.utils import iter_ngrams, count_sort_key
+
+logger = logging.getLogger(__name__)
+
+# Distinct n-grams hashed per vectorized block (bounds the temporary fixed-width unicode array)
+HASH_BLOCK = 65536
+
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def _mix64(h):
+    # splitmix64 finalizer
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+def hash_ngrams(ngrams):
+    """
+    Deterministic 64-bit hashes of a list of strings (FNV-1a over the code points, then mixed), computed column-wise
+    over a fixed-width unicode array instead of one Python call per string.
+    """
+    hashes = np.empty(len(ngrams), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for start in range(0, len(ngrams), HASH_BLOCK):
+            block = ngrams[start:start+HASH_BLOCK]
+            codes = np.array(block, dtype=np.str_)
+            width = codes.dtype.itemsize // 4
+            codes = codes.view(np.uint32).reshape(len(block), width).astype(np.uint64)
+
+            # Zero padding is skipped so that a string hashes the same in blocks of any width
+            h = np.full(len(block), FNV_OFFSET, dtype=np.uint64)
+            for col in range(width):
+                column = codes[:, col]
+                h = np.where(column > 0, (h ^ column) * FNV_PRIME, h)
+            hashes[start:start+len(block)] = _mix64(h)
+    return hashes
+
+
+class CountMinSketch(object):
+    """
+    Count-Min Sketch: depth rows of width counters. Estimates never undercount and overcount by at most
+    epsilon * total with probability 1 - delta, in width * depth * 8 bytes regardless of the number of keys.
+    """
+
+    epsilon = 1e-5
+    delta = 1e-3
+
+    def __init__(self, epsilon=1e-5, delta=1e-3):
+        if not 0 < epsilon < 1 or not 0 < delta < 1:
+            raise AttributeError('Sketch epsilon and delta must be between 0 and 1.')
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+        self.total = 0
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+    @property
+    def error_bound(self):
+        """
+        Maximum overcount of any estimate (with probability 1 - delta) for the data added so far.
+        """
+        return int(math.ceil(self.epsilon * self.total))
+
+    def _columns(self, hashes):
+        # Double hashing: row i uses h1 + i * h2 (Kirsch-Mitzenmacher)
+        h1 = hashes
+        h2 = _mix64(hashes) | np.uint64(1)
+        width = np.uint64(self.width)
+        with np.errstate(over='ignore'):
+            return [((h1 + np.uint64(row) * h2) % width).astype(np.intp) for row in range(self.depth)]
+
+    def add(self, hashes, counts):
+        counts = np.asarray(counts, dtype=np.int64)
+        for row, cols in enumerate(self._columns(hashes)):
+            np.add.at(self.table[row], cols, counts)
+        self.total += int(counts.sum())
+
+    def estimate(self, hashes):
+        estimates = None
+        for row, cols in enumerate(self._columns(hashes)):
+            row_estimates = self.table[row][cols]
+            estimates = row_estimates if estimates is None else np.minimum(estimates, row_estimates)
+        return estimates if estimates is not None else np.zeros(0, dtype=np.int64)
+
+
+class ApproxNGramCounter(NGramCounter):
+    """
+    One-pass, fixed-memory approximation of the top_k most frequent n-grams.
+
+    Every chunk of words is aggregated, added to a CountMinSketch, and the n-grams whose estimated frequency reaches
+    the current admission threshold are kept as heavy-hitter candidates. A chunk admits at most 2 * top_k of them (its
+    highest estimates), and the candidates are pruned back to the best 2 * top_k by estimate once they exceed
+    4 * top_k, so there are never more than 6 * top_k. Memory is bounded by the sketch, the candidates and one chunk,
+    not by the number of distinct n-grams in the corpus.
+    """
+
+    top_k = 1000
+    epsilon = 1e-5
+    delta = 1e-3
+
+    sketch = None
+    candidates = None
+
+    def __init__(self, filepath, top_k=1000, epsilon=1e-5, delta=1e-3, chunk_size=50000):
+        super(ApproxNGramCounter, self).__init__(filepath, chunk_size=chunk_size, use_db=False)
+        if top_k < 1:
+            raise AttributeError('top_k must be at least 1.')
+        self.top_k = top_k
+        self.epsilon = epsilon
+        self.delta = delta
+
+    def _add_chunk(self, chunk_counts):
+        keys = list(chunk_counts.keys())
+        hashes = hash_ngrams(keys)
+        self.sketch.add(hashes, np.fromiter(chunk_counts.values(), dtype=np.int64, count=len(keys)))
+        estimates = self.sketch.estimate(hashes)
+
+        capacity = 2 * self.top_k
+        threshold = self._threshold if len(self.candidates) >= capacity else 0
+        admitted = np.nonzero(estimates >= threshold)[0]
+        if len(admitted) > capacity:
+            # Before the first prune the threshold is 0: only the chunk's highest estimates are admitted
+            admitted = admitted[np.argpartition(-estimates[admitted], capacity - 1)[:capacity]]
+        for i in admitted.tolist():
+            self.candidates[keys[i]] = int(estimates[i])
+
+        if len(self.candidates) > 2 * capacity:
+            self._prune(capacity)
+
+    def _prune(self, capacity):
+        keys = list(self.candidates.keys())
+        estimates = np.fromiter(self.candidates.values(), dtype=np.int64, count=len(keys))
+        keep = np.argpartition(-estimates, capacity - 1)[:capacity]
+        self.candidates = dict((keys[i], int(estimates[i])) for i in keep.tolist())
+        self._threshold = int(estimates[keep].min())
+
+    def count_wordlist(self, min_size=1, max_size=None):
+        """
+        :return: list of the top_k (ngram, estimated count) pairs in descending count order
+        """
+        self.sketch = CountMinSketch(self.epsilon, self.delta)
+        self.candidates = {}
+        self._threshold = 0
+        logger.debug('Approximate counting: top-%s, sketch %sx%s (%.1fMB)' % (
+            self.top_k, self.sketch.depth, self.sketch.width, self.sketch.nbytes / 1024.0 / 1024.0))
+
+        for words in self.iter_words():
+            self._add_chunk(Counter(iter_ngrams(words, min_size=min_size, max_size=max_size, logger=logger)))
+            self._chunk_metrics(words, min_size, max_size)
+
+        # Candidate estimates were taken when each n-gram was last seen; refresh them from the final sketch
+        keys = list(self.candidates.keys())
+        estimates = self.sketch.estimate(hash_ngrams(keys)).tolist()
+        top = sorted(zip(keys, estimates), key=count_sort_key)[:self.top_k]
+        logger.debug('Done approximate counting (%s n-grams, error bound +%s).' % (
+            self.sketch.total, self.sketch.error_bound))
+        return top
+
+    def get_next_top_ngrams(self, top, n=100):
+        for i in range(0, len(top), n):
+            yield top[i:i+n]
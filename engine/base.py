@@ -1,19 +1,37 @@
 
 
 import os
+import json
 import logging
 import sqlite3
 import time
 import hashlib
 
+from collections import Counter
 from itertools import islice
 from pathlib import Path
 
 import settings
-from engine.utils import generate_ngrams
+from engine.utils import iter_ngrams, ngram_total, count_sort_key
+from engine.metrics import metrics
+from engine.reader import iter_line_chunks
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG if settings.DEBUG else logging.ERROR)
+
+# The count database is a rebuildable scratch store, so durability is traded for write speed
+DB_PRAGMAS = (
+    'journal_mode=WAL',
+    'synchronous=OFF',
+    'temp_store=MEMORY',
+    'cache_size=-262144',
+    'mmap_size=1073741824',
+)
+
+# Number of ngrams per 'WHERE ngram IN (...)' lookup
+DB_LOOKUP_BATCH = 500
+
+# Number of distinct ngrams held in memory before they are flushed to the database
+DB_FLUSH_ENTRIES = 5000000
 
 
 class NGramGenerator(object):
@@ -29,12 +47,18 @@ class NGramGenerator(object):
 
     destination_file = 'destination_file.txt'
 
-    def __init__(self, filepath, chunk_size=500000):
+    checkpoint = None
+
+    def __init__(self, filepath, chunk_size=500000, checkpoint=None):
+        """
+        :param checkpoint: engine.checkpoint.Checkpoint to save progress to and resume from
+        """
         if not filepath or type(filepath) is not str:
             raise AttributeError("Invalid or unspecified file path.")
 
         self.filepath = filepath
         self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
         self.destination_file = '%s%s.%s' % (
             settings.RESULT_PATH,
             self.base_fname + '_' + hashlib.sha256(str(time.time()).encode('utf-8')).hexdigest()[:10],
@@ -52,44 +76,52 @@ class NGramGenerator(object):
         return True
 
     def run(self):
-        with open(self.filepath, encoding='utf-8') as f:
-
-            # self.base_fname, self.base_ext = os.path.splitext(f.name)
-            self.base_fname, self.base_ext = os.path.splitext(os.path.basename(f.name))
-
-            data_chunk = ['test', ]
-            iteration = 0
-            while data_chunk:
+        self.base_fname, self.base_ext = os.path.splitext(os.path.basename(self.filepath))
 
-                data_chunk = list(islice(f, self.chunk_size))
-                data_chunk = [str(word).strip('\n\r\t') for word in data_chunk if self._word_is_valid(word)]
+        start = self._resume()
+        if start is None:
+            return
 
-                try:
-                    chunk_ngrams = generate_ngrams(data_chunk, min_size=1, logger=logger)
-                    logger.debug('iteration: %s\tChunk-Size: %s' % (iteration, len(data_chunk)))
-                    iteration += 1
-                    self._save_chunk(chunk_ngrams)
-                    chunk_ngrams = []
+        for data_chunk, offset in iter_line_chunks(self.filepath, self.chunk_size, strip='\r\t', start=start,
+                                                   metric='generator.bytes_read', offsets=True):
+            # N-grams are streamed straight to the destination file, so memory does not grow with the chunk
+            self._save_chunk(iter_ngrams(data_chunk, min_size=1, logger=logger))
 
-                except MemoryError:
-                    # If memory error, the resulting chunk_ngrams list is too big -- dial it back by an order of
-                    # magnitude and go through the sublists individually and save the resulting ngrams
-                    # NOTE: Rough usage metrics: caps at 800MG ram per chunk -- depends on word length though (ngram generation)
+            if metrics.enabled:
+                metrics.inc('generator.lines', len(data_chunk))
+                metrics.inc('generator.ngrams', ngram_total(data_chunk, min_size=1))
+                metrics.report()
 
-                    logger.debug('---------- Ran out of memory. Dialing back chunk size to handle ngram load. ----------')
-                    sub_chunk_lengths = int(len(data_chunk)/10)
-                    data_chunk = [data_chunk[x:x+sub_chunk_lengths] for x in range(0, len(data_chunk), sub_chunk_lengths)]
+            if offset is not None and self.checkpoint and self.checkpoint.due():
+                self._save_checkpoint(offset)
 
-                    for sublist in data_chunk:
-                        logger.debug('SUBLIST Length = %s' % len(sublist))
-                        chunk_ngrams = generate_ngrams(sublist, min_size=1, logger=logger)
-                        logger.debug('iteration: %s\tChunk-Size: %s' % (iteration, len(sublist)))
-                        iteration += 1
-                        self._save_chunk(chunk_ngrams)
-                        chunk_ngrams = []
-
-                    logger.debug('Recovered from Memory Error. Reverting back to normal ngram chunk size.')
+        if self.checkpoint:
+            self._save_checkpoint(None, complete=True)
 
+    def _resume(self):
+        """
+        Continue the destination file of a checkpointed run: cut it back to its size at the checkpoint.
+        :return: input offset to start from, or None if the checkpointed run had completed
+        """
+        state = self.checkpoint.load() if self.checkpoint else None
+        if not state:
+            return 0
+        self.destination_file = state['destination']
+        if state['complete']:
+            return None
+        with open(self.destination_file, 'a+b') as f:
+            f.truncate(state['output_size'])
+        return state['offset']
+
+    def _save_checkpoint(self, offset, complete=False):
+        if not os.path.isfile(self.destination_file):
+            open(self.destination_file, 'a').close()
+        self.checkpoint.save({
+            'destination': os.path.abspath(self.destination_file),
+            'offset': offset,
+            'output_size': os.path.getsize(self.destination_file),
+            'complete': complete,
+        }, sync=[self.destination_file])
 
     def _save_chunk(self, data):
         if not self.destination_file:
@@ -99,12 +131,9 @@ class NGramGenerator(object):
                 self.base_fname + '_' + hashlib.sha256(str(time.time()).encode('utf-8')).hexdigest()[:10],
                 settings.EXT_NGRAM
             )
-        logger.debug("Saving data... (Save File=%s)" % self.destination_file)
-
         with open(self.destination_file, 'a+', encoding='utf-8') as f:
             for ng in data:
                 f.write('%s\n' % ng)
-        logger.debug("Done.")
 
 
 class NGramCounter(object):
@@ -116,54 +145,116 @@ class NGramCounter(object):
     # NGram Count cursor for database -- to get all counts from database -- to be used in generator
     ngc_cursor = None
 
-    def __init__(self, filepath, chunk_size=500000):
+    checkpoint = None
+    # Checkpoint state found in the database by init_db
+    db_state = None
+
+    def __init__(self, filepath, chunk_size=500000, use_db=True, checkpoint=None):
+        """
+        :param checkpoint: engine.checkpoint.Checkpoint to save progress to and resume from. The database counters
+            keep the manifest in the database itself, written in the same transaction as the counts.
+        """
         self.filepath = filepath
         self.chunk_size = chunk_size
-        self.init_db(settings.DB_NAME)
+        self.checkpoint = checkpoint
+        if use_db:
+            self.init_db(settings.DB_NAME, remove_existing=checkpoint is None)
 
     def init_db(self, db_name='ng_counts.db', remove_existing=True):
 
         if remove_existing:
             logger.debug('Removing existing database at %s' % db_name)
-            model_file = Path(db_name)
-            if model_file.is_file():
-                model_file.unlink()
+            for suffix in ('', '-wal', '-shm'):
+                model_file = Path(db_name + suffix)
+                if model_file.is_file():
+                    model_file.unlink()
 
         if not self.conn:
             self.conn = sqlite3.connect(db_name)
         cursor = self.conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS ng_counts (id INTEGER PRIMARY KEY, ngram TEXT, ng_count INTEGER)''')
+        for pragma in DB_PRAGMAS:
+            cursor.execute('PRAGMA %s' % pragma)
+
+        # ngram is the primary key (no rowid, no duplicate rows)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS ng_counts (ngram TEXT PRIMARY KEY, ng_count INTEGER NOT NULL) WITHOUT ROWID''')
+        if self.checkpoint:
+            # Resumable runs must survive a crash of the machine, not only of the process
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS checkpoints (stage TEXT PRIMARY KEY, manifest TEXT NOT NULL)''')
         self.conn.commit()
 
+        if self.checkpoint:
+            self.db_state = self._db_checkpoint()
+            if self.db_state is None and not remove_existing:
+                # Counts left by another run (or input) cannot be resumed from
+                self.conn.close()
+                self.conn = None
+                self.init_db(db_name, remove_existing=True)
+
+    def _db_checkpoint(self):
+        """
+        :return: state of this counter's checkpoint in the database, or None
+        """
+        row = self.conn.execute('''SELECT manifest FROM checkpoints WHERE stage = ?''', (self.checkpoint.stage, )).fetchone()
+        return self.checkpoint.state_of(json.loads(row[0]) if row else None)
+
+    def index_db(self):
+        """
+        Create the covering index on count that lets the top-ngram queries stream rows in order instead of grouping
+        and sorting the whole table. Built once after counting; keeping it up to date during the upserts is slower.
+        """
+        logger.debug('Indexing ngram counts...')
+        with self.conn:
+            self.conn.execute('''CREATE INDEX IF NOT EXISTS ng_counts_by_count ON ng_counts (ng_count DESC, ngram)''')
+
+    def drop_db_index(self):
+        with self.conn:
+            self.conn.execute('''DROP INDEX IF EXISTS ng_counts_by_count''')
+
     def get_db_ngrams(self, counts):
         """
         Get the count values for the ngrams in 'counts' from the database and add them.
         :param counts:
         :return:
         """
-        db_ngrams = {}
         cursor = self.conn.cursor()
-        cursor.execute('''SELECT ngram, ng_count FROM ng_counts''')
+        keys = list(counts.keys())
 
         logger.debug('Fetching count values from DB...')
         start = time.time()
-        results = 1
-        while results:
-            results = cursor.fetchmany(int(self.chunk_size))
-            for result in results:
-                if result[0] in counts.keys():
-                    counts[str(result[0])] += int(result[1])
+        # Primary key lookups in batches (SQLite caps the number of bound parameters per statement)
+        for i in range(0, len(keys), DB_LOOKUP_BATCH):
+            batch = keys[i:i+DB_LOOKUP_BATCH]
+            cursor.execute('''SELECT ngram, ng_count FROM ng_counts WHERE ngram IN (%s)''' % ','.join('?' * len(batch)), batch)
+            for ng, ng_count in cursor.fetchall():
+                counts[ng] += int(ng_count)
         logger.debug('Fetch Duration: %s s' % (time.time()-start, ))
         return counts
 
-    def save_db_ngrams(self, db_ngrams):
+    def save_db_ngrams(self, db_ngrams, checkpoint_state=None):
+        """
+        Add the counts in db_ngrams to the database (upsert), in one transaction. The count index is dropped while
+        writing and rebuilt by index_db() when the counts are read back.
+        :param checkpoint_state: checkpoint state to commit together with the counts
+        """
+        self.drop_db_index()
         cursor = self.conn.cursor()
-        count = 0
-        for ng, ng_count in db_ngrams.items():
-            cursor.execute('''INSERT OR REPLACE INTO ng_counts (ngram, ng_count) VALUES (?, ?)''', (ng, ng_count))
-            count += 1
-            if count % 100000 == 0:
-                self.conn.commit()
+        items = iter(db_ngrams.items())
+        with metrics.timer('db.write'), self.conn:
+            while True:
+                batch = list(islice(items, self.chunk_size))
+                if not batch:
+                    break
+                cursor.executemany(
+                    '''INSERT INTO ng_counts (ngram, ng_count) VALUES (?, ?)
+                       ON CONFLICT(ngram) DO UPDATE SET ng_count = ng_count + excluded.ng_count''',
+                    batch
+                )
+                metrics.inc('db.rows_written', len(batch))
+            if checkpoint_state is not None:
+                cursor.execute('''INSERT OR REPLACE INTO checkpoints (stage, manifest) VALUES (?, ?)''',
+                               (self.checkpoint.stage, json.dumps(self.checkpoint.record(checkpoint_state))))
+        metrics.report()
 
     def get_top_ngrams(self, ng_counts=None, n=100):
         logger.debug('Sorting and counting top ngrams...')
@@ -171,72 +262,151 @@ class NGramCounter(object):
             sorted_ngrams = sorted(ng_counts, key=ng_counts.__getitem__, reverse=True)
             return sorted_ngrams[:n]
 
-        logger.debug('Reverting to database. This may take a few minutes...')
+        logger.debug('Reverting to database...')
+        self.index_db()
         cursor = self.conn.cursor()
-        cursor.execute('''SELECT ngram, SUM(ng_count) AS ngc FROM ng_counts GROUP BY ngram ORDER BY ngc DESC''')
-        results = cursor.fetchmany(n)
+        cursor.execute('''SELECT ngram, ng_count FROM ng_counts ORDER BY ng_count DESC, ngram LIMIT ?''', (n, ))
+        results = cursor.fetchall()
         return [k for k, v in list(results)]
 
     def get_next_top_db_ngrams(self, n=100, reset=False):
         if not self.ngc_cursor or reset:
-            logger.debug('Querying database. This may take a few minutes...')
+            logger.debug('Querying database...')
+            self.index_db()
             self.ngc_cursor = self.conn.cursor()
-            self.ngc_cursor.execute('''SELECT ngram, SUM(ng_count) AS ngc FROM ng_counts GROUP BY ngram ORDER BY ngc DESC''')
+            self.ngc_cursor.execute('''SELECT ngram, ng_count FROM ng_counts ORDER BY ng_count DESC, ngram''')
 
         while True:
             result = self.ngc_cursor.fetchmany(n)
             if not result:
                 break
+            metrics.inc('db.rows_read', len(result))
+            metrics.report()
             yield result
 
-    def count_ngrams(self):
+    def get_next_top_ngrams(self, counts, n=100):
+        """
+        In-memory counterpart of get_next_top_db_ngrams: yield (ngram, count) chunks in descending count order.
+        Ties are broken by n-gram so the output is deterministic.
+        """
+        sorted_ngrams = sorted(counts.items(), key=count_sort_key)
+        for i in range(0, len(sorted_ngrams), n):
+            yield sorted_ngrams[i:i+n]
 
-        logger.debug('Counting ngram frequencies in chunks...')
-        counts = {}
-        used_db = False
+    def _chunk_metrics(self, words, min_size=1, max_size=None):
+        """
+        Record the progress of one chunk of a wordlist.
+        """
+        if metrics.enabled:
+            metrics.inc('counter.lines', len(words))
+            metrics.inc('counter.ngrams', ngram_total(words, min_size=min_size, max_size=max_size))
+            metrics.report()
 
-        with open(self.filepath, 'r', encoding='utf-8') as f:
-            data_chunk = ['test', ]
-            iteration = 0
-            while data_chunk:
-                data_chunk = list(islice(f, self.chunk_size))
-                data_chunk = [str(ngram).strip('\n\r\t') for ngram in data_chunk]
+    def iter_words(self, start=0, offsets=False):
+        """
+        Chunks of the non-empty, stripped lines of self.filepath (see engine.reader.iter_line_chunks).
+        """
+        return iter_line_chunks(self.filepath, self.chunk_size, strip='\r\t', start=start, metric='counter.bytes_read',
+                                offsets=offsets)
 
-                logger.debug('Counting chunk %s' % iteration)
+    def iter_resumable_words(self, start=0):
+        """
+        (chunk, offset) pairs of iter_words. Without a checkpoint offset is always None, and the chunks are those of
+        iter_words.
+        """
+        if self.checkpoint:
+            return self.iter_words(start=start, offsets=True)
+        return ((words, None) for words in self.iter_words())
 
-                for ng in data_chunk:
-                    try:
-                        counts[ng] = counts.get(ng, 0) + 1
-                    except MemoryError:
-                        logger.debug('\tMemory Error. Reverting to DB. NOTE: This is slow.')
-                        logger.debug('\tChecking DB for data values')
+    def _flush_db(self, counts, offset, force=False):
+        """
+        Save counts to the database once DB_FLUSH_ENTRIES are reached (or a checkpoint is due, or force is set).
+        Checkpointed counters only flush where the input offset is known, and commit it with the counts.
+        :return: True if counts were flushed (and should be reset)
+        """
+        if self.checkpoint:
+            if not force and (offset is None or (len(counts) < DB_FLUSH_ENTRIES and not self.checkpoint.due())):
+                return False
+            state = {'offset': offset, 'complete': force}
+        else:
+            if not force and len(counts) < DB_FLUSH_ENTRIES:
+                return False
+            state = None
+        logger.debug('\tAdding %s ngrams to DB' % len(counts))
+        self.save_db_ngrams(counts, checkpoint_state=state)
+        return True
 
-                        used_db = True
-                        db_ngrams = self.get_db_ngrams(counts)
+    def _db_start(self):
+        """
+        :return: input offset to count from, or None if a checkpointed run already counted everything
+        """
+        state = self.db_state if self.checkpoint else None
+        if not state:
+            return 0
+        return None if state['complete'] else state['offset']
 
-                        # Dump data chunk to free some memory
-                        data_chunk = ['test', ]
-                        for ng, ng_count in counts.items():
-                            counts[ng] = ng_count + db_ngrams.get(ng, 0)
+    def count_wordlist(self, min_size=1, max_size=None):
+        """
+        Fused generate-and-count: treat self.filepath as a password list and count the n-grams of every word
+        directly, without writing (and re-reading) the intermediate n-gram file.
+        :return: Counter of {ngram: count}
+        """
 
-                        logger.debug('\tAdding data to DB')
-                        self.save_db_ngrams(counts)
-                        counts = {}
+        logger.debug('Generating and counting ngrams in chunks...')
+        counts = Counter()
 
-                logger.debug('\tDone chunk: %s\tChunk-Size: %s' % (iteration, len(data_chunk)))
-                iteration += 1
+        for words in self.iter_words():
+            counts.update(iter_ngrams(words, min_size=min_size, max_size=max_size, logger=logger))
+            self._chunk_metrics(words, min_size, max_size)
 
-        # Save any left-over counts to the DB
-        logger.debug('Saving final counts...')
-        self.save_db_ngrams(counts)
         logger.debug('Done counting ngram frequencies.')
-        return counts, used_db
-
+        return counts
 
+    def count_wordlist_db(self, min_size=1, max_size=None):
+        """
+        Fused generate-and-count (see count_wordlist) that stores the counts in the database, flushing every
+        DB_FLUSH_ENTRIES distinct ngrams. Read the results back with get_next_top_db_ngrams.
+        """
 
+        logger.debug('Generating and counting ngrams into the database...')
+        start = self._db_start()
+        if start is None:
+            return
+        counts = Counter()
 
+        for words, offset in self.iter_resumable_words(start):
+            counts.update(iter_ngrams(words, min_size=min_size, max_size=max_size, logger=logger))
+            if self._flush_db(counts, offset):
+                counts = Counter()
 
+            self._chunk_metrics(words, min_size, max_size)
 
+        logger.debug('Saving final counts...')
+        self._flush_db(counts, None, force=True)
+        logger.debug('Done counting ngram frequencies.')
 
+    def count_ngrams(self):
 
+        logger.debug('Counting ngram frequencies in chunks...')
+        start = self._db_start()
+        if start is None:
+            return Counter(), True
+        counts = Counter()
+        used_db = start > 0
+
+        for data_chunk, offset in self.iter_resumable_words(start):
+            counts.update(data_chunk)
+            # The upsert adds to the stored counts, so nothing has to be read back from the DB
+            if self._flush_db(counts, offset):
+                used_db = True
+                counts = Counter()
+
+            if metrics.enabled:
+                metrics.inc('counter.ngrams', len(data_chunk))
+                metrics.report()
 
+        # Save any left-over counts to the DB
+        logger.debug('Saving final counts...')
+        self._flush_db(counts, None, force=True)
+        logger.debug('Done counting ngram frequencies.')
+        return counts, used_db
@@ -0,0 +1,147 @@
+
+import os
+import math
+import logging
+import numpy as np
+
+from engine.approx import hash_ngrams, _mix64
+from engine.model import write_arrays, read_arrays
+from engine.metrics import metrics
+from engine.reader import iter_line_chunks, count_lines
+
+logger = logging.getLogger(__name__)
+
+"""
+    Bloom filters over wordlists, used to reject generated passwords that are already in the training wordlist or
+    were generated before.
+
+    Words are hashed in bulk with engine.approx.hash_ngrams; the k bit positions of a word are derived from its 64-bit
+    hash by double hashing, so adding or testing a whole batch is a handful of numpy operations. A filter for n words
+    at false positive rate p takes -n * ln(p) / ln(2)^2 bits: about 1.8GB for a billion words at p=0.001.
+"""
+
+BLOOM_EXT = 'bloom'
+
+# Words hashed per vectorized block while building a filter from a wordlist
+BUILD_CHUNK = 1000000
+
+
+class BloomFilter(object):
+    """
+    Bloom filter with a settable false positive rate. Membership tests never miss an added word and wrongly report
+    an absent word with probability error_rate (when at most capacity words were added).
+    """
+
+    capacity = 0
+    error_rate = 0.001
+
+    def __init__(self, capacity, error_rate=0.001, bits=None, num_hashes=None, count=0):
+        if not 0 < error_rate < 1:
+            raise AttributeError('The false positive rate must be between 0 and 1.')
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_bits = (self.num_bits + 63) // 64 * 64
+        self.num_hashes = num_hashes if num_hashes else max(1, int(round(self.num_bits / self.capacity * math.log(2))))
+        self.bits = bits if bits is not None else np.zeros(self.num_bits // 8, dtype=np.uint8)
+        self.count = count
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def _positions(self, words):
+        """
+        :return: (len(words), num_hashes) array of bit positions
+        """
+        with np.errstate(over='ignore'):
+            h1 = hash_ngrams(words)
+            h2 = _mix64(h1 ^ np.uint64(0x9e3779b97f4a7c15)) | np.uint64(1)
+            steps = np.arange(self.num_hashes, dtype=np.uint64)
+            return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(self.num_bits)
+
+    def add(self, words):
+        """
+        Add a list of words.
+        """
+        if not len(words):
+            return
+        positions = self._positions(words).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                         np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        self.count += len(words)
+
+    def contains(self, words):
+        """
+        :return: boolean numpy array, True for the words that are (probably) in the filter
+        """
+        if not len(words):
+            return np.zeros(0, dtype=bool)
+        positions = self._positions(words)
+        hits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return hits.all(axis=1)
+
+    def __contains__(self, word):
+        return bool(self.contains([word])[0])
+
+    def save(self, filepath, meta=None):
+        """
+        Save with engine.model.write_arrays; meta is stored alongside (e.g. the source wordlist).
+        """
+        header = dict(meta or {})
+        header.update({'type': 'bloom', 'capacity': self.capacity, 'error_rate': self.error_rate,
+                       'num_hashes': self.num_hashes, 'count': self.count})
+        write_arrays(filepath, {'bits': self.bits}, meta=header)
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        """
+        Load a saved filter; the bit array is memory-mapped (read-only) unless mmap=False.
+        """
+        meta, arrays = read_arrays(filepath, mmap=mmap)
+        if meta.get('type') != 'bloom':
+            raise ValueError('%s is not a Bloom filter file.' % filepath)
+        bloom = cls(meta['capacity'], meta['error_rate'], bits=arrays['bits'], num_hashes=meta['num_hashes'],
+                    count=meta['count'])
+        bloom.meta = meta
+        return bloom
+
+    @classmethod
+    def from_wordlist(cls, filepath, error_rate=0.001, chunk_size=BUILD_CHUNK):
+        """
+        Filter over all non-empty lines of a wordlist, sized from a first pass that counts them.
+        """
+        capacity = count_lines(filepath)
+        bloom = cls(capacity, error_rate)
+        logger.debug('Building Bloom filter over %s words of %s (%.0fMB)...' % (capacity, filepath, bloom.nbytes / 2 ** 20))
+        for words in iter_line_chunks(filepath, chunk_size, metric='bloom.bytes_read'):
+            bloom.add(words)
+            metrics.inc('bloom.added', len(words))
+            metrics.report()
+        return bloom
+
+
+def bloom_path(model_path):
+    """
+    :return: path of the Bloom filter persisted next to a model file
+    """
+    return '%s.%s' % (model_path, BLOOM_EXT)
+
+
+def wordlist_filter(wordlist, model_path, error_rate=0.001):
+    """
+    Bloom filter over a training wordlist, persisted next to model_path. A saved filter is reused when it was built
+    from the same wordlist, at the same or a lower false positive rate, after the wordlist was last modified.
+    """
+    filepath = bloom_path(model_path)
+    if os.path.isfile(filepath) and os.path.getmtime(filepath) >= os.path.getmtime(wordlist):
+        bloom = BloomFilter.load(filepath)
+        if bloom.meta.get('source') == os.path.abspath(wordlist) and bloom.error_rate <= error_rate:
+            return bloom
+
+    bloom = BloomFilter.from_wordlist(wordlist, error_rate=error_rate)
+    tmp_file = '%s.tmp' % filepath
+    bloom.save(tmp_file, meta={'source': os.path.abspath(wordlist)})
+    os.replace(tmp_file, filepath)
+    logger.debug('Saved Bloom filter to %s' % filepath)
+    return bloom
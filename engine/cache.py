@@ -0,0 +1,123 @@
+
+import os
+import json
+import time
+import logging
+import hashlib
+
+import settings
+from engine.utils import load_obj, save_obj
+
+logger = logging.getLogger(__name__)
+
+
+def file_digest(filepath, block_size=1 << 20):
+    """
+    blake2b digest of a file's content, read in large blocks.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ModelCache(object):
+    """
+    On-disk cache of trained models keyed by the content of their training data and their training parameters.
+
+    Entries are pickled objects in cache_dir, listed in a JSON index file with their size and last use. When the
+    cache grows beyond max_entries or max_bytes the least recently used entries are evicted.
+    """
+
+    index_name = 'index.json'
+
+    cache_dir = None
+    max_entries = 20
+    max_bytes = 2 * 1024 ** 3
+
+    def __init__(self, cache_dir=None, max_entries=None, max_bytes=None, extension=None):
+        self.cache_dir = cache_dir if cache_dir else settings.VALIDATOR_PATH
+        self.extension = extension if extension else settings.EXT_VALIDATOR
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.index_path = os.path.join(self.cache_dir, self.index_name)
+
+    @staticmethod
+    def make_key(content_digest, params):
+        key_data = json.dumps({'content': content_digest, 'params': params}, sort_keys=True)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()[:32]
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, '%s.%s' % (key, self.extension))
+
+    def load_index(self):
+        if not os.path.isfile(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            logger.debug('Cache index %s is corrupt. Starting a new one.' % self.index_path)
+            return {}
+
+    def save_index(self, index):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, key):
+        """
+        :return: the cached object, or None on a miss
+        """
+        index = self.load_index()
+        entry_path = self._entry_path(key)
+        if key not in index or not os.path.isfile(entry_path):
+            return None
+
+        logger.debug('Cache hit: %s' % entry_path)
+        obj = load_obj(entry_path)
+        index[key]['last_used'] = time.time()
+        self.save_index(index)
+        return obj
+
+    def put(self, key, obj, **info):
+        """
+        Store obj under key; extra keyword arguments are recorded in the index entry.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry_path = self._entry_path(key)
+        save_obj(obj, entry_path)
+        logger.debug('Cached model: %s' % entry_path)
+
+        index = self.load_index()
+        now = time.time()
+        entry = dict(info)
+        entry.update({'size': os.path.getsize(entry_path), 'created': now, 'last_used': now})
+        index[key] = entry
+        self.evict(index)
+        self.save_index(index)
+
+    def evict(self, index):
+        """
+        Drop least recently used entries (and index entries whose file is gone) until the limits are met.
+        """
+        for key in [k for k in index if not os.path.isfile(self._entry_path(k))]:
+            del index[key]
+
+        by_age = sorted(index, key=lambda k: index[k]['last_used'])
+        total = sum(entry['size'] for entry in index.values())
+        # The most recently used entry is always kept
+        while len(by_age) > 1 and (len(index) > self.max_entries or total > self.max_bytes):
+            key = by_age.pop(0)
+            logger.debug('Evicting cached model: %s' % self._entry_path(key))
+            total -= index[key]['size']
+            del index[key]
+            os.remove(self._entry_path(key))
@@ -0,0 +1,139 @@
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+
+import settings
+from engine.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+    Checkpoints for resumable stages.
+
+    A stage saves a manifest every `interval` seconds, at a point where its output is consistent with a prefix of its
+    input: the input byte offset it got to plus whatever it needs to continue (run files, the size of its output file,
+    ...). A rerun with the same checkpoint directory loads the manifest and continues from that offset. Manifests
+    record the source file (path, size, modification time) and the stage parameters, and are ignored when any of them
+    changed.
+"""
+
+# Seconds between two checkpoints of a stage
+CHECKPOINT_INTERVAL = 300
+
+
+def fsync_file(filepath):
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def checkpoint_directory(source, root=None):
+    """
+    :return: checkpoint directory of the runs over source (under settings.CHECKPOINT_PATH by default)
+    """
+    root = root if root else settings.CHECKPOINT_PATH
+    digest = hashlib.sha256(os.path.abspath(source).encode('utf-8')).hexdigest()[:10]
+    return os.path.join(root, '%s_%s' % (os.path.basename(source), digest))
+
+
+def remove_checkpoints(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+class Checkpoint(object):
+    """
+    Manifest of one stage, saved as <directory>/<stage>.json. Stage data files live in <directory>/<stage>/.
+    """
+
+    directory = None
+    stage = None
+    interval = CHECKPOINT_INTERVAL
+
+    def __init__(self, directory, stage, source, params=None, interval=CHECKPOINT_INTERVAL):
+        # Absolute, so that the paths recorded in the manifest do not depend on the working directory
+        self.directory = os.path.abspath(directory)
+        self.stage = stage
+        self.path = os.path.join(self.directory, '%s.json' % stage)
+        self.interval = interval
+        stat = os.stat(source)
+        self.identity = {
+            'stage': stage,
+            'source': os.path.abspath(source),
+            'source_size': stat.st_size,
+            'source_mtime': stat.st_mtime,
+            'params': params or {},
+        }
+        self.last_save = time.time()
+
+    def data_dir(self):
+        """
+        :return: the (created) directory for the stage's data files
+        """
+        path = os.path.join(self.directory, self.stage)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def matches(self, manifest):
+        return manifest is not None and all(manifest.get(key) == value for key, value in self.identity.items())
+
+    def due(self):
+        return time.time() - self.last_save >= self.interval
+
+    def record(self, state):
+        """
+        :return: the manifest of state (for stages that store it themselves, see NGramCounter.save_db_ngrams)
+        """
+        self.last_save = time.time()
+        metrics.inc('checkpoint.saves')
+        manifest = dict(self.identity)
+        manifest.update({'state': state, 'saved': self.last_save})
+        return manifest
+
+    def state_of(self, manifest):
+        """
+        :return: the state of a manifest written for this stage's source and parameters, else None
+        """
+        if not self.matches(manifest):
+            if manifest is not None:
+                logger.debug('Ignoring %s checkpoint: the input or the parameters changed.' % self.stage)
+            return None
+        logger.debug('Resuming %s from its checkpoint of %s' % (self.stage, time.ctime(manifest['saved'])))
+        return manifest['state']
+
+    def load(self):
+        """
+        :return: the saved state, or None if there is no (matching) manifest
+        """
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, encoding='utf-8') as f:
+            return self.state_of(json.load(f))
+
+    def save(self, state, sync=()):
+        """
+        Atomically replace the manifest. The files in sync are flushed to disk first, so that a manifest never refers
+        to data lost in a crash.
+        """
+        for filepath in sync:
+            fsync_file(filepath)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.record(state), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """
+        Remove the manifest and the stage data files.
+        """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        shutil.rmtree(os.path.join(self.directory, self.stage), ignore_errors=True)
@@ -0,0 +1,83 @@
+
+import json
+import socket
+
+"""
+    Client of the generation/validation service (see engine.service).
+
+    Only uses the standard library, so a client call does not import numpy, scipy or sklearn.
+"""
+
+
+class ServiceClient(object):
+    """
+    Sends requests to a running service over its Unix domain socket (or localhost TCP port) and returns the
+    responses. The connection is opened on the first request and reused by the next ones.
+    """
+
+    socket_path = None
+    port = None
+    timeout = None
+
+    def __init__(self, socket_path=None, port=None, timeout=None):
+        self.socket_path = socket_path
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.f = None
+
+    def connect(self):
+        if self.port is not None:
+            self.sock = socket.create_connection(('127.0.0.1', self.port), timeout=self.timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.socket_path)
+        self.f = self.sock.makefile('rwb')
+
+    def close(self):
+        if self.sock:
+            self.f.close()
+            self.sock.close()
+        self.sock = None
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, op, **params):
+        """
+        :return: the response dict of the service
+        :raises ValueError: if the service rejected the request
+        """
+        if not self.sock:
+            self.connect()
+        params['op'] = op
+        self.f.write(json.dumps(params).encode('utf-8') + b'\n')
+        self.f.flush()
+        line = self.f.readline()
+        if not line:
+            self.close()
+            raise ConnectionError('Service closed the connection.')
+        response = json.loads(line.decode('utf-8'))
+        if not response.pop('ok', False):
+            raise ValueError(response.get('error', 'Request failed.'))
+        return response
+
+    def generate(self, length=10, count=100, **params):
+        return self.request('generate', length=length, count=count, **params)['passwords']
+
+    def classify(self, passwords):
+        return self.request('classify', passwords=list(passwords))['accepted']
+
+    def compare(self, words):
+        return self.request('compare', words=list(words))['results']
+
+    def reload(self):
+        return self.request('reload')
+
+    def status(self):
+        return self.request('status')
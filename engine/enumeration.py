@@ -0,0 +1,250 @@
+
+import logging
+import numpy as np
+
+from scipy import sparse
+
+from engine.model import MarkovModel
+
+logger = logging.getLogger(__name__)
+
+"""
+    Probability-ordered password enumeration.
+
+    Passwords of a fixed length are emitted in descending model probability, each exactly once. The log-probability
+    range is walked from the top in bands [lo, hi): a band is enumerated by expanding prefixes level by level and
+    dropping every prefix whose best completion falls below lo (nothing to emit) or whose worst completion is at least
+    hi (all emitted by earlier bands). The best/worst completions of every character are computed once by dynamic
+    programming over the transition matrix, so only prefixes that lead to the band are expanded. A band is sorted and
+    emitted before the next one is enumerated; band widths adapt so a band holds about band_size passwords, which
+    bounds memory regardless of how many passwords are enumerated in total. A band that is still too large once it is
+    narrower than MIN_BAND_WIDTH holds equally likely passwords (e.g. every password of a uniform model): it is
+    emitted in alphabet order, prefix by prefix, as it is enumerated, without being held or sorted as a whole.
+"""
+
+# Slack for the rounding of the completion bounds (log-probabilities)
+BOUND_EPS = 1e-9
+
+# Passwords in a band narrower than this (in log-probability) count as equally likely
+MIN_BAND_WIDTH = 1e-6
+
+
+class MarkovEnumerator(object):
+    """
+    Best-first enumeration of the passwords of one length from a first-order MarkovModel.
+
+    The probability of a password is that of its first character times its transitions, with the same restart rule
+    as MarkovSampler (characters without outgoing transitions continue from the first-character distribution); the
+    sampler's random mutations are not part of it.
+    """
+
+    alphabet = None
+    length = None
+    min_prob = None
+    band_size = 100000
+    chunk_size = 1024
+
+    def __init__(self, model, length, min_prob=None, band_size=100000, chunk_size=1024):
+        """
+        :param min_prob: stop at passwords less likely than this
+        :param band_size: passwords enumerated (and held in memory) per band, approximately
+        :param chunk_size: prefixes expanded at once
+        """
+        if not isinstance(model, MarkovModel):
+            raise AttributeError('Enumeration only supports first-order markov models.')
+        if length < 1:
+            raise AttributeError('Password length must be at least 1.')
+        if min_prob is not None and not 0.0 < min_prob <= 1.0:
+            raise AttributeError('Minimum probability must be in (0, 1].')
+
+        self.alphabet = model.alphabet
+        self.length = length
+        self.min_prob = min_prob
+        self.band_size = band_size
+        self.chunk_size = chunk_size
+        self._compile(model)
+        self._completion_bounds()
+
+    @classmethod
+    def from_file(cls, filepath, length, **kwargs):
+        return cls(MarkovModel.load(filepath), length, **kwargs)
+
+    def _compile(self, model):
+        size = len(self.alphabet)
+        first = np.array(model.first, dtype=np.float64)
+        if size == 0 or first.sum() <= 0:
+            raise AttributeError('Markov model has no first-character frequencies.')
+
+        trans = model.to_csr().astype(np.float64)
+        trans.eliminate_zeros()
+        dead_rows = np.diff(trans.indptr) == 0
+        if dead_rows.any():
+            restart = sparse.csr_matrix(dead_rows.astype(np.float64)[:, np.newaxis]) @ sparse.csr_matrix(first)
+            trans = (trans + restart).tocsr()
+            trans.eliminate_zeros()
+        trans = MarkovModel._normalize(trans)
+        trans.sort_indices()
+
+        with np.errstate(divide='ignore'):
+            self.log_first = np.log(first / first.sum())
+        self.log_trans = np.log(trans.data)
+        self.indices = trans.indices.astype(np.int32)
+        self.indptr = trans.indptr.astype(np.int64)
+        self.row_nnz = np.diff(self.indptr)
+
+    def _completion_bounds(self):
+        """
+        best[k][c] / worst[k][c]: highest / lowest log-probability of the k transitions that can follow character c
+        """
+        size = len(self.alphabet)
+        self.best = np.zeros((self.length, size), dtype=np.float64)
+        self.worst = np.zeros((self.length, size), dtype=np.float64)
+        row_start = self.indptr[:-1]
+        for k in range(1, self.length):
+            self.best[k] = np.maximum.reduceat(self.log_trans + self.best[k-1][self.indices], row_start)
+            self.worst[k] = np.minimum.reduceat(self.log_trans + self.worst[k-1][self.indices], row_start)
+
+        starts = np.isfinite(self.log_first)
+        remaining = self.length - 1
+        self.top = float(np.max(self.log_first[starts] + self.best[remaining][starts]))
+        self.bottom = float(np.min(self.log_first[starts] + self.worst[remaining][starts]))
+
+    def _viable(self, chars, logp, remaining, lo, hi):
+        keep = logp + self.best[remaining][chars] >= lo - BOUND_EPS
+        if np.isfinite(hi):
+            keep &= logp + self.worst[remaining][chars] < hi + BOUND_EPS
+        return keep
+
+    def _expand(self, codes, logp, lo, hi):
+        """
+        :return: the one character longer prefixes of codes that can complete into the band [lo, hi)
+        """
+        last = codes[:, -1]
+        counts = self.row_nnz[last]
+        parent = np.repeat(np.arange(len(last)), counts)
+        offsets = np.cumsum(counts) - counts
+        entries = self.indptr[last][parent] + np.arange(int(counts.sum())) - offsets[parent]
+
+        child = self.indices[entries]
+        child_logp = logp[parent] + self.log_trans[entries]
+        keep = self._viable(child, child_logp, self.length - codes.shape[1] - 1, lo, hi)
+        return np.hstack((codes[parent[keep]], child[keep][:, np.newaxis])), child_logp[keep]
+
+    def _iter_band(self, lo, hi):
+        """
+        Yield (codes, log-probabilities) arrays of the passwords with a log-probability in [lo, hi), in alphabet order
+        (depth first: one chunk of prefixes per level is expanded at a time).
+        """
+        starts = np.nonzero(np.isfinite(self.log_first))[0].astype(np.int32)
+        keep = self._viable(starts, self.log_first[starts], self.length - 1, lo, hi)
+        stack = [(starts[keep][:, np.newaxis], self.log_first[starts][keep])]
+
+        while stack:
+            codes, logp = stack.pop()
+            if codes.shape[1] == self.length:
+                in_band = (logp >= lo) & (logp < hi)
+                if in_band.any():
+                    yield codes[in_band], logp[in_band]
+            elif len(logp) > self.chunk_size:
+                # Split instead of expanding everything at once: only one chunk's children per level are in memory
+                for start in reversed(range(0, len(logp), self.chunk_size)):
+                    stack.append((codes[start:start+self.chunk_size], logp[start:start+self.chunk_size]))
+            elif len(logp):
+                stack.append(self._expand(codes, logp, lo, hi))
+
+    def _band(self, lo, hi, cap=None):
+        """
+        :return: (codes, log-probabilities) of every password with a log-probability in [lo, hi), in descending
+            order, or None once more than cap passwords are found
+        """
+        found_codes, found_logp = [], []
+        found = 0
+        for codes, logp in self._iter_band(lo, hi):
+            found_codes.append(codes)
+            found_logp.append(logp)
+            found += len(logp)
+            if cap is not None and found > cap:
+                return None
+
+        if not found_codes:
+            return np.empty((0, self.length), dtype=np.int32), np.empty(0, dtype=np.float64)
+        codes = np.vstack(found_codes)
+        logp = np.concatenate(found_logp)
+        # Descending probability; equally likely passwords in alphabet order
+        order = np.lexsort([codes[:, i] for i in reversed(range(self.length))] + [-logp])
+        return codes[order], logp[order]
+
+    def iter_bands(self):
+        """
+        Yield (codes, log-probabilities) arrays of consecutive bands, together covering every password (down to
+        min_prob) in descending probability.
+        """
+        floor = self.bottom - BOUND_EPS
+        if self.min_prob is not None:
+            floor = max(floor, float(np.log(self.min_prob)))
+
+        hi = np.inf
+        width = 1.0
+        while True:
+            lo = max((self.top if np.isinf(hi) else hi) - width, floor)
+            if width < MIN_BAND_WIDTH:
+                found = 0
+                for codes, logp in self._iter_ties(lo, hi):
+                    found += len(logp)
+                    yield codes, logp
+            else:
+                band = self._band(lo, hi, cap=4 * self.band_size)
+                if band is None:
+                    width /= 2
+                    continue
+                codes, logp = band
+                found = len(logp)
+                if found:
+                    yield codes, logp
+
+            logger.debug('Enumerated %s passwords with log-probability in [%.4f, %.4f)' % (found, lo, hi))
+            if lo <= floor:
+                break
+
+            if found < self.band_size // 4:
+                width *= 2
+            elif found > self.band_size:
+                width /= 2
+            hi = lo
+
+    def _iter_ties(self, lo, hi):
+        """
+        Yield the passwords of a narrow band (see MIN_BAND_WIDTH) in alphabet order, in arrays of about band_size.
+        """
+        found_codes, found_logp = [], []
+        found = 0
+        for codes, logp in self._iter_band(lo, hi):
+            found_codes.append(codes)
+            found_logp.append(logp)
+            found += len(logp)
+            if found >= self.band_size:
+                yield np.vstack(found_codes), np.concatenate(found_logp)
+                found_codes, found_logp = [], []
+                found = 0
+        if found_codes:
+            yield np.vstack(found_codes), np.concatenate(found_logp)
+
+    def decode(self, codes):
+        chars = np.array(self.alphabet, dtype='U1')[codes]
+        return np.ascontiguousarray(chars).view('U%s' % self.length).ravel().tolist()
+
+    def generate_batches(self, batch_size=100000):
+        """
+        Yield lists of at most batch_size passwords, in descending probability; no password is repeated.
+        """
+        for codes, _ in self.iter_bands():
+            for start in range(0, len(codes), batch_size):
+                yield self.decode(codes[start:start+batch_size])
+
+    def __iter__(self):
+        """
+        Yield (password, probability) pairs in descending probability.
+        """
+        for codes, logp in self.iter_bands():
+            for password, prob in zip(self.decode(codes), np.exp(logp).tolist()):
+                yield password, prob
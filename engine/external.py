@@ -0,0 +1,271 @@
+
+import os
+import heapq
+import logging
+import shutil
+import tempfile
+
+from collections import Counter
+from itertools import islice
+
+import settings
+from engine.base import NGramCounter
+from engine.metrics import metrics
+from engine.utils import iter_ngrams, count_sort_key
+from engine.reader import read_counts
+
+logger = logging.getLogger(__name__)
+
+# Rough cost of one {ngram: count} entry in a Python dict (slot + str + int objects), used to turn a memory budget
+# into a maximum number of in-memory entries.
+ENTRY_BYTES = 160
+
+# Maximum number of run files merged at once; more runs are merged in several passes
+MAX_FAN_IN = 128
+
+
+def write_run(items, filepath):
+    with open(filepath, 'w', encoding='utf-8') as f:
+        for ng, ng_count in items:
+            f.write('%s\t%s\n' % (ng, ng_count))
+    return filepath
+
+
+def merge_sum(iterators):
+    """
+    Merge iterators of (ngram, count) sorted by ngram, summing the counts of equal n-grams.
+    """
+    current_ng = None
+    current_count = 0
+    for ng, ng_count in heapq.merge(*iterators, key=lambda item: item[0]):
+        if ng == current_ng:
+            current_count += ng_count
+            continue
+        if current_ng is not None:
+            yield current_ng, current_count
+        current_ng = ng
+        current_count = ng_count
+    if current_ng is not None:
+        yield current_ng, current_count
+
+
+class ExternalNGramCounter(NGramCounter):
+    """
+    NGramCounter with a fixed memory budget.
+
+    Counts are aggregated in memory until the budget is reached, then flushed to disk as a run sorted by n-gram.
+    Runs are k-way merged (summing equal n-grams) and re-sorted by frequency the same way, so memory use is bounded
+    by memory_budget regardless of the number of distinct n-grams.
+    """
+
+    memory_budget = 1024
+    tmp_dir = None
+    work_dir = None
+    runs = None
+    spill_count = 0
+    run_count = 0
+
+    min_size = 1
+    max_size = None
+
+    # Share of max_entries left free below which counts are spilled: n-grams are fed up to the headroom left between
+    # two memory checks, so this keeps them from being checked a few n-grams at a time
+    spill_headroom = 0.1
+
+    def __init__(self, filepath, memory_budget=1024, chunk_size=500000, tmp_dir=None, checkpoint=None):
+        """
+        :param memory_budget: memory budget for in-memory counts, in MB
+        :param checkpoint: engine.checkpoint.Checkpoint to save progress to and resume from. Runs are then written to
+            the checkpoint's data directory, and the in-memory counts are spilled at every checkpoint.
+        """
+        super(ExternalNGramCounter, self).__init__(filepath, chunk_size=chunk_size, use_db=False,
+                                                   checkpoint=checkpoint)
+        self.memory_budget = memory_budget
+        self.tmp_dir = tmp_dir
+        self.runs = []
+        self.synced_runs = 0
+
+    @property
+    def max_entries(self):
+        return max(int(self.memory_budget * 1024 * 1024 / ENTRY_BYTES), 1)
+
+    def _run_path(self, prefix):
+        if not self.work_dir:
+            if self.checkpoint:
+                self.work_dir = self.checkpoint.data_dir()
+            else:
+                self.work_dir = tempfile.mkdtemp(prefix='ngruns_', dir=self.tmp_dir)
+        self.run_count += 1
+        return os.path.join(self.work_dir, '%s_%s.%s' % (prefix, self.run_count, settings.EXT_NG_COUNTS))
+
+    def _spill(self, counts):
+        if not counts:
+            return
+        with metrics.timer('counter.spill'):
+            path = write_run(sorted(counts.items()), self._run_path('run'))
+        self.spill_count += 1
+        metrics.inc('counter.spills')
+        metrics.inc('counter.spilled_entries', len(counts))
+        logger.debug('\tSpilled %s ngrams to %s' % (len(counts), path))
+        self.runs.append(path)
+        counts.clear()
+
+    def _merge_runs(self, runs, key=None, combine=False):
+        """
+        Reduce runs to at most MAX_FAN_IN files, merging MAX_FAN_IN at a time.
+        """
+        while len(runs) > MAX_FAN_IN:
+            merged = []
+            for i in range(0, len(runs), MAX_FAN_IN):
+                group = runs[i:i+MAX_FAN_IN]
+                iterators = [read_counts(path) for path in group]
+                items = merge_sum(iterators) if combine else heapq.merge(*iterators, key=key)
+                merged.append(write_run(items, self._run_path('merge')))
+                # Checkpointed runs stay until the counts have been consumed
+                if not self.checkpoint:
+                    for path in group:
+                        os.remove(path)
+            runs = merged
+        return runs
+
+    def _resume(self):
+        """
+        :return: input offset to count from, or None if the checkpointed run counted everything
+        """
+        state = self.checkpoint.load() if self.checkpoint else None
+        if not state:
+            return 0
+        # Runs spilled after the last checkpoint are renumbered (overwritten) as counting continues
+        self.runs = list(state['runs'])
+        self.run_count = state['run_count']
+        self.synced_runs = len(self.runs)
+        return None if state['complete'] else state['offset']
+
+    def _save_checkpoint(self, offset, complete=False):
+        self.checkpoint.save({'offset': offset, 'runs': self.runs, 'run_count': self.run_count, 'complete': complete},
+                             sync=self.runs[self.synced_runs:])
+        self.synced_runs = len(self.runs)
+
+    def _count_file(self, generate):
+        start = self._resume()
+        if start is None:
+            logger.debug('Counts restored from the checkpoint (%s runs).' % len(self.runs))
+            return self.runs
+
+        counts = Counter()
+        min_headroom = max(int(self.max_entries * self.spill_headroom), 1)
+        for words, offset in self.iter_resumable_words(start):
+            ngrams = iter_ngrams(words, min_size=self.min_size, max_size=self.max_size, logger=logger) if generate else iter(words)
+            for ngram in ngrams:
+                # Every n-gram adds at most one entry: feed no more than the headroom left, whatever the line lengths
+                counts[ngram] += 1
+                counts.update(islice(ngrams, self.max_entries - len(counts)))
+                if self.max_entries - len(counts) < min_headroom:
+                    self._spill(counts)
+
+            if generate:
+                self._chunk_metrics(words, self.min_size, self.max_size)
+            elif metrics.enabled:
+                metrics.inc('counter.ngrams', len(words))
+                metrics.report()
+
+            if offset is not None and self.checkpoint and self.checkpoint.due():
+                self._spill(counts)
+                self._save_checkpoint(offset)
+
+        self._spill(counts)
+        if self.checkpoint:
+            self._save_checkpoint(None, complete=True)
+        logger.debug('Done counting ngram frequencies (%s runs).' % len(self.runs))
+        return self.runs
+
+    def count_wordlist(self, min_size=1, max_size=None):
+        """
+        Bounded-memory version of NGramCounter.count_wordlist.
+        :return: list of run files (see get_next_top_ngrams)
+        """
+        logger.debug('Generating and counting ngrams (memory budget=%sMB)...' % self.memory_budget)
+        self.min_size = min_size
+        self.max_size = max_size
+        return self._count_file(generate=True)
+
+    def count_ngrams(self):
+        """
+        Bounded-memory version of NGramCounter.count_ngrams: count an n-gram file (one n-gram per line).
+        :return: list of run files (see get_next_top_ngrams)
+        """
+        logger.debug('Counting ngram frequencies (memory budget=%sMB)...' % self.memory_budget)
+        return self._count_file(generate=False)
+
+    def iter_counts(self, runs=None, cleanup=False):
+        """
+        Yield the aggregated (ngram, count) pairs, sorted by n-gram.
+        :param cleanup: remove the temporary files once exhausted
+        """
+        runs = self._merge_runs(list(runs if runs is not None else self.runs), combine=True)
+        counts = merge_sum([read_counts(path) for path in runs])
+        return self._cleanup_after(counts) if cleanup else counts
+
+    def _cleanup_after(self, items):
+        complete = False
+        try:
+            for item in items:
+                yield item
+            complete = True
+        finally:
+            self.cleanup(complete)
+
+    def cleanup(self, complete=True):
+        """
+        Remove the run files. A checkpoint (and its runs) is only removed once the counts were completely consumed,
+        so that an interrupted merge can be resumed.
+        """
+        if self.checkpoint:
+            if complete:
+                self.checkpoint.clear()
+                self.work_dir = None
+                self.runs = []
+            return
+        if self.work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
+        self.runs = []
+
+    def get_next_top_ngrams(self, runs=None, n=100):
+        """
+        Yield (ngram, count) chunks in descending count order: the aggregated counts are cut into sorted runs of at
+        most max_entries and k-way merged by frequency. Temporary files are removed once exhausted.
+        """
+        complete = False
+        try:
+            sorted_runs = []
+            buffer = []
+            for item in self.iter_counts(runs):
+                buffer.append(item)
+                if len(buffer) >= self.max_entries:
+                    buffer.sort(key=count_sort_key)
+                    sorted_runs.append(write_run(buffer, self._run_path('sorted')))
+                    buffer = []
+
+            if sorted_runs and buffer:
+                buffer.sort(key=count_sort_key)
+                sorted_runs.append(write_run(buffer, self._run_path('sorted')))
+                buffer = []
+
+            if sorted_runs:
+                sorted_runs = self._merge_runs(sorted_runs, key=count_sort_key)
+                merged = heapq.merge(*[read_counts(path) for path in sorted_runs], key=count_sort_key)
+            else:
+                merged = iter(sorted(buffer, key=count_sort_key))
+
+            chunk = []
+            for item in merged:
+                chunk.append(item)
+                if len(chunk) >= n:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+            complete = True
+        finally:
+            self.cleanup(complete)
@@ -0,0 +1,149 @@
+
+import logging
+import numpy as np
+
+from scipy import sparse
+
+from engine.approx import FNV_OFFSET, FNV_PRIME, _mix64
+
+logger = logging.getLogger(__name__)
+
+"""
+    Password feature encoders for the validator (see PasswordVerifier).
+
+    An encoder turns a list of passwords into the matrix the classifier is trained on and predicts from, in bulk. Its
+    name and parameters are part of the validator cache key, so models trained on one encoding are never used with
+    another.
+"""
+
+# Pseudo code points marking the start and the end of a password (above the unicode range)
+BEGIN_MARK = 0x110000
+END_MARK = 0x110001
+
+
+class OrdEncoder(object):
+    """
+    Dense (n, max_length) array of the passwords' code points, zero-padded (the original str_to_numbers encoding).
+    """
+
+    name = 'ord100'
+    max_length = 100
+
+    # RBF width for the classifiers: None keeps the backend's default
+    gamma = None
+
+    def __init__(self, max_length=100):
+        self.max_length = max_length
+
+    def get_params(self):
+        return {'max_length': self.max_length}
+
+    def encode(self, password_list):
+        """
+        Passwords longer than max_length are truncated.
+        """
+        result = np.zeros((len(password_list), self.max_length), dtype=np.uint32)
+        if len(password_list) == 0:
+            return result
+        # A fixed-width unicode array is laid out as UTF-32 code points, i.e. exactly ord() of every character
+        codes = np.array(password_list, dtype='U%s' % self.max_length).view(np.uint32)
+        result[:] = codes.reshape(len(password_list), self.max_length)
+        return result
+
+
+class HashedNGramEncoder(object):
+    """
+    Sparse CSR matrix of the counts of every character n-gram (min_n to max_n) of the passwords, hashed into
+    n_features columns, with rows scaled to unit length. The passwords are framed by begin/end marks, so n-grams at
+    the start or the end of a password (e.g. trailing digits) are features of their own.
+
+    A password of length L only fills about (max_n - min_n + 1) * L columns. The sgd backend's feature map works on
+    those entries directly, so it trains and classifies faster than on OrdEncoder; the exact svm backend goes through
+    libsvm's sparse kernels, which train slower.
+    """
+
+    name = 'hashed'
+    n_features = 1 << 12
+    min_n = 1
+    max_n = 3
+    max_length = 64
+
+    # Rows are unit vectors (squared distances between 0 and 2)
+    gamma = 1.0
+
+    def __init__(self, n_features=1 << 12, min_n=1, max_n=3, max_length=64):
+        if not 1 <= min_n <= max_n:
+            raise AttributeError('N-gram sizes must satisfy 1 <= min_n <= max_n.')
+        self.n_features = n_features
+        self.min_n = min_n
+        self.max_n = max_n
+        self.max_length = max_length
+
+    def get_params(self):
+        return {'n_features': self.n_features, 'min_n': self.min_n, 'max_n': self.max_n,
+                'max_length': self.max_length}
+
+    def _framed_codes(self, password_list):
+        """
+        :return: (n, width + 2) array of BEGIN_MARK, code points, END_MARK and zero padding, and the framed lengths
+        """
+        n = len(password_list)
+        lengths = np.minimum(np.fromiter(map(len, password_list), dtype=np.int64, count=n), self.max_length)
+        width = max(int(lengths.max()), 1)
+        codes = np.array(password_list, dtype='U%s' % width).view(np.uint32).reshape(n, width)
+
+        framed = np.zeros((n, width + 2), dtype=np.uint64)
+        framed[:, 0] = BEGIN_MARK
+        framed[:, 1:width + 1] = codes
+        # Padding code points (0) after the end are overwritten by the mark and never part of a valid window
+        framed[np.arange(n), lengths + 1] = END_MARK
+        return framed, lengths + 2
+
+    def encode(self, password_list):
+        n = len(password_list)
+        if n == 0:
+            return sparse.csr_matrix((0, self.n_features), dtype=np.float32)
+
+        framed, lengths = self._framed_codes(password_list)
+        hashes = []
+        valid = []
+        with np.errstate(over='ignore'):
+            for size in range(self.min_n, self.max_n + 1):
+                windows = framed.shape[1] - size + 1
+                if windows <= 0:
+                    continue
+                # FNV-1a over the code points of every window, all windows of a size at once
+                h = np.full((n, windows), FNV_OFFSET, dtype=np.uint64)
+                for k in range(size):
+                    h ^= framed[:, k:k + windows]
+                    h *= FNV_PRIME
+                hashes.append(h)
+                valid.append(np.arange(windows)[np.newaxis, :] <= (lengths - size)[:, np.newaxis])
+
+            # Side by side, the valid windows of the row-major mask come out grouped by password: the CSR layout
+            valid = np.hstack(valid)
+            columns = (_mix64(np.hstack(hashes)[valid]) % np.uint64(self.n_features)).astype(np.int32)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(valid.sum(axis=1), out=indptr[1:])
+
+        matrix = sparse.csr_matrix((np.ones(len(columns), dtype=np.float32), columns, indptr),
+                                   shape=(n, self.n_features))
+        # Repeated n-grams (and hash collisions) of a password are summed into one entry
+        matrix.sum_duplicates()
+        row_of_entry = np.repeat(np.arange(n), np.diff(matrix.indptr))
+        norms = np.sqrt(np.bincount(row_of_entry, weights=np.square(matrix.data), minlength=n))
+        norms[norms == 0] = 1.0
+        matrix.data /= norms[row_of_entry].astype(np.float32)
+        return matrix
+
+
+ENCODERS = {
+    OrdEncoder.name: OrdEncoder,
+    HashedNGramEncoder.name: HashedNGramEncoder,
+}
+
+
+def make_encoder(name, **params):
+    if name not in ENCODERS:
+        raise AttributeError('Unknown feature encoding: %s (expected one of %s)' % (name, ', '.join(sorted(ENCODERS))))
+    return ENCODERS[name](**params)
@@ -0,0 +1,138 @@
+
+import logging
+import numpy as np
+
+from collections import deque
+from multiprocessing import Pool
+
+from engine.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+    Reproducible, multi-process candidate generation.
+
+    The candidate stream is cut into blocks of batch_size candidates, and block i is drawn with its own Generator,
+    seeded with the i-th child of the run's SeedSequence. A block is therefore the same whichever process draws it:
+    workers draw and filter (known passwords, validator) whole blocks, and the blocks are put back in order, so a run
+    only depends on its seed and block sizes, not on the number of workers. Block sizes start at first_batch and
+    double up to batch_size (see block_size), so a run that only needs a few passwords does not draw a whole
+    batch_size block.
+"""
+
+# Blocks in flight per worker
+BLOCKS_PER_WORKER = 2
+
+# Smallest first block, and its margin over the candidates expected to give the passwords wanted
+MIN_FIRST_BATCH = 256
+FIRST_BATCH_MARGIN = 1.25
+
+
+def seed_sequence(seed=None):
+    """
+    :return: the SeedSequence of a run; a random one (see its entropy) without seed
+    """
+    return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+
+def block_rng(seed_seq, block):
+    """
+    :return: Generator of a block: the same as seed_seq.spawn(block + 1)[block], without spawning the others
+    """
+    child = np.random.SeedSequence(seed_seq.entropy, spawn_key=tuple(seed_seq.spawn_key) + (block,),
+                                   pool_size=seed_seq.pool_size)
+    return np.random.default_rng(child)
+
+
+def draw_block(sampler, length, batch_size, seed_seq, block):
+    sampler.rng = block_rng(seed_seq, block)
+    return sampler.generate_batch(batch_size, length)
+
+
+def first_batch_size(n, batch_size, keep_rate=None):
+    """
+    :return: size of the first block of a run that wants n passwords: n divided by the share of candidates expected
+        to be kept (keep_rate, e.g. a validator's acceptance rate so far; all of them if unknown), with a margin
+    """
+    expected = n / keep_rate if keep_rate else n
+    return int(min(max(expected * FIRST_BATCH_MARGIN, MIN_FIRST_BATCH), batch_size))
+
+
+def block_size(block, batch_size, first_batch=None):
+    """
+    :return: number of candidates of block number block: first_batch, doubled every block up to batch_size
+    """
+    if not first_batch:
+        return batch_size
+    return min(first_batch << min(block, 32), batch_size)
+
+
+def iter_seeded_candidates(sampler, length, batch_size, seed_seq, start=0, first_batch=None):
+    """
+    Endless stream of candidate batches from a MarkovSampler or NGramSampler, one block each (in process).
+    :param first_batch: size of the first block; the next ones double in size up to batch_size
+    """
+    block = start
+    while True:
+        yield draw_block(sampler, length, block_size(block, batch_size, first_batch), seed_seq, block)
+        block += 1
+
+
+# Worker state (set by the pool initializer)
+_worker = None
+
+
+def _init_worker(sampler, length, batch_size, seed_seq, known, validator, first_batch):
+    global _worker
+    _worker = (sampler, length, batch_size, seed_seq, known, validator, first_batch)
+
+
+def _generate_block(block):
+    """
+    Worker: draw a block and drop the known and rejected candidates.
+    :return: (number of candidates, number of known candidates, kept passwords)
+    """
+    sampler, length, batch_size, seed_seq, known, validator, first_batch = _worker
+    batch = draw_block(sampler, length, block_size(block, batch_size, first_batch), seed_seq, block)
+    candidates = len(batch)
+    excluded = 0
+    if known is not None and batch:
+        batch = [pw for pw, hit in zip(batch, known.contains(batch).tolist()) if not hit]
+        excluded = candidates - len(batch)
+    if validator is not None:
+        batch = validator.filter_passwords(batch)
+    return candidates, excluded, batch
+
+
+def parallel_blocks(sampler, length, batch_size, seed_seq, workers, known=None, validator=None, n=None,
+                    first_batch=None):
+    """
+    Endless, ordered stream of _generate_block results, computed by a pool of workers; the blocks are those of
+    iter_seeded_candidates. At most a few blocks per worker are in flight at a time, and with n (the passwords still
+    wanted) only as many as are expected to cover the rest of n at the share of candidates kept so far; the pool is
+    terminated when the stream is closed.
+    """
+    logger.debug('Generating with %s workers (seed entropy=%s)' % (workers, seed_seq.entropy))
+    with Pool(workers, initializer=_init_worker,
+              initargs=(sampler, length, batch_size, seed_seq, known, validator, first_batch)) as pool:
+        in_flight = deque()
+        block = 0
+        drawn = 0
+        kept = 0
+        pending = 0
+        while True:
+            # Until a block is back, assume every candidate is kept (one block for a small n)
+            keep_rate = float(max(kept, 1)) / drawn if drawn else 1.0
+            while len(in_flight) < workers * BLOCKS_PER_WORKER and not (
+                    n is not None and in_flight and pending * keep_rate >= n - kept):
+                in_flight.append(pool.apply_async(_generate_block, (block,)))
+                pending += block_size(block, batch_size, first_batch)
+                block += 1
+            candidates, excluded, batch = in_flight.popleft().get()
+            pending -= candidates
+            drawn += candidates
+            kept += len(batch)
+            if validator is not None:
+                # Classified in the workers, whose metrics are not reported
+                metrics.inc('verifier.classified', candidates - excluded)
+            yield candidates, excluded, batch
@@ -0,0 +1,155 @@
+
+import os
+import mmap
+import logging
+import hashlib
+import numpy as np
+
+from array import array
+
+from engine.reader import iter_lines
+
+
+logger = logging.getLogger(__name__)
+
+
+def ngram_hash(ngram):
+    return int.from_bytes(hashlib.blake2b(ngram.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class NGramIndex(object):
+    """
+    Persistent, memory-mapped hash index over a counted n-gram file ("ngram<TAB>count" per line).
+
+    The index is a directory next to the source file holding four arrays: the sorted 64-bit hashes of the n-grams,
+    their counts, and the offset/length of every n-gram in a raw key file (used to verify hash matches). Lookups are
+    a vectorized binary search over the hashes, so a batch of n-grams costs one np.searchsorted call.
+    Lines without a count are counted once; repeated n-grams are summed.
+    """
+
+    index_ext = 'index'
+
+    source_path = None
+    index_path = None
+
+    hashes = None
+    counts = None
+    key_starts = None
+    key_lengths = None
+    keys = None
+
+    def __init__(self, source_path, index_path=None):
+        self.source_path = source_path
+        self.index_path = index_path if index_path else '%s.%s' % (source_path, self.index_ext)
+
+    @classmethod
+    def open(cls, source_path, index_path=None, rebuild=False):
+        """
+        Load the index for source_path, (re)building it first if it is missing or older than the source file.
+        """
+        index = cls(source_path, index_path=index_path)
+        if rebuild or index.is_stale():
+            index.build()
+        index.load()
+        return index
+
+    def _array_path(self, name):
+        return os.path.join(self.index_path, '%s.npy' % name)
+
+    def is_stale(self):
+        keys_path = os.path.join(self.index_path, 'keys')
+        if not os.path.isfile(keys_path) or not os.path.isfile(self._array_path('hashes')):
+            return True
+        return os.path.getmtime(self.source_path) > os.path.getmtime(self._array_path('hashes'))
+
+    def build(self):
+        logger.debug('Building n-gram index for %s...' % self.source_path)
+        os.makedirs(self.index_path, exist_ok=True)
+
+        hashes = array('Q')
+        counts = array('q')
+        key_starts = array('Q')
+        key_lengths = array('I')
+
+        offset = 0
+        with open(os.path.join(self.index_path, 'keys'), 'wb') as keys:
+            for line in iter_lines(self.source_path):
+                ng, sep, ng_count = line.rpartition('\t')
+                if not sep:
+                    ng, ng_count = line, 1
+
+                key = ng.encode('utf-8')
+                keys.write(key)
+                hashes.append(ngram_hash(ng))
+                counts.append(int(ng_count))
+                key_starts.append(offset)
+                key_lengths.append(len(key))
+                offset += len(key)
+
+        hashes = np.frombuffer(hashes, dtype=np.uint64)
+        order = np.argsort(hashes, kind='stable')
+        np.save(self._array_path('counts'), np.frombuffer(counts, dtype=np.int64)[order])
+        np.save(self._array_path('key_starts'), np.frombuffer(key_starts, dtype=np.uint64)[order])
+        np.save(self._array_path('key_lengths'), np.frombuffer(key_lengths, dtype=np.uint32)[order])
+        # Written last: its mtime marks the index as complete (see is_stale)
+        np.save(self._array_path('hashes'), hashes[order])
+        logger.debug('Indexed %s n-grams to %s' % (len(order), self.index_path))
+
+    def load(self):
+        self.hashes = np.load(self._array_path('hashes'), mmap_mode='r')
+        self.counts = np.load(self._array_path('counts'), mmap_mode='r')
+        self.key_starts = np.load(self._array_path('key_starts'), mmap_mode='r')
+        self.key_lengths = np.load(self._array_path('key_lengths'), mmap_mode='r')
+
+        keys_path = os.path.join(self.index_path, 'keys')
+        if os.path.getsize(keys_path) > 0:
+            with open(keys_path, 'rb') as f:
+                self.keys = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.keys = b''
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _key(self, i):
+        start = int(self.key_starts[i])
+        return self.keys[start:start + int(self.key_lengths[i])].decode('utf-8')
+
+    def lookup(self, ngrams):
+        """
+        :return: numpy array with the count of every n-gram in ngrams (0 when absent)
+        """
+        results = np.zeros(len(ngrams), dtype=np.int64)
+        if not ngrams or len(self.hashes) == 0:
+            return results
+
+        query = np.fromiter((ngram_hash(ng) for ng in ngrams), dtype=np.uint64, count=len(ngrams))
+        positions = np.searchsorted(self.hashes, query, side='left')
+        candidates = np.nonzero(self.hashes[np.minimum(positions, len(self.hashes) - 1)] == query)[0]
+
+        # Verify hash matches against the stored keys
+        hit_positions = positions[candidates]
+        starts = self.key_starts[hit_positions].tolist()
+        lengths = self.key_lengths[hit_positions].tolist()
+        hit_counts = self.counts[hit_positions].tolist()
+        keys = self.keys
+        for i, start, length, ng_count in zip(candidates.tolist(), starts, lengths, hit_counts):
+            if keys[start:start + length] == ngrams[i].encode('utf-8'):
+                results[i] = ng_count
+
+        # Equal hashes sit next to each other: repeated n-grams (or true collisions) need a scan of the run
+        last = len(self.hashes) - 1
+        repeated = candidates[self.hashes[np.minimum(hit_positions + 1, last)] == query[candidates]]
+        for i in repeated.tolist():
+            pos = int(positions[i])
+            total = 0
+            while pos <= last and self.hashes[pos] == query[i]:
+                if self._key(pos) == ngrams[i]:
+                    total += int(self.counts[pos])
+                pos += 1
+            results[i] = total
+        return results
+
+    def get(self, ngram, default=0):
+        count = int(self.lookup([ngram])[0])
+        return count if count else default
@@ -0,0 +1,212 @@
+
+import os
+import sys
+import json
+import time
+
+from contextlib import contextmanager
+
+from engine.utils import peak_rss_mb, format_mb
+
+"""
+    Lightweight progress metrics.
+
+    Stages record counters (e.g. 'counter.lines', 'db.rows_written') and timers (e.g. 'db.write') on the module-level
+    `metrics` registry, once per chunk rather than once per item. Nothing is recorded until the registry is enabled with
+    one or more sinks, so a disabled registry costs one attribute check per chunk:
+
+        from engine.metrics import metrics, StderrSink, JSONLinesSink
+        metrics.enable([StderrSink(), JSONLinesSink('run.jsonl')])
+        ...
+        metrics.close()
+
+    Snapshots (counters, per-second rates, timer totals, peak RSS) are pushed to the sinks at most every `interval`
+    seconds and once more on close.
+"""
+
+
+class StderrSink(object):
+    """
+    Progress line on stderr, rewritten in place on a terminal and appended as a new line otherwise.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream else sys.stderr
+        self.rewrite = self.stream.isatty()
+        self.width = 0
+
+    def write(self, snapshot, final=False):
+        parts = ['%.0fs' % snapshot['elapsed']]
+        for name, value in sorted(snapshot['counters'].items()):
+            rate = snapshot['rates'].get(name)
+            parts.append('%s=%s (%s/s)' % (name, _human(value), _human(rate)) if rate else '%s=%s' % (name, _human(value)))
+        parts.append('rss=%s' % format_mb(snapshot['peak_rss_mb']))
+
+        line = ' | '.join(parts)
+        if self.rewrite:
+            self.stream.write('\r' + line.ljust(self.width) + ('\n' if final else ''))
+            self.width = 0 if final else len(line)
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class JSONLinesSink(object):
+    """
+    Append every snapshot as one JSON object per line.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = open(filepath, 'a', encoding='utf-8')
+
+    def write(self, snapshot, final=False):
+        record = dict(snapshot)
+        record['final'] = final
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PrometheusSink(object):
+    """
+    Prometheus text exposition file (e.g. for node_exporter's textfile collector), atomically replaced on every write.
+    """
+
+    prefix = 'pwanalysis'
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def _name(self, name):
+        return '%s_%s' % (self.prefix, ''.join(ch if ch.isalnum() else '_' for ch in name))
+
+    def write(self, snapshot, final=False):
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = self._name(name) + '_total'
+            lines.extend(['# TYPE %s counter' % metric, '%s %s' % (metric, value)])
+        for name, seconds in sorted(snapshot['timers'].items()):
+            metric = self._name(name) + '_seconds_total'
+            lines.extend(['# TYPE %s counter' % metric, '%s %s' % (metric, seconds)])
+        for name, value in (('elapsed_seconds', snapshot['elapsed']), ('peak_rss_megabytes', snapshot['peak_rss_mb'])):
+            if value is None:
+                continue
+            metric = self._name(name)
+            lines.extend(['# TYPE %s gauge' % metric, '%s %s' % (metric, value)])
+
+        tmp_path = self.filepath + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.filepath)
+
+    def close(self):
+        pass
+
+
+def _human(value):
+    if value is None:
+        return '-'
+    for unit, scale in (('G', 1e9), ('M', 1e6), ('k', 1e3)):
+        if abs(value) >= scale:
+            return '%.1f%s' % (value / scale, unit)
+    return '%.0f' % value if isinstance(value, float) else str(value)
+
+
+def make_sink(spec):
+    """
+    Build a sink from a command line spec: 'stderr', 'jsonl:<file>' or 'prom:<file>'.
+    """
+    kind, _, target = spec.partition(':')
+    if kind == 'stderr':
+        return StderrSink()
+    if kind == 'jsonl' and target:
+        return JSONLinesSink(target)
+    if kind == 'prom' and target:
+        return PrometheusSink(target)
+    raise AttributeError('Unknown metrics sink: %s (expected stderr, jsonl:<file> or prom:<file>)' % spec)
+
+
+class Metrics(object):
+
+    enabled = False
+    interval = 1.0
+
+    def __init__(self):
+        self.sinks = []
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timers = {}
+        self.start = time.time()
+        self.last_report = 0.0
+
+    def enable(self, sinks, interval=1.0):
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.enabled = bool(self.sinks)
+        self.reset()
+
+    def inc(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        if self.enabled:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def snapshot(self):
+        elapsed = time.time() - self.start
+        return {
+            'timestamp': time.time(),
+            'elapsed': elapsed,
+            'counters': dict(self.counters),
+            'rates': dict((name, value / elapsed) for name, value in self.counters.items() if elapsed > 0),
+            'timers': dict(self.timers),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    def report(self, force=False):
+        """
+        Push a snapshot to the sinks if the reporting interval has passed (or force is set).
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.write(snapshot)
+
+    def close(self):
+        if not self.enabled:
+            return
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.write(snapshot, final=True)
+            sink.close()
+        self.enabled = False
+        self.sinks = []
+
+
+# Process-wide registry used by all stages
+metrics = Metrics()
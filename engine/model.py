@@ -0,0 +1,303 @@
+
+import json
+import logging
+import struct
+import numpy as np
+
+from scipy import sparse
+
+from engine.utils import load_obj
+
+logger = logging.getLogger(__name__)
+
+MODEL_MAGIC = b'PWMODEL\x00'
+MODEL_VERSION = 1
+
+# Arrays are aligned so that they can be memory-mapped directly
+ALIGNMENT = 64
+
+# Alphabets larger than this are stored as a CSR matrix instead of a dense one
+SPARSE_ALPHABET_SIZE = 256
+
+
+def _padding(offset):
+    return (ALIGNMENT - offset % ALIGNMENT) % ALIGNMENT
+
+
+def write_arrays(filepath, arrays, meta=None):
+    """
+    Write named numpy arrays to a single binary file:
+        magic | header length (uint32) | JSON header | aligned raw array data
+    The header records the format version, free-form metadata and the dtype/shape/offset of every array.
+    """
+    arrays = dict((name, np.ascontiguousarray(arr)) for name, arr in arrays.items())
+
+    layout = {}
+    offset = 0
+    for name, arr in arrays.items():
+        layout[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset += arr.nbytes + _padding(arr.nbytes)
+
+    header = json.dumps({'version': MODEL_VERSION, 'meta': meta or {}, 'arrays': layout}).encode('utf-8')
+    data_start = len(MODEL_MAGIC) + 4 + len(header)
+    header += b' ' * _padding(data_start)
+
+    with open(filepath, 'wb') as f:
+        f.write(MODEL_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for name, arr in arrays.items():
+            # Written from the array's buffer: no in-memory copy of large arrays
+            f.write(arr.data)
+            f.write(b'\x00' * _padding(arr.nbytes))
+
+
+def read_arrays(filepath, mmap=True):
+    """
+    Read a file written by write_arrays. Arrays are read-only memory maps unless mmap=False.
+    :return: (meta, {name: array})
+    """
+    with open(filepath, 'rb') as f:
+        if f.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+            raise ValueError('%s is not a binary model file.' % filepath)
+        header_len = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_len).decode('utf-8'))
+
+    if header.get('version', 0) > MODEL_VERSION:
+        raise ValueError('Unsupported model format version %s (max %s).' % (header['version'], MODEL_VERSION))
+
+    data_start = len(MODEL_MAGIC) + 4 + header_len
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        shape = tuple(info['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(filepath, dtype=dtype, mode='r', offset=data_start + info['offset'], shape=shape)
+        else:
+            with open(filepath, 'rb') as f:
+                f.seek(data_start + info['offset'])
+                arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return header['meta'], arrays
+
+
+def is_binary_model(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(len(MODEL_MAGIC)) == MODEL_MAGIC
+
+
+def model_type(filepath):
+    """
+    :return: the 'type' recorded in a binary model's header ('markov', 'ngram'); legacy pickled models are 'markov'
+    """
+    if not is_binary_model(filepath):
+        return 'markov'
+    with open(filepath, 'rb') as f:
+        f.seek(len(MODEL_MAGIC))
+        header_len = struct.unpack('<I', f.read(4))[0]
+        return json.loads(f.read(header_len).decode('utf-8'))['meta'].get('type', 'markov')
+
+
+class MarkovModel(object):
+    """
+    First-order markov model over an indexed alphabet.
+
+    alphabet:           list of single characters
+    first:              first-character frequencies (one per alphabet entry)
+    transitions:        row-normalized transition probabilities, dense ndarray or scipy.sparse CSR matrix
+    transition_counts:  raw transition counts (same layout as transitions), kept so the model can be merged with
+                        counts from new data (see merge); None for models converted from probabilities only
+    """
+
+    alphabet = None
+    first = None
+    transitions = None
+    transition_counts = None
+
+    def __init__(self, alphabet, first, transitions, transition_counts=None):
+        self.alphabet = list(alphabet)
+        self.first = first
+        self.transitions = transitions
+        self.transition_counts = transition_counts
+        self.char_index = dict((ch, i) for i, ch in enumerate(self.alphabet))
+
+    @property
+    def is_sparse(self):
+        return sparse.issparse(self.transitions)
+
+    @property
+    def has_counts(self):
+        return self.transition_counts is not None
+
+    @staticmethod
+    def _alphabet_of(char_freqs, mm):
+        chars = set(char_freqs.keys()) | set(mm.keys())
+        for ch_matrix in mm.values():
+            chars.update(ch_matrix.keys())
+        return sorted(chars)
+
+    @staticmethod
+    def _matrix(mm, char_index, use_sparse):
+        rows, cols, values = [], [], []
+        for ch1, ch1_matrix in mm.items():
+            for ch2, value in ch1_matrix.items():
+                rows.append(char_index[ch1])
+                cols.append(char_index[ch2])
+                values.append(value)
+
+        size = len(char_index)
+        matrix = sparse.csr_matrix((values, (rows, cols)), shape=(size, size), dtype=np.float64)
+        if use_sparse is None:
+            use_sparse = size > SPARSE_ALPHABET_SIZE
+        return matrix if use_sparse else matrix.toarray()
+
+    @staticmethod
+    def _normalize(counts):
+        """
+        Row-normalize a count matrix (dense or CSR) into transition probabilities.
+        """
+        if sparse.issparse(counts):
+            totals = np.asarray(counts.sum(axis=1)).ravel()
+            totals[totals == 0] = 1.0
+            return sparse.csr_matrix(sparse.diags(1.0 / totals) @ counts)
+        totals = counts.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1.0
+        return counts / totals
+
+    @classmethod
+    def from_dicts(cls, char_freqs, p_mm, use_sparse=None):
+        """
+        Build a model from the legacy (char_freqs, p_mm) dicts.
+        """
+        alphabet = cls._alphabet_of(char_freqs, p_mm)
+        char_index = dict((ch, i) for i, ch in enumerate(alphabet))
+
+        first = np.zeros(len(alphabet), dtype=np.float64)
+        for ch, count in char_freqs.items():
+            first[char_index[ch]] = count
+
+        return cls(alphabet, first, cls._matrix(p_mm, char_index, use_sparse))
+
+    @classmethod
+    def from_counts(cls, char_freqs, mm, use_sparse=None):
+        """
+        Build a model from first-character counts and raw transition counts ({ch1: {ch2: count}}); the counts are
+        kept alongside the probabilities.
+        """
+        alphabet = cls._alphabet_of(char_freqs, mm)
+        char_index = dict((ch, i) for i, ch in enumerate(alphabet))
+
+        first = np.zeros(len(alphabet), dtype=np.float64)
+        for ch, count in char_freqs.items():
+            first[char_index[ch]] = count
+
+        counts = cls._matrix(mm, char_index, use_sparse)
+        return cls(alphabet, first, cls._normalize(counts), transition_counts=counts)
+
+    def merge(self, other):
+        """
+        Combine the counts of two models, e.g. an existing model and one built from a new password dump. The result is
+        the model that counting both corpora together would have produced.
+        """
+        if not self.has_counts or not other.has_counts:
+            raise AttributeError('Only models that keep raw transition counts can be merged.')
+
+        alphabet = sorted(set(self.alphabet) | set(other.alphabet))
+        char_index = dict((ch, i) for i, ch in enumerate(alphabet))
+        size = len(alphabet)
+
+        first = np.zeros(size, dtype=np.float64)
+        counts = sparse.csr_matrix((size, size), dtype=np.float64)
+        for model in (self, other):
+            remap = np.array([char_index[ch] for ch in model.alphabet], dtype=np.int64)
+            first[remap] += model.first
+            model_counts = sparse.coo_matrix(model.transition_counts)
+            counts = counts + sparse.csr_matrix(
+                (model_counts.data, (remap[model_counts.row], remap[model_counts.col])), shape=(size, size))
+
+        counts = sparse.csr_matrix(counts)
+        if not (self.is_sparse or other.is_sparse or size > SPARSE_ALPHABET_SIZE):
+            counts = counts.toarray()
+        return MarkovModel(alphabet, first, self._normalize(counts), transition_counts=counts)
+
+    def to_dicts(self):
+        """
+        :return: the legacy (char_freqs, p_mm) dicts
+        """
+        char_freqs = dict((self.alphabet[i], float(count)) for i, count in enumerate(self.first) if count > 0)
+
+        p_mm = {}
+        transitions = sparse.csr_matrix(self.transitions)
+        for row in range(transitions.shape[0]):
+            start, end = transitions.indptr[row], transitions.indptr[row+1]
+            if start == end:
+                continue
+            p_mm[self.alphabet[row]] = dict(
+                (self.alphabet[col], float(prob))
+                for col, prob in zip(transitions.indices[start:end], transitions.data[start:end])
+            )
+        return char_freqs, p_mm
+
+    def to_csr(self):
+        return sparse.csr_matrix(self.transitions)
+
+    @staticmethod
+    def _matrix_arrays(name, matrix):
+        if sparse.issparse(matrix):
+            matrix = sparse.csr_matrix(matrix)
+            return {
+                '%s_data' % name: matrix.data.astype(np.float64),
+                '%s_indices' % name: matrix.indices.astype(np.int32),
+                '%s_indptr' % name: matrix.indptr.astype(np.int64),
+            }
+        return {name: np.asarray(matrix, dtype=np.float64)}
+
+    @staticmethod
+    def _load_matrix(name, arrays, size, is_sparse):
+        if is_sparse:
+            return sparse.csr_matrix(
+                (arrays['%s_data' % name], arrays['%s_indices' % name], arrays['%s_indptr' % name]),
+                shape=(size, size), copy=False
+            )
+        return arrays[name]
+
+    def save(self, filepath):
+        logger.debug('Saving markov model to %s' % filepath)
+        arrays = {
+            'alphabet': np.array([ord(ch) for ch in self.alphabet], dtype=np.uint32),
+            'first': np.asarray(self.first, dtype=np.float64),
+        }
+        arrays.update(self._matrix_arrays('trans', self.transitions) if self.is_sparse else
+                      {'transitions': np.asarray(self.transitions, dtype=np.float64)})
+        if self.has_counts:
+            arrays.update(self._matrix_arrays('counts', self.transition_counts))
+
+        write_arrays(filepath, arrays, meta={
+            'type': 'markov',
+            'order': 1,
+            'sparse': self.is_sparse,
+            'counts': self.has_counts,
+        })
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        """
+        Load a binary model (memory-mapped by default) or a legacy pickled (char_freqs, p_mm) model.
+        """
+        if not is_binary_model(filepath):
+            logger.debug('Loading legacy pickled markov model: %s' % filepath)
+            char_freqs, p_mm = load_obj(filepath)
+            return cls.from_dicts(char_freqs, p_mm)
+
+        logger.debug('Loading markov model: %s' % filepath)
+        meta, arrays = read_arrays(filepath, mmap=mmap)
+        alphabet = [chr(code) for code in arrays['alphabet'].tolist()]
+        size = len(alphabet)
+
+        transitions = cls._load_matrix('trans', arrays, size, True) if meta.get('sparse') else arrays['transitions']
+        counts = None
+        if meta.get('counts'):
+            counts = cls._load_matrix('counts', arrays, size, meta.get('sparse'))
+
+        return cls(alphabet, arrays['first'], transitions, transition_counts=counts)
@@ -0,0 +1,290 @@
+
+import logging
+import numpy as np
+
+from array import array
+
+from engine.model import write_arrays, read_arrays
+
+logger = logging.getLogger(__name__)
+
+MIN_ORDER = 2
+MAX_ORDER = 6
+
+# Contexts are packed into one int64 as base-CONTEXT_BASE digits (character index + 1, most recent character in the
+# lowest digit), so a context of up to MAX_ORDER-1 characters needs (MAX_ORDER-1) * 12 = 60 bits.
+CONTEXT_BITS = 12
+CONTEXT_BASE = 1 << CONTEXT_BITS
+
+
+class NGramModel(object):
+    """
+    Order-k character model: the next character is drawn given the previous k-1 characters, backing off to shorter
+    contexts when a context was never seen.
+
+    Storage is a hashed context table in CSR layout rather than nested dicts:
+        contexts:       sorted int64 context codes (all context lengths 1..k-1 share one table)
+        indptr:         offsets of every context's transitions in next_chars/next_counts
+        next_chars:     int32 alphabet index of the next character
+        next_counts:    int64 number of times the (context + next character) n-gram was counted
+        first:          first-character frequencies
+    """
+
+    order = 2
+    alphabet = None
+    first = None
+    contexts = None
+    indptr = None
+    next_chars = None
+    next_counts = None
+
+    def __init__(self, order, alphabet, first, contexts, indptr, next_chars, next_counts):
+        self.order = order
+        self.alphabet = list(alphabet)
+        self.first = first
+        self.contexts = contexts
+        self.indptr = indptr
+        self.next_chars = next_chars
+        self.next_counts = next_counts
+
+    @classmethod
+    def from_ngram_counts(cls, ngram_counts, order=3):
+        """
+        Build the model from (ngram, count) pairs (in any order): every n-gram of length 2..order contributes one
+        (context = all but its last character) -> last character transition.
+        """
+        if order < MIN_ORDER or order > MAX_ORDER:
+            raise AttributeError('Model order must be between %s and %s.' % (MIN_ORDER, MAX_ORDER))
+
+        char_index = {}
+        alphabet = []
+        first_counts = {}
+        context_codes = array('q')
+        next_chars = array('i')
+        next_counts = array('q')
+
+        def index_of(ch):
+            i = char_index.get(ch)
+            if i is None:
+                i = len(alphabet)
+                if i + 1 >= CONTEXT_BASE:
+                    raise AttributeError('Alphabet too large for an order-%s model (max %s characters).' % (
+                        order, CONTEXT_BASE - 2))
+                char_index[ch] = i
+                alphabet.append(ch)
+            return i
+
+        for ng, ng_count in ngram_counts:
+            if len(ng) == 1:
+                first_counts[index_of(ng)] = int(ng_count)
+                continue
+            if len(ng) < 2 or len(ng) > order:
+                continue
+
+            code = 0
+            for ch in ng[:-1]:
+                code = code * CONTEXT_BASE + index_of(ch) + 1
+            context_codes.append(code)
+            next_chars.append(index_of(ng[-1]))
+            next_counts.append(int(ng_count))
+
+        first = np.zeros(len(alphabet), dtype=np.float64)
+        for i, count in first_counts.items():
+            first[i] = count
+
+        contexts = np.frombuffer(context_codes, dtype=np.int64)
+        chars = np.frombuffer(next_chars, dtype=np.int32)
+        counts = np.frombuffer(next_counts, dtype=np.int64)
+
+        # Renumber the alphabet in sorted order, so that the model does not depend on the order of ngram_counts
+        rank = np.empty(len(alphabet), dtype=np.int64)
+        rank[np.argsort(np.array(alphabet, dtype=np.str_), kind='stable')] = np.arange(len(alphabet))
+        digit_rank = np.append(0, rank + 1)
+        renumbered = np.zeros(len(contexts), dtype=np.int64)
+        for position in range(order - 1):
+            digits = (contexts >> (position * CONTEXT_BITS)) & (CONTEXT_BASE - 1)
+            renumbered |= digit_rank[digits] << (position * CONTEXT_BITS)
+        contexts = renumbered
+        chars = rank[chars].astype(np.int32)
+        first[rank] = first.copy()
+        alphabet = sorted(alphabet)
+
+        # Group transitions by context (and sum any repeated n-grams)
+        order_idx = np.lexsort((chars, contexts))
+        contexts, chars, counts = contexts[order_idx], chars[order_idx], counts[order_idx]
+        if len(contexts):
+            new_pair = np.ones(len(contexts), dtype=bool)
+            new_pair[1:] = (contexts[1:] != contexts[:-1]) | (chars[1:] != chars[:-1])
+            starts = np.nonzero(new_pair)[0]
+            counts = np.add.reduceat(counts, starts)
+            contexts, chars = contexts[starts], chars[starts]
+
+        unique_contexts, context_starts = np.unique(contexts, return_index=True)
+        indptr = np.append(context_starts, len(contexts)).astype(np.int64)
+
+        logger.debug('Built order-%s model (alphabet-size=%s, contexts=%s, transitions=%s)' % (
+            order, len(alphabet), len(unique_contexts), len(chars)))
+        return cls(order, alphabet, first, unique_contexts, indptr, chars, counts)
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in (self.first, self.contexts, self.indptr, self.next_chars, self.next_counts))
+
+    def save(self, filepath):
+        logger.debug('Saving order-%s model to %s' % (self.order, filepath))
+        arrays = {
+            'alphabet': np.array([ord(ch) for ch in self.alphabet], dtype=np.uint32),
+            'first': np.asarray(self.first, dtype=np.float64),
+            'contexts': np.asarray(self.contexts, dtype=np.int64),
+            'indptr': np.asarray(self.indptr, dtype=np.int64),
+            'next_chars': np.asarray(self.next_chars, dtype=np.int32),
+            'next_counts': np.asarray(self.next_counts, dtype=np.int64),
+        }
+        write_arrays(filepath, arrays, meta={'type': 'ngram', 'order': self.order})
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        meta, arrays = read_arrays(filepath, mmap=mmap)
+        if meta.get('type') != 'ngram':
+            raise ValueError('%s is not an order-k n-gram model.' % filepath)
+        alphabet = [chr(code) for code in arrays['alphabet'].tolist()]
+        return cls(meta['order'], alphabet, arrays['first'], arrays['contexts'], arrays['indptr'],
+                   arrays['next_chars'], arrays['next_counts'])
+
+
+class NGramSampler(object):
+    """
+    Vectorized batch sampler for NGramModel (see MarkovSampler). Every character position costs at most order-1
+    vectorized context lookups for the whole batch, so generation stays O(length) per password.
+    """
+
+    model = None
+    prune = False
+    threshold = 0.1
+    mutation_rate = 0.1
+
+    def __init__(self, model, prune=False, threshold=0.1, mutation_rate=0.1, rng=None, seed=None):
+        if mutation_rate < 0.0 or mutation_rate > 1.0:
+            raise AttributeError("Mutation rate must be between 0.0 and 1.0.")
+
+        self.model = model
+        self.alphabet = model.alphabet
+        self.prune = prune
+        self.threshold = threshold
+        self.mutation_rate = mutation_rate
+        self.rng = rng if rng is not None else np.random.default_rng(seed)
+        self._compile()
+
+    def _compile(self):
+        model = self.model
+        if len(self.alphabet) == 0:
+            raise AttributeError("N-gram model is empty.")
+
+        first = np.array(model.first, dtype=np.float64)
+        if first.sum() <= 0:
+            raise AttributeError("N-gram model has no first-character frequencies.")
+        first_cdf = np.cumsum(first)
+        self.first_cdf = first_cdf / first_cdf[-1]
+
+        contexts = np.asarray(model.contexts)
+        indptr = np.asarray(model.indptr)
+        chars = np.asarray(model.next_chars)
+        weights = np.asarray(model.next_counts, dtype=np.float64)
+        row_of_entry = np.repeat(np.arange(len(contexts)), np.diff(indptr))
+
+        if self.prune:
+            # Drop transitions below the threshold (relative to their context's total); contexts left without any
+            # transition are removed so that sampling backs off to a shorter context.
+            totals = np.add.reduceat(weights, indptr[:-1]) if len(weights) else np.zeros(0)
+            keep = weights / totals[row_of_entry] >= self.threshold
+            chars, weights, row_of_entry = chars[keep], weights[keep], row_of_entry[keep]
+            kept_rows, counts = np.unique(row_of_entry, return_counts=True)
+            contexts = contexts[kept_rows]
+            indptr = np.append(0, np.cumsum(counts)).astype(np.int64)
+            row_of_entry = np.repeat(np.arange(len(contexts)), counts)
+
+        self.contexts = contexts
+        self.indptr = indptr
+        self.chars = chars
+        self.trans_cdf = self._flat_cdf(weights, row_of_entry)
+        self.uniform_cdf = self._flat_cdf(np.ones_like(weights), row_of_entry)
+
+    def _flat_cdf(self, data, row_of_entry):
+        if len(data) == 0:
+            return np.zeros(0)
+        cum = np.cumsum(data)
+        row_start = self.indptr[:-1]
+        before_row = np.where(row_start > 0, cum[np.maximum(row_start - 1, 0)], 0.0)
+        row_total = np.add.reduceat(data, row_start)
+        within = cum - before_row[row_of_entry]
+        return within / row_total[row_of_entry] + row_of_entry
+
+    def _draw(self, flat_cdf, rows, uniform):
+        entry = np.searchsorted(flat_cdf, rows + uniform, side='right')
+        entry = np.clip(entry, self.indptr[rows], self.indptr[rows + 1] - 1)
+        return self.chars[entry]
+
+    def _find_rows(self, history, pos):
+        """
+        Index of the longest known context for every password (-1 if none), given the packed history codes.
+        """
+        n = history.shape[1]
+        rows = np.full(n, -1, dtype=np.int64)
+        if len(self.contexts) == 0:
+            return rows
+
+        for length in range(min(self.model.order - 1, pos), 0, -1):
+            unresolved = np.nonzero(rows < 0)[0]
+            if len(unresolved) == 0:
+                break
+            codes = history[length, unresolved]
+            idx = np.minimum(np.searchsorted(self.contexts, codes), len(self.contexts) - 1)
+            found = self.contexts[idx] == codes
+            rows[unresolved[found]] = idx[found]
+        return rows
+
+    def generate_codes(self, n, length):
+        codes = np.empty((n, length), dtype=np.intp)
+        if n == 0 or length == 0:
+            return codes
+
+        max_context = self.model.order - 1
+        # history[m] = packed code of the last m characters of every password
+        history = np.zeros((max_context + 1, n), dtype=np.int64)
+
+        for pos in range(length):
+            rows = self._find_rows(history, pos) if pos > 0 else np.full(n, -1, dtype=np.int64)
+            known = rows >= 0
+
+            selection = np.empty(n, dtype=np.intp)
+            # No known context (start of the password or a dead end): restart from the first-character distribution
+            restart = ~known
+            if restart.any():
+                selection[restart] = np.minimum(
+                    np.searchsorted(self.first_cdf, self.rng.random(int(restart.sum())), side='right'),
+                    len(self.alphabet) - 1)
+
+            if known.any():
+                known_rows = rows[known]
+                drawn = self._draw(self.trans_cdf, known_rows, self.rng.random(len(known_rows)))
+                if self.mutation_rate > 0:
+                    mutate = self.rng.random(len(known_rows)) < self.mutation_rate
+                    if mutate.any():
+                        drawn[mutate] = self._draw(self.uniform_cdf, known_rows[mutate],
+                                                   self.rng.random(int(mutate.sum())))
+                selection[known] = drawn
+
+            codes[:, pos] = selection
+            for m in range(max_context, 0, -1):
+                history[m] = history[m - 1] * CONTEXT_BASE + selection + 1
+
+        return codes
+
+    def decode(self, codes):
+        if codes.shape[1] == 0:
+            return [''] * codes.shape[0]
+        chars = np.array(self.alphabet, dtype='U1')[codes]
+        return np.ascontiguousarray(chars).view('U%s' % codes.shape[1]).ravel().tolist()
+
+    def generate_batch(self, n, length):
+        return self.decode(self.generate_codes(n, length))
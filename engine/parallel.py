@@ -0,0 +1,153 @@
+
+import os
+import heapq
+import logging
+import shutil
+import tempfile
+import zlib
+
+from collections import Counter
+from multiprocessing import Pool
+
+import settings
+from engine.base import NGramCounter
+from engine.metrics import metrics
+from engine.utils import iter_ngrams, write_counts, count_sort_key
+from engine.reader import iter_line_chunks, read_counts, is_compressed
+
+logger = logging.getLogger(__name__)
+
+
+def find_shards(filepath, num_shards):
+    """
+    Split a file into num_shards byte ranges that start and end on line boundaries. Compressed files cannot be
+    split and form a single shard.
+    :return: list of (start, end) byte offsets
+    """
+    file_size = os.path.getsize(filepath)
+    if is_compressed(filepath):
+        return [(0, file_size)]
+    boundaries = [0]
+    with open(filepath, 'rb') as f:
+        for i in range(1, num_shards):
+            f.seek(max(int(file_size * i / num_shards), boundaries[-1]))
+            f.readline()
+            boundaries.append(min(f.tell(), file_size))
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def partition_of(ngram, num_partitions):
+    # Stable across processes, unlike hash() under hash randomization
+    return zlib.crc32(ngram.encode('utf-8')) % num_partitions
+
+
+def _count_shard(task):
+    """
+    Worker: generate and count the n-grams of one byte range of the wordlist, then write the partial table split
+    into hash partitions.
+    """
+    filepath, start, end, shard_id, num_partitions, tmp_dir, chunk_size, min_size, max_size = task
+
+    counts = Counter()
+    for words in iter_line_chunks(filepath, chunk_size, strip='\r\t', start=start, end=end):
+        counts.update(iter_ngrams(words, min_size=min_size, max_size=max_size))
+
+    partitions = [{} for _ in range(num_partitions)]
+    for ng, ng_count in counts.items():
+        partitions[partition_of(ng, num_partitions)][ng] = ng_count
+    counts = None
+
+    paths = []
+    for part_id, part in enumerate(partitions):
+        path = os.path.join(tmp_dir, 'shard_%s_part_%s.%s' % (shard_id, part_id, settings.EXT_NG_COUNTS))
+        write_counts(part, path)
+        paths.append(path)
+    return paths
+
+
+def _merge_partition(task):
+    """
+    Worker: sum one hash partition across all shards and write it sorted by descending count.
+    """
+    part_id, paths, tmp_dir = task
+
+    counts = Counter()
+    for path in paths:
+        for ng, ng_count in read_counts(path):
+            counts[ng] += ng_count
+        os.remove(path)
+
+    merged_path = os.path.join(tmp_dir, 'merged_part_%s.%s' % (part_id, settings.EXT_NG_COUNTS))
+    write_counts(counts, merged_path, sort=True)
+    return merged_path
+
+
+class ShardedNGramCounter(NGramCounter):
+    """
+    Multi-process variant of NGramCounter.count_wordlist.
+
+    The wordlist is cut into byte-range shards that are generated and counted by separate worker processes. The
+    partial tables are split by a hash of the n-gram and every partition is merged by its own worker, so no single
+    process holds the full table. The sorted partitions are finally streamed together with a k-way merge.
+    """
+
+    workers = 1
+    tmp_dir = None
+
+    def __init__(self, filepath, workers=None, chunk_size=500000, tmp_dir=None):
+        super(ShardedNGramCounter, self).__init__(filepath, chunk_size=chunk_size, use_db=False)
+        self.workers = workers if workers else os.cpu_count()
+        self.tmp_dir = tmp_dir
+
+    def count_wordlist(self, min_size=1, max_size=None):
+        """
+        :return: list of partition files, each sorted by descending count (see get_next_top_ngrams)
+        """
+        work_dir = tempfile.mkdtemp(prefix='ngshards_', dir=self.tmp_dir)
+        shards = find_shards(self.filepath, self.workers)
+        logger.debug('Counting %s shards with %s workers (tmp=%s)...' % (len(shards), self.workers, work_dir))
+
+        tasks = [
+            (self.filepath, start, end, shard_id, self.workers, work_dir, self.chunk_size, min_size, max_size)
+            for shard_id, (start, end) in enumerate(shards)
+        ]
+
+        with Pool(self.workers) as pool:
+            shard_paths = []
+            with metrics.timer('counter.count_shards'):
+                for (_, start, end, _, _, _, _, _, _), paths in zip(tasks, pool.imap(_count_shard, tasks)):
+                    shard_paths.append(paths)
+                    metrics.inc('counter.shards')
+                    metrics.inc('counter.bytes_read', end - start)
+                    metrics.report()
+            logger.debug('Counted all shards. Merging %s partitions...' % self.workers)
+
+            merge_tasks = [
+                (part_id, [paths[part_id] for paths in shard_paths], work_dir) for part_id in range(self.workers)
+            ]
+            with metrics.timer('counter.merge_partitions'):
+                partitions = pool.map(_merge_partition, merge_tasks)
+
+        logger.debug('Done counting ngram frequencies.')
+        return partitions
+
+    def get_next_top_ngrams(self, partitions, n=100):
+        """
+        K-way merge of the sorted partition files; yields (ngram, count) chunks in descending count order and
+        removes the temporary files once exhausted.
+        """
+        try:
+            merged = heapq.merge(*[read_counts(path) for path in partitions], key=count_sort_key)
+            chunk = []
+            for item in merged:
+                chunk.append(item)
+                if len(chunk) >= n:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            work_dirs = set(os.path.dirname(path) for path in partitions)
+            for work_dir in work_dirs:
+                shutil.rmtree(work_dir, ignore_errors=True)
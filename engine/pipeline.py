@@ -0,0 +1,404 @@
+
+import os
+import copy
+import time
+import logging
+
+from collections import Counter
+from itertools import chain
+
+import settings
+from engine.base import NGramCounter, NGramGenerator
+from engine.parallel import ShardedNGramCounter
+from engine.external import ExternalNGramCounter
+from engine.approx import ApproxNGramCounter
+from engine.analytics import NGramAnalyzer
+from engine.model import MarkovModel, model_type
+from engine.sampling import MarkovSampler
+from engine.ngram_model import NGramModel, NGramSampler
+from engine.utils import iter_ngrams, ngram_total, count_sort_key
+from engine.metrics import metrics
+from engine.reader import iter_line_chunks
+from engine.bloom import BloomFilter
+from engine.checkpoint import Checkpoint, CHECKPOINT_INTERVAL
+from engine.generation import seed_sequence, first_batch_size, iter_seeded_candidates, parallel_blocks
+from engine.enumeration import MarkovEnumerator
+
+logger = logging.getLogger(__name__)
+
+"""
+    Composable in-process stages for the -A flow:
+
+        wordlist -> word chunks -> n-gram counts -> markov model -> sampler -> candidate batches -> validator
+
+    Every stage is a plain function or generator that takes the previous stage's output, so the whole chain runs
+    without touching disk unless an artifact is explicitly requested (write_ngram_counts, MarkovModel.save).
+"""
+
+
+def iter_words(filepath, chunk_size=500000):
+    """
+    Yield chunks (lists) of the non-empty words of a wordlist.
+    """
+    return iter_line_chunks(filepath, chunk_size, strip='\r\t', metric='counter.bytes_read')
+
+
+def count_ngrams(word_chunks, min_size=1, max_size=None):
+    """
+    :return: Counter of {ngram: count} over all words of all chunks
+    """
+    counts = Counter()
+    for words in word_chunks:
+        counts.update(iter_ngrams(words, min_size=min_size, max_size=max_size, logger=logger))
+        if metrics.enabled:
+            metrics.inc('counter.lines', len(words))
+            metrics.inc('counter.ngrams', ngram_total(words, min_size=min_size, max_size=max_size))
+            metrics.report()
+    return counts
+
+
+def write_ngram_counts(ngram_counts, filepath):
+    """
+    Pass-through stage: write (ngram, count) pairs to filepath as "ngram<TAB>count" while yielding them on.
+    """
+    logger.debug('Saving ngram counts to \'%s\'...' % filepath)
+    with open(filepath, 'w+', encoding='utf-8') as f:
+        for ng, ng_count in ngram_counts:
+            f.write('%s\t%s\n' % (ng, ng_count))
+            yield ng, ng_count
+
+
+def build_model(ngram_counts, order=None):
+    """
+    :param order: build an order-k NGramModel instead of the first-order MarkovModel
+    :return: model built from (ngram, count) pairs
+    """
+    if order:
+        return NGramModel.from_ngram_counts(ngram_counts, order=order)
+    char_freqs, mm = NGramAnalyzer(None).build_markov_counts(ngram_counts)
+    return MarkovModel.from_counts(char_freqs, mm)
+
+
+def iter_candidates(sampler, length, batch_size=100000):
+    """
+    Endless stream of candidate batches from a MarkovSampler or NGramSampler.
+    """
+    while True:
+        yield sampler.generate_batch(batch_size, length)
+
+
+def validate(batches, validator):
+    """
+    Keep only the passwords of every batch that the validator (PasswordVerifier) accepts.
+    """
+    for batch in batches:
+        yield validator.filter_passwords(batch)
+
+
+def exclude(batch, known=None, seen=None):
+    """
+    :return: the passwords of batch that are not in the Bloom filter known (e.g. over the training wordlist) and,
+        with a Bloom filter seen, were not generated before (they are added to it)
+    """
+    if seen is not None:
+        batch = list(dict.fromkeys(batch))
+    if known is not None and batch:
+        batch = [pw for pw, hit in zip(batch, known.contains(batch).tolist()) if not hit]
+    if seen is not None and batch:
+        batch = [pw for pw, hit in zip(batch, seen.contains(batch).tolist()) if not hit]
+        seen.add(batch)
+    return batch
+
+
+def take(batches, n):
+    """
+    Yield batches until n passwords have been produced; the last batch is truncated.
+    """
+    produced = 0
+    if n <= 0:
+        return
+    for batch in batches:
+        batch = batch[:n - produced]
+        produced += len(batch)
+        yield batch
+        if produced >= n:
+            break
+
+
+class Pipeline(object):
+    """
+    wordlist -> counts -> model -> passwords, in process.
+
+    Counting uses the same backends as the CLI (in-memory Counter, sharded workers, memory-budgeted external sort,
+    SQLite, or approximate top-K counting). Intermediate results stay in memory; n-gram counts and the model are only written when a path is
+    given.
+    """
+
+    wordlist = None
+    chunk_size = 500000
+    workers = None
+    memory_budget = None
+    use_db = False
+    two_stage = False
+    tmp_dir = None
+    order = None
+    approx_top_k = None
+    sketch_error = 1e-5
+    checkpoint_dir = None
+    checkpoint_interval = CHECKPOINT_INTERVAL
+
+    model = None
+    stats = None
+
+    def __init__(self, wordlist=None, chunk_size=500000, workers=None, memory_budget=None, use_db=False,
+                 two_stage=False, tmp_dir=None, order=None, approx_top_k=None, sketch_error=1e-5,
+                 checkpoint_dir=None, checkpoint_interval=CHECKPOINT_INTERVAL):
+        """
+        :param checkpoint_dir: save the progress of the counting stages and the model to this directory, and resume
+            from the checkpoints found there (see engine.checkpoint). Only the exact, single-process counting
+            backends can be resumed; without a memory budget the in-memory counter is replaced by the external one.
+        """
+        if checkpoint_dir and (approx_top_k or (workers and workers > 1)):
+            raise AttributeError('Approximate and multi-process counting cannot be resumed from checkpoints.')
+        self.wordlist = wordlist
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.memory_budget = memory_budget
+        self.use_db = use_db
+        self.two_stage = two_stage
+        self.tmp_dir = tmp_dir if tmp_dir else settings.RESULT_PATH
+        self.order = order
+        self.approx_top_k = approx_top_k
+        self.sketch_error = sketch_error
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.stats = {}
+
+    def _checkpoint(self, stage, source, **params):
+        if not self.checkpoint_dir:
+            return None
+        return Checkpoint(self.checkpoint_dir, stage, source, params=params, interval=self.checkpoint_interval)
+
+    def _generate_ngrams(self):
+        """
+        First stage of the two-stage flows: write the n-gram file of the wordlist.
+        """
+        ngg = NGramGenerator(self.wordlist, chunk_size=self.chunk_size,
+                             checkpoint=self._checkpoint('ngram_generator', self.wordlist))
+        ngg.run()
+        return ngg.destination_file
+
+    def count(self, sort=False, max_size=None):
+        """
+        Count the n-grams of the wordlist.
+        :param sort: yield pairs in descending count order (needed for .ngcounts files and top-N listings)
+        :param max_size: only count n-grams up to this length (the two-stage flows always count all of them)
+        :return: iterator of (ngram, count) pairs; only the approximate top approx_top_k if that is set
+        """
+        if self.approx_top_k:
+            counter = ApproxNGramCounter(self.wordlist, top_k=self.approx_top_k, epsilon=self.sketch_error)
+            return iter(counter.count_wordlist(max_size=max_size))
+
+        if self.use_db:
+            if self.two_stage:
+                ngram_file = self._generate_ngrams()
+                counter = NGramCounter(ngram_file, chunk_size=self.chunk_size,
+                                       checkpoint=self._checkpoint('count_ngrams_db', ngram_file))
+                counter.count_ngrams()
+            else:
+                counter = NGramCounter(self.wordlist, chunk_size=self.chunk_size,
+                                       checkpoint=self._checkpoint('count_wordlist_db', self.wordlist,
+                                                                   max_size=max_size))
+                counter.count_wordlist_db(max_size=max_size)
+            return chain.from_iterable(counter.get_next_top_db_ngrams(n=counter.chunk_size))
+
+        if self.two_stage or self.memory_budget or self.checkpoint_dir:
+            if self.two_stage:
+                ngram_file = self._generate_ngrams()
+                counter = ExternalNGramCounter(ngram_file, memory_budget=self.memory_budget or 1024,
+                                               chunk_size=self.chunk_size, tmp_dir=self.tmp_dir,
+                                               checkpoint=self._checkpoint('count_ngrams', ngram_file))
+                runs = counter.count_ngrams()
+            else:
+                counter = ExternalNGramCounter(self.wordlist, memory_budget=self.memory_budget or 1024,
+                                               chunk_size=self.chunk_size, tmp_dir=self.tmp_dir,
+                                               checkpoint=self._checkpoint('count_wordlist', self.wordlist,
+                                                                           max_size=max_size))
+                runs = counter.count_wordlist(max_size=max_size)
+            if sort:
+                return chain.from_iterable(counter.get_next_top_ngrams(runs, n=counter.chunk_size))
+            return counter.iter_counts(runs, cleanup=True)
+
+        if self.workers and self.workers > 1:
+            counter = ShardedNGramCounter(self.wordlist, workers=self.workers, chunk_size=self.chunk_size,
+                                          tmp_dir=self.tmp_dir)
+            partitions = counter.count_wordlist(max_size=max_size)
+            return chain.from_iterable(counter.get_next_top_ngrams(partitions, n=counter.chunk_size))
+
+        counts = count_ngrams(iter_words(self.wordlist, self.chunk_size), max_size=max_size)
+        logger.debug('Counted %s distinct ngrams.' % len(counts))
+        if sort:
+            return iter(sorted(counts.items(), key=count_sort_key))
+        return iter(counts.items())
+
+    def build_model(self, ngram_counts=None, save_ngrams=None, savefile=None):
+        """
+        Build the markov model (order-k NGramModel if self.order is set) from ngram_counts, or from the wordlist's
+        counts if not given. An order-k model only needs n-grams up to length k, so only those are counted.
+        :param save_ngrams: also write the (sorted) n-gram counts to this file
+        :param savefile: also save the model to this file
+        """
+        if ngram_counts is None:
+            ngram_counts = self.count(sort=bool(save_ngrams), max_size=self.order)
+        if save_ngrams:
+            ngram_counts = write_ngram_counts(ngram_counts, save_ngrams)
+
+        logger.debug('Generating Markov Matrix from n-grams...')
+        self.model = build_model(ngram_counts, order=self.order)
+        if savefile:
+            self.model.save(savefile)
+            checkpoint = self._checkpoint('model', self.wordlist, order=self.order)
+            if checkpoint:
+                checkpoint.save({'model': os.path.abspath(savefile)}, sync=[savefile])
+        return self.model
+
+    def resume_model(self):
+        """
+        Load the model saved by a checkpointed build_model over the same wordlist, if there is one.
+        :return: the model's path, or None
+        """
+        checkpoint = self._checkpoint('model', self.wordlist, order=self.order)
+        state = checkpoint.load() if checkpoint else None
+        if not state or not os.path.isfile(state['model']):
+            return None
+        self.load_model(state['model'])
+        return state['model']
+
+    def load_model(self, filepath):
+        if model_type(filepath) == 'ngram':
+            self.model = NGramModel.load(filepath)
+        else:
+            self.model = MarkovModel.load(filepath)
+        return self.model
+
+    def sampler(self, prune=False, threshold=0.1, mutation_rate=0.1, **kwargs):
+        if self.model is None:
+            self.build_model()
+        sampler_class = NGramSampler if isinstance(self.model, NGramModel) else MarkovSampler
+        return sampler_class(self.model, prune=prune, threshold=threshold, mutation_rate=mutation_rate, **kwargs)
+
+    def generate(self, n, length, validator=None, known=None, unique=False, error_rate=0.001, batch_size=100000,
+                 workers=None, seed=None, sampler=None, first_batch=None, **sampler_kwargs):
+        """
+        Yield batches of generated passwords until n have been produced; with a validator, only accepted passwords
+        are kept. Passwords in the Bloom filter known (see engine.bloom.wordlist_filter) are dropped before validation
+        and, with unique, passwords generated before are dropped too (via a Bloom filter at false positive rate
+        error_rate).
+        :param workers: draw, exclude and validate the candidates in this many processes (default: the pipeline's
+            workers); the passwords are the same for any number of workers (see engine.generation)
+        :param seed: seed (or numpy SeedSequence) of the run; the entropy of a random seed is kept in self.stats
+        :param sampler: compiled sampler to draw from instead of compiling one from the model (see engine.service);
+            its random state is not touched
+        :param first_batch: draw a first block of this many candidates and double the block size up to batch_size
+            while more passwords are needed. By default, with a validator or known, it is sized from n and the
+            validator's acceptance rate so far (from n alone with a seed, so that a seed always gives the same
+            passwords); the passwords depend on it as well as on the seed and batch_size
+        Candidate/exclusion/validation/emission counts are kept in self.stats.
+        """
+        # Every block sets the sampler's Generator (see engine.generation.draw_block): draw from a copy
+        sampler = copy.copy(sampler) if sampler is not None else self.sampler(**sampler_kwargs)
+        seed_seq = seed_sequence(seed)
+        workers = workers if workers is not None else self.workers
+        self.stats = self._new_stats(seed_seq.entropy)
+        start = time.time()
+
+        if validator is None and known is None:
+            # Dedup only drops a few candidates: a 10% margin, and more batches of that size if it drops more
+            batch_size = min(batch_size, max(n, 1) + (n // 10 if unique else 0))
+        elif first_batch is None:
+            # A few passwords should not cost a whole batch_size block of candidates to classify
+            rate = validator.acceptance_rate if validator is not None and seed is None else None
+            first_batch = first_batch_size(n, batch_size, rate)
+        if workers and workers > 1:
+            batches = self._parallel(parallel_blocks(sampler, length, batch_size, seed_seq, workers, known=known,
+                                                     validator=validator, n=n, first_batch=first_batch),
+                                     validator=validator)
+        else:
+            batches = self._counted(iter_seeded_candidates(sampler, length, batch_size, seed_seq,
+                                                           first_batch=first_batch), 'candidates')
+            if known is not None:
+                batches = self._excluded(batches, known=known)
+            if validator is not None:
+                batches = self._counted(validate(self._counted(batches, 'classified'), validator), 'validated')
+        if unique:
+            # After validation, so that only emitted passwords fill the filter
+            batches = self._excluded(batches, seen=BloomFilter(n, error_rate))
+
+        for batch in take(batches, n):
+            self.stats['accepted'] += len(batch)
+            self.stats['seconds'] = time.time() - start
+            metrics.inc('generate.accepted', len(batch))
+            metrics.report()
+            yield batch
+
+    def enumerate(self, n, length, validator=None, known=None, min_prob=None, batch_size=100000):
+        """
+        Yield batches of the n most likely passwords of the model (see engine.enumeration), in descending probability,
+        with the validator and the Bloom filter known applied as in generate. No password is enumerated twice, so no
+        dedup is needed; fewer than n are produced if the model (or min_prob) runs out.
+        """
+        if self.model is None:
+            self.build_model()
+        if validator is None and known is None:
+            batch_size = min(batch_size, max(n, 1))
+        enumerator = MarkovEnumerator(self.model, length, min_prob=min_prob, band_size=batch_size)
+        self.stats = self._new_stats()
+        start = time.time()
+
+        batches = self._counted(enumerator.generate_batches(batch_size), 'candidates')
+        if known is not None:
+            batches = self._excluded(batches, known=known)
+        if validator is not None:
+            batches = self._counted(validate(self._counted(batches, 'classified'), validator), 'validated')
+
+        for batch in take(batches, n):
+            self.stats['accepted'] += len(batch)
+            self.stats['seconds'] = time.time() - start
+            metrics.inc('generate.accepted', len(batch))
+            metrics.report()
+            yield batch
+
+    @staticmethod
+    def _new_stats(seed=None):
+        """
+        candidates drawn, excluded (known or generated before), classified and validated (accepted) by the validator,
+        and accepted: passwords emitted
+        """
+        return {'candidates': 0, 'excluded': 0, 'classified': 0, 'validated': 0, 'accepted': 0, 'seconds': 0.0,
+                'seed': seed}
+
+    def _parallel(self, blocks, validator=None):
+        for candidates, excluded, batch in blocks:
+            self.stats['candidates'] += candidates
+            self.stats['excluded'] += excluded
+            metrics.inc('generate.candidates', candidates)
+            metrics.inc('generate.excluded', excluded)
+            if validator is not None:
+                self.stats['classified'] += candidates - excluded
+                self.stats['validated'] += len(batch)
+                metrics.inc('generate.classified', candidates - excluded)
+                metrics.inc('generate.validated', len(batch))
+            yield batch
+
+    def _excluded(self, batches, known=None, seen=None):
+        for batch in batches:
+            kept = exclude(batch, known=known, seen=seen)
+            self.stats['excluded'] += len(batch) - len(kept)
+            metrics.inc('generate.excluded', len(batch) - len(kept))
+            yield kept
+
+    def _counted(self, batches, key):
+        for batch in batches:
+            self.stats[key] += len(batch)
+            metrics.inc('generate.%s' % key, len(batch))
+            yield batch
@@ -0,0 +1,164 @@
+
+import bz2
+import gzip
+import lzma
+
+from engine.metrics import metrics
+
+"""
+    Shared bulk line reader for wordlists, n-gram files and count files.
+
+    Files are read in large binary blocks, every block is cut at its last newline, decoded in one call and split into
+    lines in bulk, so the per-line Python work is limited to what the caller does with the lines. gzip, bz2 and xz
+    files are recognized by their magic bytes and decompressed on the fly.
+"""
+
+# Bytes per read; large blocks amortize the decode/split calls
+BLOCK_SIZE = 1 << 24
+
+# Smaller blocks for count files, which are read by up to MAX_FAN_IN merge iterators at once
+COUNTS_BLOCK_SIZE = 1 << 18
+
+COMPRESSED_MAGIC = (
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+)
+
+
+def compression_of(filepath):
+    """
+    :return: the open function of the file's compression format, or None for plain files
+    """
+    with open(filepath, 'rb') as f:
+        magic = f.read(6)
+    for prefix, opener in COMPRESSED_MAGIC:
+        if magic.startswith(prefix):
+            return opener
+    return None
+
+
+def is_compressed(filepath):
+    return compression_of(filepath) is not None
+
+
+def open_binary(filepath):
+    opener = compression_of(filepath)
+    return opener(filepath, 'rb') if opener else open(filepath, 'rb', buffering=0)
+
+
+def iter_blocks(filepath, start=0, end=None, block_size=BLOCK_SIZE, metric=None, offsets=False):
+    """
+    Yield decoded blocks of whole lines. start/end restrict a plain file to a byte range whose bounds are line
+    boundaries (see engine.parallel.find_shards). For compressed files start is an offset into the decompressed data
+    (as returned with offsets) and end is ignored.
+    :param offsets: yield (block, offset) pairs, offset being the position right after the block's last line
+    """
+    compressed = is_compressed(filepath)
+    with open_binary(filepath) as f:
+        remaining = None
+        if start:
+            # Decompressing file objects emulate the (forward) seek
+            f.seek(start)
+        if not compressed and end is not None:
+            remaining = end - start
+
+        position = start
+        tail = b''
+        while True:
+            size = block_size if remaining is None else min(block_size, remaining)
+            block = f.read(size) if size > 0 else b''
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            if metric:
+                metrics.inc(metric, len(block))
+
+            block = tail + block
+            cut = block.rfind(b'\n') + 1
+            if cut == 0:
+                tail = block
+                continue
+            tail = block[cut:]
+            position += cut
+            text = block[:cut].decode('utf-8', errors='replace')
+            yield (text, position) if offsets else text
+
+        if tail:
+            text = tail.decode('utf-8', errors='replace')
+            yield (text, position + len(tail)) if offsets else text
+
+
+def count_lines(filepath):
+    """
+    :return: number of lines of a (possibly compressed) file, counted on the raw blocks (an upper bound of the
+        non-empty lines)
+    """
+    lines = 0
+    last = b'\n'
+    with open_binary(filepath) as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return lines + (last != b'\n')
+
+
+def iter_line_chunks(filepath, chunk_size=500000, strip='\r', skip_empty=True, start=0, end=None,
+                     block_size=BLOCK_SIZE, metric=None, offsets=False):
+    """
+    Yield lists of at most chunk_size lines (no padding, newlines removed). Invalid UTF-8 is replaced rather than
+    raising. Every line is stripped of the characters in strip; empty lines are dropped unless skip_empty is False.
+    :param offsets: yield (lines, offset) pairs. Chunks then end at block boundaries, and offset is the position
+        right after the chunk for the last chunk of a block (a point to resume from with start=offset), else None.
+    """
+    chunk = []
+    for text, position in iter_blocks(filepath, start=start, end=end, block_size=block_size, metric=metric,
+                                      offsets=True):
+        lines = text.split('\n')
+        if text.endswith('\n'):
+            lines.pop()
+        # Per-line stripping only when a block actually contains one of the characters
+        if strip and any(ch in text for ch in strip):
+            lines = [line.strip(strip) for line in lines]
+        if skip_empty:
+            lines = list(filter(None, lines))
+
+        chunk.extend(lines)
+        while len(chunk) >= chunk_size:
+            yield (chunk[:chunk_size], None) if offsets else chunk[:chunk_size]
+            chunk = chunk[chunk_size:]
+        if offsets:
+            # Flushed (possibly empty) at every block boundary, so that every block end can be resumed from
+            yield chunk, position
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def iter_lines(filepath, **kwargs):
+    for chunk in iter_line_chunks(filepath, **kwargs):
+        for line in chunk:
+            yield line
+
+
+def read_lines(filepath, limit=None, **kwargs):
+    """
+    :return: list of the (first limit) lines of a file
+    """
+    lines = []
+    for chunk in iter_line_chunks(filepath, **kwargs):
+        lines.extend(chunk)
+        if limit and len(lines) >= limit:
+            return lines[:limit]
+    return lines
+
+
+def read_counts(filepath):
+    """
+    Yield (ngram, count) pairs from a "ngram<TAB>count" file.
+    """
+    for line in iter_lines(filepath, chunk_size=65536, block_size=COUNTS_BLOCK_SIZE):
+        ng, _, ng_count = line.rpartition('\t')
+        yield ng, int(ng_count)
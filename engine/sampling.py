@@ -0,0 +1,147 @@
+
+import logging
+import numpy as np
+
+from scipy import sparse
+
+from engine.model import MarkovModel
+
+logger = logging.getLogger(__name__)
+
+
+class MarkovSampler(object):
+    """
+    Compiled form of a markov model (see MarkovModel).
+
+    The transition matrix is flattened once into cumulative-probability arrays over a character index so that whole
+    batches of passwords can be drawn with a handful of numpy calls per character position instead of one
+    np.random.choice call per character. The arrays follow the CSR layout of the transition matrix, so memory
+    grows with the number of observed transitions rather than with the square of the alphabet.
+    """
+
+    alphabet = None
+    first_cdf = None
+    trans_cdf = None
+    uniform_cdf = None
+    indices = None
+    indptr = None
+
+    prune = False
+    threshold = 0.1
+    mutation_rate = 0.1
+
+    def __init__(self, model, prune=False, threshold=0.1, mutation_rate=0.1, rng=None, seed=None):
+        if mutation_rate < 0.0 or mutation_rate > 1.0:
+            raise AttributeError("Mutation rate must be between 0.0 and 1.0.")
+
+        self.prune = prune
+        self.threshold = threshold
+        self.mutation_rate = mutation_rate
+        self.rng = rng if rng is not None else np.random.default_rng(seed)
+
+        self.alphabet = model.alphabet
+        self._compile(model)
+
+    @classmethod
+    def from_dicts(cls, char_freqs, p_mm, **kwargs):
+        return cls(MarkovModel.from_dicts(char_freqs, p_mm), **kwargs)
+
+    @classmethod
+    def from_file(cls, filepath, **kwargs):
+        return cls(MarkovModel.load(filepath), **kwargs)
+
+    def _compile(self, model):
+        size = len(self.alphabet)
+        if size == 0:
+            raise AttributeError("Markov model is empty.")
+
+        first = np.array(model.first, dtype=np.float64)
+        if first.sum() <= 0:
+            raise AttributeError("Markov model has no first-character frequencies.")
+
+        trans = model.to_csr().astype(np.float64)
+
+        if self.prune:
+            # Same rule as NGramAnalyzer._get_next_char_from_mm: drop transitions below the threshold (relative to
+            # the row total) and renormalize what is left.
+            totals = np.asarray(trans.sum(axis=1)).ravel()
+            totals[totals == 0] = 1.0
+            row_of_entry = np.repeat(np.arange(size), np.diff(trans.indptr))
+            trans.data[trans.data / totals[row_of_entry] < self.threshold] = 0.0
+        trans.eliminate_zeros()
+
+        # Characters without any outgoing transitions restart from the first-character distribution so every
+        # generated password has the requested length.
+        dead_rows = np.diff(trans.indptr) == 0
+        if dead_rows.any():
+            restart = sparse.csr_matrix(dead_rows.astype(np.float64)[:, np.newaxis]) @ sparse.csr_matrix(first)
+            trans = (trans + restart).tocsr()
+            trans.eliminate_zeros()
+        trans.sort_indices()
+
+        self.indices = trans.indices
+        self.indptr = trans.indptr
+        row_nnz = np.diff(trans.indptr)
+        row_of_entry = np.repeat(np.arange(size), row_nnz)
+
+        first_cdf = np.cumsum(first)
+        self.first_cdf = first_cdf / first_cdf[-1]
+        self.trans_cdf = self._flat_cdf(trans.data, row_of_entry)
+        self.uniform_cdf = self._flat_cdf(np.ones_like(trans.data), row_of_entry)
+
+        logger.debug('Compiled markov model (alphabet-size=%s, transitions=%s, dead-rows=%s)' % (
+            size, trans.nnz, int(dead_rows.sum())))
+
+    def _flat_cdf(self, data, row_of_entry):
+        """
+        Row-wise CDFs over the CSR entries laid out end to end, with row i shifted into [i, i+1], so that one
+        searchsorted call can sample a different row for every password in the batch.
+        """
+        cum = np.cumsum(data)
+        row_start = self.indptr[:-1]
+        before_row = np.where(row_start > 0, cum[np.maximum(row_start - 1, 0)], 0.0)
+        row_total = np.add.reduceat(data, row_start) if len(data) else np.zeros(0)
+        within = cum - before_row[row_of_entry]
+        return within / row_total[row_of_entry] + row_of_entry
+
+    def _draw(self, flat_cdf, prev, uniform):
+        entry = np.searchsorted(flat_cdf, prev + uniform, side='right')
+        # Guard against rounding at the edges of a row's range
+        entry = np.clip(entry, self.indptr[prev], self.indptr[prev + 1] - 1)
+        return self.indices[entry]
+
+    def generate_codes(self, n, length):
+        """
+        Generate an (n, length) array of character indices into self.alphabet.
+        """
+        codes = np.empty((n, length), dtype=np.intp)
+        if n == 0 or length == 0:
+            return codes
+
+        codes[:, 0] = np.minimum(np.searchsorted(self.first_cdf, self.rng.random(n), side='right'),
+                                 len(self.alphabet) - 1)
+
+        for pos in range(1, length):
+            prev = codes[:, pos - 1]
+            selection = self._draw(self.trans_cdf, prev, self.rng.random(n))
+
+            if self.mutation_rate > 0:
+                mutate = self.rng.random(n) < self.mutation_rate
+                if mutate.any():
+                    selection[mutate] = self._draw(self.uniform_cdf, prev[mutate], self.rng.random(int(mutate.sum())))
+
+            codes[:, pos] = selection
+
+        return codes
+
+    def decode(self, codes):
+        if codes.shape[1] == 0:
+            return [''] * codes.shape[0]
+        chars = np.array(self.alphabet, dtype='U1')[codes]
+        return np.ascontiguousarray(chars).view('U%s' % codes.shape[1]).ravel().tolist()
+
+    def generate_batch(self, n, length):
+        """
+        Generate n passwords of the given length in one vectorized pass.
+        """
+        return self.decode(self.generate_codes(n, length))
@@ -0,0 +1,230 @@
+
+import os
+import json
+import signal
+import asyncio
+import logging
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from engine.pipeline import Pipeline
+from engine.model import MarkovModel
+from engine.analytics import NGramAnalyzer
+from engine.validation import PasswordVerifier
+from engine.bloom import BloomFilter, bloom_path
+from engine.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+    Long-lived generation/validation service.
+
+    The markov model (and its compiled sampler), the validator and the n-gram index are loaded once and shared by all
+    requests, so a request only pays for its own work instead of the imports, model loading and validator training of
+    a CLI run. Requests and responses are JSON objects, one per line, over a Unix domain socket or a localhost TCP
+    port; a connection may send any number of requests. Requests run in a pool of worker threads, so slow requests
+    do not hold up the others.
+
+    Requests:
+        {"op": "generate", "length": 10, "count": 100, "seed": 1, "validate": true, "exclude": false}
+        {"op": "generate", "length": 8, "count": 1000, "enumerate": true, "min_prob": 1e-9}
+        {"op": "classify", "passwords": ["password1", ...]}
+        {"op": "compare", "words": ["password1", ...]}
+        {"op": "reload"}
+        {"op": "status"}
+
+    Responses are {"ok": true, ...} or {"ok": false, "error": "<message>"}. A reload (also on SIGHUP) loads a new set
+    of models in the background and swaps it in once complete; requests in flight finish with the models they started
+    with.
+"""
+
+# Longest request line (a classify/compare request carries its whole word list)
+MAX_REQUEST_BYTES = 1 << 28
+
+# Sampler settings of the -g CLI flow
+SAMPLER_PARAMS = {'prune': False, 'threshold': 0.2}
+
+GEN_BATCH_SIZE = 100000
+
+
+class ServiceModels(object):
+    """
+    One loaded, read-only set of models. Any of them may be missing; the requests that need it are then rejected.
+    """
+
+    model = None
+    sampler = None
+    validator = None
+    known = None
+    analyzer = None
+    loaded = None
+
+    @classmethod
+    def load(cls, model_path=None, validate=None, ngram_counts=None, validator_backend='svm', features='ord100',
+             validator_sample=100000):
+        """
+        :param model_path: model for generate requests; its saved Bloom filter (see engine.bloom) serves "exclude"
+        :param validate: password file the validator is trained on (or loaded from the validator cache)
+        :param ngram_counts: counted n-gram file for compare requests
+        """
+        models = cls()
+        if model_path:
+            pipeline = Pipeline()
+            models.model = pipeline.load_model(model_path)
+            models.sampler = pipeline.sampler(**SAMPLER_PARAMS)
+            if os.path.isfile(bloom_path(model_path)):
+                models.known = BloomFilter.load(bloom_path(model_path))
+        if validate:
+            models.validator = PasswordVerifier(backend=validator_backend, features=features)
+            models.validator.init_classifier(validate, chunk_size=validator_sample)
+        if ngram_counts:
+            models.analyzer = NGramAnalyzer(ngram_counts)
+            models.analyzer.get_index()
+        models.loaded = {'model': model_path, 'validate': validate, 'ngram_counts': ngram_counts}
+        logger.debug('Loaded service models: %s' % models.loaded)
+        return models
+
+    def generate(self, length=10, count=100, seed=None, validate=True, exclude=False, enumerate=False,
+                 min_prob=None):
+        if self.model is None:
+            raise AttributeError('No model loaded.')
+        if exclude and self.known is None:
+            raise AttributeError('No Bloom filter saved next to the model.')
+        validator = self.validator if validate else None
+        known = self.known if exclude else None
+
+        pipeline = Pipeline()
+        pipeline.model = self.model
+        if enumerate:
+            if not isinstance(self.model, MarkovModel):
+                raise AttributeError('Enumeration only supports first-order markov models.')
+            batches = pipeline.enumerate(count, length, validator=validator, known=known, min_prob=min_prob,
+                                         batch_size=GEN_BATCH_SIZE)
+        else:
+            batches = pipeline.generate(count, length, validator=validator, known=known, batch_size=GEN_BATCH_SIZE,
+                                        seed=seed, sampler=self.sampler)
+        passwords = [pw for batch in batches for pw in batch]
+        return {'passwords': passwords, 'stats': pipeline.stats}
+
+    def classify(self, passwords):
+        if self.validator is None:
+            raise AttributeError('No validator loaded.')
+        return {'accepted': self.validator.classify_passwords(passwords)}
+
+    def compare(self, words):
+        if self.analyzer is None:
+            raise AttributeError('No n-gram counts loaded.')
+        results = []
+        for word, (ngrams, known, total) in zip(words, self.analyzer.compare_many(words)):
+            results.append({'word': word, 'ngrams': len(ngrams), 'known': known, 'total': total})
+        return {'results': results}
+
+
+class ModelService(object):
+    """
+    asyncio server around a ServiceModels set, loaded (and reloaded) with loader.
+    """
+
+    models = None
+    requests = 0
+
+    def __init__(self, loader, workers=4):
+        """
+        :param loader: callable returning a ServiceModels, e.g. functools.partial(ServiceModels.load, ...)
+        :param workers: requests handled at the same time
+        """
+        self.loader = loader
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.reload_lock = None
+        self.stopped = None
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def reload(self):
+        """
+        Load a new model set and swap it in. If loading fails the current set stays in use and the error is raised.
+        """
+        async with self.reload_lock:
+            with metrics.timer('service.reload'):
+                self.models = await self._run(self.loader)
+        return {'loaded': self.models.loaded}
+
+    async def handle(self, request):
+        """
+        :return: the response (dict) to a request (dict)
+        """
+        op = request.pop('op', None)
+        # Requests keep the models they started with, whatever a reload does meanwhile
+        models = self.models
+        if op == 'generate':
+            return await self._run(models.generate, **request)
+        if op == 'classify':
+            return await self._run(models.classify, request['passwords'])
+        if op == 'compare':
+            return await self._run(models.compare, request['words'])
+        if op == 'reload':
+            return await self.reload()
+        if op == 'status':
+            return {'loaded': models.loaded, 'requests': self.requests}
+        raise AttributeError('Unknown request: %s' % op)
+
+    async def _connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    with metrics.timer('service.request'):
+                        response = await self.handle(json.loads(line.decode('utf-8')))
+                    response['ok'] = True
+                except Exception as e:
+                    # Any failure (e.g. a reload whose files are gone) is the request's error, not the connection's
+                    logger.debug('Request failed', exc_info=True)
+                    response = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+                self.requests += 1
+                metrics.inc('service.requests')
+                metrics.report()
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _schedule_reload(self):
+        logger.debug('Reloading models (SIGHUP)...')
+        task = asyncio.ensure_future(self.reload())
+        task.add_done_callback(lambda t: t.exception() and logger.error('Reload failed: %s' % t.exception()))
+
+    async def serve(self, socket_path=None, port=None, ready=None):
+        """
+        Load the models and serve on the Unix domain socket socket_path, or on localhost:port, until SIGINT/SIGTERM.
+        :param ready: called once the service accepts connections
+        """
+        self.reload_lock = asyncio.Lock()
+        self.stopped = asyncio.Event()
+        await self.reload()
+
+        if port is not None:
+            server = await asyncio.start_server(self._connection, '127.0.0.1', port, limit=MAX_REQUEST_BYTES)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self._connection, socket_path, limit=MAX_REQUEST_BYTES)
+
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, self._schedule_reload)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopped.set)
+
+        logger.debug('Serving on %s' % (socket_path if port is None else '127.0.0.1:%s' % port))
+        if ready:
+            ready()
+        async with server:
+            await self.stopped.wait()
+        self.executor.shutdown(wait=False)
+        if port is None and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,227 @@
+
+import os
+import logging
+import numpy as np
+
+from multiprocessing import Pool
+
+# https://pypi.org/project/python-Levenshtein/
+import Levenshtein
+
+from engine.approx import hash_ngrams
+from engine.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+    Nearest-neighbour edit distances between a generated wordlist and a reference wordlist.
+
+    Every reference word is indexed under its deletion neighbourhood: all strings obtained by deleting up to
+    max_distance of its characters. Two words within max_distance edits always share such a string, so the candidates
+    of a generated word are the reference words sharing one of its own deletion strings. Candidates are then verified
+    with Levenshtein.distance. The neighbourhoods are stored as a sorted array of 64-bit hashes (see
+    engine.approx.hash_ngrams) with the matching reference word ids, and a whole chunk of generated words is looked up
+    with one np.searchsorted call.
+"""
+
+# Reference words longer than this are only matched exactly (their neighbourhoods grow as length^max_distance)
+MAX_INDEXED_LENGTH = 32
+
+# Generated words looked up per worker task
+QUERY_CHUNK = 20000
+
+# Reference words hashed per worker task while building the index
+BUILD_CHUNK = 50000
+
+
+def deletion_variants(word, max_deletions):
+    """
+    :return: set of all strings obtained by deleting up to max_deletions characters of word (including word itself)
+    """
+    variants = {word}
+    # Deleting positions in increasing order only generates every set of deleted positions once
+    level, starts = [word], [0]
+    for _ in range(max_deletions):
+        next_level, next_starts = [], []
+        for w, start in zip(level, starts):
+            for i in range(start, len(w)):
+                next_level.append(w[:i] + w[i+1:])
+                next_starts.append(i)
+        level, starts = next_level, next_starts
+        variants.update(level)
+    return variants
+
+
+def _variant_hashes(task):
+    """
+    Worker: deletion neighbourhood hashes of a slice of the reference words.
+    :return: (hashes, word ids) numpy arrays
+    """
+    words, word_ids, max_distance = task
+    variants = []
+    ids = []
+    for word_id, word in zip(word_ids, words):
+        word_variants = deletion_variants(word, max_distance)
+        variants.extend(word_variants)
+        ids.extend([word_id] * len(word_variants))
+    return hash_ngrams(variants), np.array(ids, dtype=np.uint32)
+
+
+class SimilarityIndex(object):
+    """
+    Deletion neighbourhood index over the distinct words of a reference list, answering "how many edits is the
+    closest reference word away" for words within max_distance edits (larger distances are reported as
+    max_distance + 1).
+    """
+
+    max_distance = 2
+
+    def __init__(self, ref_words, max_distance=2, workers=None, max_length=MAX_INDEXED_LENGTH):
+        if max_distance < 0:
+            raise AttributeError('The maximum edit distance cannot be negative.')
+        self.max_distance = max_distance
+        self.max_length = max_length
+        self.words = list(dict.fromkeys(word for word in ref_words if word))
+        self.ids = dict((word, word_id) for word_id, word in enumerate(self.words))
+        self.hashes = None
+        self.word_ids = None
+        self.build(workers=workers)
+
+    def build(self, workers=None):
+        indexed = [word_id for word_id, word in enumerate(self.words) if len(word) <= self.max_length]
+        tasks = []
+        for start in range(0, len(indexed), BUILD_CHUNK):
+            word_ids = indexed[start:start+BUILD_CHUNK]
+            tasks.append(([self.words[word_id] for word_id in word_ids], word_ids, self.max_distance))
+
+        workers = workers if workers else os.cpu_count()
+        if workers > 1 and len(tasks) > 1:
+            with Pool(min(workers, len(tasks))) as pool:
+                parts = pool.map(_variant_hashes, tasks)
+        else:
+            parts = [_variant_hashes(task) for task in tasks]
+
+        if parts:
+            hashes = np.concatenate([part[0] for part in parts])
+            word_ids = np.concatenate([part[1] for part in parts])
+        else:
+            hashes, word_ids = np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint32)
+        order = np.argsort(hashes)
+        self.word_ids = word_ids[order]
+        order = None
+        hashes.sort()
+        self.hashes = hashes
+        logger.debug('Indexed %s reference words under %s deletion variants' % (len(self.words), len(self.hashes)))
+
+    def nearest(self, words):
+        """
+        :return: (distances, nearest ids) numpy arrays for a list of words. Distances above max_distance are reported
+            as max_distance + 1, with a nearest id of -1.
+        """
+        unmatched = self.max_distance + 1
+        distances = np.full(len(words), unmatched, dtype=np.int16)
+        nearest = np.full(len(words), -1, dtype=np.int64)
+
+        variants = []
+        owners = []
+        for i, word in enumerate(words):
+            word_id = self.ids.get(word)
+            if word_id is not None:
+                distances[i] = 0
+                nearest[i] = word_id
+            elif 0 < len(word) <= self.max_length + self.max_distance and self.max_distance > 0:
+                word_variants = deletion_variants(word, self.max_distance)
+                variants.extend(word_variants)
+                owners.extend([i] * len(word_variants))
+        if not variants or len(self.hashes) == 0:
+            return distances, nearest
+
+        # Expand every matching hash range into (word, reference word) candidate pairs
+        # (sorted needles keep the binary searches cache friendly)
+        hashes = hash_ngrams(variants)
+        order = np.argsort(hashes)
+        hashes = hashes[order]
+        owners = np.array(owners, dtype=np.int64)[order]
+        lo = np.searchsorted(self.hashes, hashes, side='left')
+        hi = np.searchsorted(self.hashes, hashes, side='right')
+        hits = hi - lo
+        total = int(hits.sum())
+        if total == 0:
+            return distances, nearest
+        offsets = np.arange(total) - np.repeat(np.cumsum(hits) - hits, hits)
+        candidates = np.repeat(owners, hits) * len(self.words) + \
+            self.word_ids[np.repeat(lo, hits) + offsets]
+        candidates = np.unique(candidates)
+        query_ids, ref_ids = np.divmod(candidates, len(self.words))
+
+        query_ids = query_ids.tolist()
+        ref_ids = ref_ids.tolist()
+        found = np.array(list(map(Levenshtein.distance, [words[i] for i in query_ids],
+                                  [self.words[i] for i in ref_ids])), dtype=np.int16)
+        metrics.inc('similarity.verified', len(found))
+
+        # Smallest distance per word: sort by (word, distance) and keep the first pair of every word
+        query_ids = np.array(query_ids, dtype=np.int64)
+        order = np.lexsort((found, query_ids))
+        first = order[np.r_[True, query_ids[order][1:] != query_ids[order][:-1]]]
+        best = first[found[first] <= self.max_distance]
+        distances[query_ids[best]] = found[best]
+        nearest[query_ids[best]] = np.array(ref_ids, dtype=np.int64)[best]
+        return distances, nearest
+
+
+# Index shared with the query workers (set by the pool initializer)
+_index = None
+
+
+def _init_worker(index):
+    global _index
+    _index = index
+
+
+def _nearest_chunk(words):
+    return _index.nearest(words)
+
+
+def nearest_distances(gen_words, index, workers=None, chunk_size=QUERY_CHUNK):
+    """
+    Nearest reference distance of every word in gen_words, looked up in chunks across worker processes. Repeated
+    words are looked up once.
+    :return: (distances, nearest ids) numpy arrays aligned with gen_words
+    """
+    distinct = list(dict.fromkeys(gen_words))
+    positions = dict((word, i) for i, word in enumerate(distinct))
+    chunks = [distinct[start:start+chunk_size] for start in range(0, len(distinct), chunk_size)]
+
+    workers = workers if workers else os.cpu_count()
+    if workers > 1 and len(chunks) > 1:
+        with Pool(min(workers, len(chunks)), initializer=_init_worker, initargs=(index,)) as pool:
+            results = pool.map(_nearest_chunk, chunks)
+    else:
+        results = [index.nearest(chunk) for chunk in chunks]
+
+    if results:
+        distances = np.concatenate([result[0] for result in results])
+        nearest = np.concatenate([result[1] for result in results])
+    else:
+        distances, nearest = np.empty(0, dtype=np.int16), np.empty(0, dtype=np.int64)
+    metrics.inc('similarity.compared', len(gen_words))
+
+    lookup = np.fromiter((positions[word] for word in gen_words), dtype=np.int64, count=len(gen_words))
+    return distances[lookup], nearest[lookup]
+
+
+def summarize(distances, max_distance):
+    """
+    :return: dict with the number of words, the share of words at each distance ('histogram', the last bucket being
+        "more than max_distance") and the cumulative share within each distance ('within')
+    """
+    total = len(distances)
+    counts = np.bincount(np.asarray(distances, dtype=np.int64), minlength=max_distance + 2)[:max_distance + 2]
+    shares = counts / total if total else np.zeros(len(counts))
+    return {
+        'words': total,
+        'max_distance': max_distance,
+        'histogram': dict((d, float(share)) for d, share in enumerate(shares)),
+        'within': dict((d, float(share)) for d, share in enumerate(np.cumsum(shares)[:max_distance + 1])),
+    }
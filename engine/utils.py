@@ -1,31 +1,63 @@
 
 import pickle
+import sys
 
 
-def generate_ngrams(word_list, min_size=2, max_size=None, logger=None, max_wordlen=128):
-    ngrams = []
+def iter_ngrams(word_list, min_size=2, max_size=None, logger=None, max_wordlen=128):
+    """
+    Yield every substring of every word with a length between min_size and max_size (inclusive) one at a time, so
+    the n-grams can be fed straight into a Counter without building the O(L^2) substring list of a whole chunk.
+    """
+    skipped = 0
     for word in word_list:
-        if len(word) > max_wordlen:
-            if logger:
-                logger.debug('Skipping words of length greater than %s' % max_wordlen)
-                logger.debug('Skipped word: %s' % word)
+        word_len = len(word)
+        if word_len > max_wordlen:
+            skipped += 1
             continue
 
-        for start_pos in range(len(word)):
-            for end_pos in range(start_pos+min_size, len(word)+1):
+        for start_pos in range(word_len):
+            # Clamp to the size bounds before any substring is created
+            last_end = min(word_len, start_pos + max_size) if max_size else word_len
+            for end_pos in range(start_pos+min_size, last_end+1):
+                yield word[start_pos:end_pos]
+
+    if skipped and logger:
+        logger.debug('Skipped %s words of length greater than %s' % (skipped, max_wordlen))
+
+
+def ngram_total(word_list, min_size=2, max_size=None, max_wordlen=128):
+    """
+    Number of n-grams iter_ngrams yields for word_list, computed from the word lengths alone.
+    """
+    total = 0
+    for word_len in map(len, word_list):
+        if word_len > max_wordlen:
+            continue
+        largest = min(max_size, word_len) if max_size else word_len
+        sizes = largest - min_size + 1
+        if sizes > 0:
+            # sum of (word_len - size + 1) for size in [min_size, largest]
+            total += sizes * (word_len + 1) - (min_size + largest) * sizes // 2
+    return total
 
-                if max_size and end_pos - start_pos > max_size:
-                    break
 
-                try:
-                    ngrams.append(word[start_pos:end_pos])
-                except MemoryError:
-                    if logger:
-                        logger.debug('Excepting word length: %s' % len(word))
-                        logger.debug('Excepting word: %s' % word)
-                    raise
+def generate_ngrams(word_list, min_size=2, max_size=None, logger=None, max_wordlen=128):
+    """
+    List version of iter_ngrams, for small inputs (e.g. a single word).
+    """
+    return list(iter_ngrams(word_list, min_size=min_size, max_size=max_size, logger=logger, max_wordlen=max_wordlen))
+
+
+def write_counts(counts, filepath, sort=False):
+    items = sorted(counts.items(), key=count_sort_key) if sort else counts.items()
+    with open(filepath, 'w', encoding='utf-8') as f:
+        for ng, ng_count in items:
+            f.write('%s\t%s\n' % (ng, ng_count))
+
+
+def count_sort_key(item):
+    return -item[1], item[0]
 
-    return ngrams
 
 def load_obj(filepath):
     with open(filepath, 'rb') as f:
@@ -38,11 +70,21 @@ def save_obj(obj, filepath ):
 def only_ascii(char_list):
     return [ch for ch in char_list if ord(ch) < 128]
 
-def get_file(f, chunk_size=1000000):
-    result = []
-    for i in range(chunk_size):
-        result.append(f.readline().strip('\n\r'))
-    return result
-
+def peak_rss_mb():
+    """
+    Peak resident set size of this process, in MB; None where the resource module is not available (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
 
 
+def format_mb(mb):
+    """
+    '123MB' for a peak_rss_mb value, 'n/a' for None.
+    """
+    return '%.0fMB' % mb if mb is not None else 'n/a'
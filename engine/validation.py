@@ -1,24 +1,133 @@
 
 import os
+import time
 import logging
+import numpy as np
+import sklearn
+
+from scipy import sparse
 
 from sklearn.svm import OneClassSVM
-from pathlib import Path
+from sklearn.linear_model import SGDOneClassSVM
+from sklearn.kernel_approximation import Nystroem
+from sklearn.ensemble import IsolationForest
+from sklearn.pipeline import Pipeline
 
 import settings
-from engine.utils import get_file, load_obj, save_obj
+from engine.utils import load_obj, save_obj, peak_rss_mb, format_mb
+from engine.cache import ModelCache, file_digest
+from engine.metrics import metrics
+from engine.reader import iter_line_chunks
+from engine.features import make_encoder, OrdEncoder
 
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG if settings.DEBUG else logging.ERROR)
+
+
+# Classifier backends:
+#   svm:        exact OneClassSVM (RBF kernel) on a uniform sample of chunk_size passwords -- O(n^2) or worse
+#   sgd:        Nystroem RBF feature map + SGDOneClassSVM, trained with partial_fit over the whole dump
+#   iforest:    IsolationForest on a uniform sample of chunk_size passwords
+BACKENDS = ('svm', 'sgd', 'iforest')
+
+# Support vectors (densified) and passwords per block of svm_decision_function
+SV_BLOCK = 1024
+ROW_BLOCK = 8192
+
+
+def rbf_gamma(svm, n_features):
+    """
+    :return: the RBF width of an OneClassSVM with a numeric or 'auto' gamma; None for 'scale' (data dependent)
+    """
+    if svm.gamma == 'auto':
+        return 1.0 / n_features
+    if isinstance(svm.gamma, str):
+        return None
+    return float(svm.gamma)
+
+
+def svm_decision_function(svm, features):
+    """
+    decision_function of a fitted RBF OneClassSVM, computed with matrix products between blocks of passwords and
+    blocks of support vectors instead of one kernel evaluation at a time (libsvm). Works on dense and sparse features.
+    """
+    gamma = rbf_gamma(svm, features.shape[1])
+    n = features.shape[0]
+    decision = np.full(n, svm.intercept_[0], dtype=np.float64)
+    coef = svm.dual_coef_
+    coef = np.asarray(coef.toarray() if sparse.issparse(coef) else coef, dtype=np.float64).ravel()
+    vectors = svm.support_vectors_
+    for sv_start in range(0, vectors.shape[0], SV_BLOCK):
+        block = vectors[sv_start:sv_start+SV_BLOCK]
+        block = np.asarray(block.toarray() if sparse.issparse(block) else block, dtype=np.float64)
+        block_sq = np.einsum('ij,ij->i', block, block)
+        # Contiguous, so that sparse row blocks multiply it row by row without a copy
+        block_t = np.ascontiguousarray(block.T)
+        for start in range(0, n, ROW_BLOCK):
+            rows = features[start:start+ROW_BLOCK]
+            if sparse.issparse(rows):
+                rows = rows.astype(np.float64)
+                rows_sq = np.asarray(rows.multiply(rows).sum(axis=1)).ravel()
+            else:
+                rows = np.asarray(rows, dtype=np.float64)
+                rows_sq = np.einsum('ij,ij->i', rows, rows)
+            # exp(-gamma * squared distance), computed in place
+            kernel = np.asarray(rows @ block_t)
+            kernel *= -2.0
+            kernel += rows_sq[:, np.newaxis]
+            kernel += block_sq[np.newaxis, :]
+            np.maximum(kernel, 0, out=kernel)
+            kernel *= -gamma
+            np.exp(kernel, out=kernel)
+            decision[start:start+ROW_BLOCK] += kernel @ coef[sv_start:sv_start+SV_BLOCK]
+    return decision
 
 
 class PasswordVerifier(object):
 
     classifier = None
+    backend = 'svm'
+
+    # Nystroem components for the 'sgd' backend
+    n_components = 300
+    # Passwords per partial_fit call for the 'sgd' backend
+    batch_size = 20000
+    random_state = 0
+
+    # Password -> vector encoding (see engine.features), recorded with cached models
+    encoder = None
+
+    # Statistics of the last train_model call
+    training_stats = None
+
+    # Passwords classified and accepted by filter_passwords (see acceptance_rate)
+    filtered = 0
+    accepted = 0
 
-    def __init__(self):
-        pass
+    def __init__(self, backend='svm', features='ord100'):
+        """
+        :param features: name of the feature encoding (see engine.features.ENCODERS)
+        """
+        if backend not in BACKENDS:
+            raise AttributeError('Unknown validator backend: %s (expected one of %s)' % (backend, ', '.join(BACKENDS)))
+        self.backend = backend
+        self.encoder = make_encoder(features)
+
+    @property
+    def feature_encoding(self):
+        return self.encoder.name
+
+    def _new_classifier(self):
+        gamma = self.encoder.gamma
+        if self.backend == 'iforest':
+            return IsolationForest(random_state=self.random_state)
+        if self.backend == 'sgd':
+            return Pipeline([
+                ('features', Nystroem(kernel='rbf', gamma=gamma if gamma else 0.01, n_components=self.n_components,
+                                      random_state=self.random_state)),
+                ('ocsvm', SGDOneClassSVM(random_state=self.random_state)),
+            ])
+        return OneClassSVM(kernel="rbf", gamma=gamma if gamma else 'auto')
 
     def init_classifier(self, pw_dump_filename, chunk_size=100000, **kwargs):
         """
@@ -26,21 +135,45 @@ class PasswordVerifier(object):
         If a pre-trained model exists attempt to load and use it.
         """
 
-        logger.debug('Initializing classifier...')
-        self.classifier = OneClassSVM(kernel="rbf", gamma='auto')
+        logger.debug('Initializing classifier (backend=%s)...' % self.backend)
+        self.classifier = self._new_classifier()
 
         logger.debug('Checking for already-trained models...')
-        filename, file_extension = os.path.splitext(os.path.basename(pw_dump_filename))
-        model_filepath = '%s%s.%s' % (settings.VALIDATOR_PATH, filename, settings.EXT_VALIDATOR)
-        model_file = Path(model_filepath)
+        cache = ModelCache(settings.VALIDATOR_PATH, max_entries=settings.VALIDATOR_CACHE_MAX_ENTRIES,
+                           max_bytes=settings.VALIDATOR_CACHE_MAX_MB * 1024 * 1024)
+        params = self.training_params(chunk_size)
+        cache_key = cache.make_key(file_digest(pw_dump_filename), params)
 
-        if model_file.is_file():
-            self.load_model(model_filepath)
+        classifier = cache.get(cache_key)
+        if classifier is not None:
+            self.use_classifier(classifier)
 
         else:
             logger.debug('Could not find existing model. Training new classifier.')
             self.train_model(pw_dump_filename, chunk_size=chunk_size)
-            self.save_model(model_filepath)
+            cache.put(cache_key, self.classifier, source=os.path.abspath(pw_dump_filename), params=params,
+                      feature_encoding=self.feature_encoding)
+
+    def _classifier_params(self):
+        classifier = self._new_classifier()
+        if isinstance(classifier, Pipeline):
+            return dict((name, step.get_params()) for name, step in classifier.steps)
+        return classifier.get_params()
+
+    def training_params(self, chunk_size):
+        """
+        Everything besides the training data that determines the trained model; part of the validator cache key.
+        """
+        return {
+            'backend': self.backend,
+            'chunk_size': chunk_size,
+            'random_state': self.random_state,
+            'feature_encoding': self.feature_encoding,
+            'feature_params': self.encoder.get_params(),
+            'classifier': self._classifier_params(),
+            'batch_size': self.batch_size if self.backend == 'sgd' else None,
+            'sklearn': sklearn.__version__,
+        }
 
     def save_model(self, filepath):
         logger.debug('Saving trained model to %s' % filepath)
@@ -48,28 +181,139 @@ class PasswordVerifier(object):
 
     def load_model(self, filepath):
         logger.debug('Loading trained model: %s' % filepath)
-        self.classifier = load_obj(filepath)
+        self.use_classifier(load_obj(filepath))
+
+    def use_classifier(self, classifier):
+        """
+        Use a trained classifier with the feature encoding it was trained on. Classifiers saved before the encoding was
+        recorded used the dense 'ord100' encoding.
+        """
+        encoding = getattr(classifier, 'feature_encoding_', {'name': OrdEncoder.name, 'params': {}})
+        if encoding['name'] != self.feature_encoding or encoding['params'] != self.encoder.get_params():
+            logger.debug('Model was trained on %s features. Switching from %s.' % (encoding['name'], self.feature_encoding))
+            self.encoder = make_encoder(encoding['name'], **encoding['params'])
+        self.classifier = classifier
+
+    def _iter_chunks(self, pw_dump_filename):
+        return iter_line_chunks(pw_dump_filename, self.batch_size, metric='verifier.bytes_read')
+
+    def sample_passwords(self, pw_dump_filename, sample_size):
+        """
+        Uniform reservoir sample of sample_size passwords, streamed over the whole dump.
+        """
+        rng = np.random.default_rng(self.random_state)
+        reservoir = []
+        seen = 0
+        for chunk in self._iter_chunks(pw_dump_filename):
+            fill = min(max(sample_size - len(reservoir), 0), len(chunk))
+            reservoir.extend(chunk[:fill])
+
+            # Algorithm R, vectorized per chunk: password number i replaces a random slot with probability k/(i+1)
+            positions = np.arange(seen + fill, seen + len(chunk))
+            slots = (rng.random(len(positions)) * (positions + 1)).astype(np.int64)
+            for offset in np.nonzero(slots < sample_size)[0]:
+                reservoir[slots[offset]] = chunk[fill + offset]
+            seen += len(chunk)
+            metrics.inc('verifier.sampled_lines', len(chunk))
+            metrics.report()
+
+        logger.debug('Sampled %s of %s passwords' % (len(reservoir), seen))
+        return reservoir, seen
 
     def train_model(self, pw_dump_filename, chunk_size=100000):
-        # TODO: Assumption: List of passwords can be loaded into memory to train classifier
-        # TODO: Limiting chunk size to prevent memory errors
+        """
+        Train the classifier on the password dump. The 'svm' and 'iforest' backends are fit on a uniform sample of
+        chunk_size passwords from the whole file; the 'sgd' backend fits its feature map on that sample and then
+        streams every password of the file through partial_fit.
+        """
+
+        start = time.time()
+        if self.classifier is None:
+            self.classifier = self._new_classifier()
 
-        logger.debug('Loading password dump training file...')
-        with open(pw_dump_filename, encoding='utf-8') as f:
-            pws = get_file(f, chunk_size=chunk_size)
+        logger.debug('Sampling password dump training file...')
+        pws, total = self.sample_passwords(pw_dump_filename, chunk_size)
+        if not pws:
+            raise AttributeError('No passwords to train on in %s' % pw_dump_filename)
 
         logger.debug('Formatting strings for classification...')
-        num_pws = [self.str_to_numbers(s) for s in pws]
+        num_pws = self.encode_passwords(pws)
 
         logger.debug('Training classifier...')
-        self.classifier.fit(num_pws)
-        logger.debug('Initialization complete.')
+        trained = len(pws)
+        if self.backend == 'sgd':
+            features = self.classifier.named_steps['features'].fit(num_pws)
+            ocsvm = self.classifier.named_steps['ocsvm']
+            trained = 0
+            for chunk in self._iter_chunks(pw_dump_filename):
+                with metrics.timer('verifier.train'):
+                    ocsvm.partial_fit(features.transform(self.encode_passwords(chunk)))
+                trained += len(chunk)
+                metrics.inc('verifier.trained', len(chunk))
+                metrics.report()
+        else:
+            with metrics.timer('verifier.train'):
+                self.classifier.fit(num_pws)
+            metrics.inc('verifier.trained', trained)
+        # Saved and cached models carry their encoding (see use_classifier)
+        self.classifier.feature_encoding_ = {'name': self.feature_encoding, 'params': self.encoder.get_params()}
+
+        self.training_stats = {
+            'backend': self.backend,
+            'passwords': total,
+            'trained_on': trained,
+            'seconds': time.time() - start,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        logger.debug('Initialization complete. (backend=%s, trained on %s of %s passwords, %.1fs, peak RSS %s)' % (
+            self.backend, trained, total, self.training_stats['seconds'], format_mb(self.training_stats['peak_rss_mb'])))
+
+    def _accepted(self, features):
+        """
+        :return: boolean array, True for the encoded passwords the classifier accepts
+        """
+        classifier = self.classifier
+        if isinstance(classifier, OneClassSVM) and classifier.kernel == 'rbf' and \
+                rbf_gamma(classifier, features.shape[1]) is not None:
+            return svm_decision_function(classifier, features) > 0
+        return self.classifier.predict(features) > 0
 
     def classify_passwords(self, password_list):
         if not self.classifier:
             raise AttributeError('Attempted to use uninitiated classifier')
-        num_pws = [self.str_to_numbers(s.strip('\n\r')) for s in password_list]
-        return [x > 0 for x in self.classifier.predict(num_pws)]
+        num_pws = self.encode_passwords([s.strip('\n\r') for s in password_list])
+        with metrics.timer('verifier.classify'):
+            accepted = self._accepted(num_pws).tolist()
+        metrics.inc('verifier.classified', len(accepted))
+        return accepted
+
+    def filter_passwords(self, password_list):
+        """
+        Classify a block of passwords in bulk and return the accepted ones.
+        """
+        if not password_list:
+            return []
+        if not self.classifier:
+            raise AttributeError('Attempted to use uninitiated classifier')
+        with metrics.timer('verifier.classify'):
+            keep = self._accepted(self.encode_passwords(password_list))
+        metrics.inc('verifier.classified', len(password_list))
+        self.filtered += len(password_list)
+        self.accepted += int(keep.sum())
+        return [pw for pw, accepted in zip(password_list, keep) if accepted]
+
+    @property
+    def acceptance_rate(self):
+        """
+        Share of the passwords passed to filter_passwords that were accepted; None before any were classified.
+        """
+        return float(self.accepted) / self.filtered if self.filtered else None
+
+    def encode_passwords(self, password_list):
+        """
+        Encode a list of passwords into one matrix (a row per password) with the verifier's feature encoder.
+        """
+        return self.encoder.encode(password_list)
 
     def str_to_numbers(self, string, max_pw_length=100, **kwargs):
         result = [0]*max_pw_length
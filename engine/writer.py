@@ -0,0 +1,122 @@
+
+import os
+import bz2
+import sys
+import gzip
+import lzma
+import queue
+import logging
+import threading
+
+from engine.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+    Buffered line writer for large outputs (e.g. generated password lists).
+
+    Lines are written a batch at a time: every batch is joined and encoded in one call and handed to a background
+    thread that does the (possibly compressed) writes, so compressing and writing overlap with producing the next
+    batch. The counterpart of engine.reader: files ending in .gz, .bz2 or .xz are compressed.
+"""
+
+COMPRESSORS = {
+    '.gz': lambda filepath: gzip.open(filepath, 'wb', compresslevel=6),
+    '.bz2': lambda filepath: bz2.open(filepath, 'wb'),
+    '.xz': lambda filepath: lzma.open(filepath, 'wb'),
+}
+
+# Bytes buffered by the underlying file object
+WRITE_BUFFER = 1 << 24
+
+# Encoded batches waiting for the writer thread
+MAX_PENDING = 8
+
+
+def open_output(filepath):
+    """
+    :return: binary file object for filepath, compressed according to its extension; stdout for None or '-'
+    """
+    if filepath in (None, '-'):
+        return sys.stdout.buffer
+    compressor = COMPRESSORS.get(os.path.splitext(filepath)[1].lower())
+    if compressor:
+        return compressor(filepath)
+    return open(filepath, 'wb', buffering=WRITE_BUFFER)
+
+
+class LineWriter(object):
+    """
+    Writes batches of lines to filepath (see open_output) from a background thread. Errors of the thread are raised
+    by the next write_batch or close call.
+    """
+
+    filepath = None
+    lines = 0
+
+    def __init__(self, filepath=None, max_pending=MAX_PENDING):
+        self.filepath = filepath
+        self.f = open_output(filepath)
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_pending, daemon=True)
+        self.thread.start()
+
+    def _write_pending(self):
+        while True:
+            data = self.pending.get()
+            if data is None:
+                break
+            if self.error:
+                continue
+            try:
+                self.f.write(data)
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error:
+            raise self.error
+
+    def write_batch(self, lines):
+        """
+        Queue a list of lines (without newlines) for writing.
+        """
+        self._check()
+        if not lines:
+            return
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.pending.put(data)
+        self.lines += len(lines)
+        metrics.inc('writer.lines', len(lines))
+        metrics.inc('writer.bytes', len(data))
+
+    def close(self):
+        """
+        Write what is left, then close the file (stdout is only flushed).
+        """
+        if self.thread is None:
+            return
+        self.pending.put(None)
+        self.thread.join()
+        self.thread = None
+        try:
+            if self.f is sys.stdout.buffer:
+                self.f.flush()
+            else:
+                self.f.close()
+        finally:
+            self._check()
+        if self.filepath not in (None, '-'):
+            logger.debug('Wrote %s lines to %s' % (self.lines, self.filepath))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            # Do not mask the exception that ended the block (often the writer's own error)
+            if exc_type is None:
+                raise
@@ -1,17 +1,29 @@
 
 import argparse
 import logging
+import os
+import sys
 import time
 import hashlib
 
 import settings
-from engine.base import NGramCounter, NGramGenerator
 from engine.analytics import NGramAnalyzer
-from engine.validation import PasswordVerifier
+from engine.pipeline import Pipeline, write_ngram_counts
+from engine.model import MarkovModel, model_type
+from engine.ngram_model import MIN_ORDER, MAX_ORDER
+from engine.validation import PasswordVerifier, BACKENDS
+from engine.features import ENCODERS
+from engine.metrics import metrics, make_sink
+from engine.bloom import BloomFilter, bloom_path, wordlist_filter
+from engine.checkpoint import checkpoint_directory, remove_checkpoints, CHECKPOINT_INTERVAL
+from engine.writer import LineWriter
+from engine.utils import format_mb
 
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG if settings.DEBUG else logging.ERROR)
+
+# Number of candidate passwords drawn from the markov model per vectorized batch
+GEN_BATCH_SIZE = 100000
 
 """
     General format:   ./ngram_analysis.py -f <file to act on> <action flag> -o <output file>
@@ -20,9 +32,12 @@ logging.basicConfig(level=logging.DEBUG if settings.DEBUG else logging.ERROR)
         Generate ngrams:                                    ./ngram_analysis -f passwords.txt -n -o pw_ngrams.ngram
         Generate Markov Matrix from ngrams:                 ./ngram_analysis -f pw_ngrams.ngram -m -o mm.model
         Generate 50 passwords of length 10 from M. Matrix:  ./ngram_analysis -f mm.model -g 10 -G 50
+        Generate 100M passwords with 8 processes to a file:  ./ngram_analysis -f mm.model -g 10 -G 100000000 -j 8 --seed 1 -o pws.txt.gz
+        Enumerate the 10M most likely passwords of length 8: ./ngram_analysis -f mm.model -g 8 -G 10000000 --enumerate -o top.txt
 
         NOTE:
             Add -V <password file> to "-g" to validate generated passwords against a trained classifier
+            Add --exclude <password file> to "-g" to drop generated passwords that are in the file, --unique to drop repeats
             See below example
 
         ./ngram_analysis -f resources/10_million_password_list_top_1000000.txt -n -o results/pw_ngrams.ngram
@@ -32,6 +47,24 @@ logging.basicConfig(level=logging.DEBUG if settings.DEBUG else logging.ERROR)
 
 """
 
+def result_path(extension):
+    return '%sRESULT_%s.%s' % (
+        settings.RESULT_PATH,
+        hashlib.sha256(str(time.time()).encode('utf-8')).hexdigest()[:10],
+        extension
+    )
+
+
+def print_top(ngram_counts, n):
+    """
+    Print the first n of the (sorted) ngram counts while passing all of them on.
+    """
+    for i, (ng, ct) in enumerate(ngram_counts):
+        if i < n:
+            print('%s:%s' % (ng, ct))
+        yield ng, ct
+
+
 if __name__ == "__main__":
 
     start_time = time.time()
@@ -45,96 +78,173 @@ if __name__ == "__main__":
     parser.add_argument('-g', dest='genpw', type=int, default=None, help='Generate a password from the given markov model file with given length')
     parser.add_argument('-G', dest='genpws', type=int, default=None, help='Supplemental flag for -g, repeat N times.')
     parser.add_argument('-V', dest='validate', type=str, help='Use this password file to validate generated passwords.')
+    parser.add_argument('--exclude', dest='exclude', type=str, nargs='?', const='', default=None, metavar='WORDLIST', help='With -g/-A: drop generated passwords that are in WORDLIST (default: the -A wordlist, or the filter saved with the -g model), tested with a Bloom filter that is saved next to the model.')
+    parser.add_argument('--unique', dest='unique', action='store_true', help='With -g/-A: drop generated passwords that were already generated.')
+    parser.add_argument('--fp-rate', dest='fp_rate', type=float, default=0.001, help='False positive rate of the --exclude/--unique Bloom filters (share of new passwords wrongly dropped).')
+    parser.add_argument('--validator', dest='validator_backend', choices=BACKENDS, default='svm', help='Classifier backend for -V: svm (exact, sampled), sgd (approximate kernel, whole dump) or iforest.')
+    parser.add_argument('--features', dest='features', choices=sorted(ENCODERS), default='ord100', help='Password encoding of the -V validator: ord100 (dense character codes) or hashed (sparse character n-gram counts; faster with --validator sgd, slower with svm).')
+    parser.add_argument('--validator-sample', dest='validator_sample', type=int, default=100000, help='Number of passwords sampled from the -V file to train the validator on.')
+    parser.add_argument('--two-stage', dest='two_stage', action='store_true', help='With -n/-A: write the intermediate n-gram file and count it from disk (slower).')
+    parser.add_argument('-M', '--memory-budget', dest='memory_budget', type=int, default=None, help='With -n/-A: cap in-memory n-gram counts at this many MB and spill sorted runs to disk.')
+    parser.add_argument('--sqlite', dest='sqlite', action='store_true', help='With -n/-A: store n-gram counts in the SQLite database (settings.DB_NAME).')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=None, help='With -n/-A: count n-grams with N worker processes. With -g/-A: generate passwords with N worker processes.')
+    parser.add_argument('--enumerate', dest='enumerate', action='store_true', help='With -g/-A: emit the -G most likely passwords in descending probability instead of sampling (first-order models; no repeats).')
+    parser.add_argument('--min-prob', dest='min_prob', type=float, default=None, help='With --enumerate: stop at passwords less likely than this.')
+    parser.add_argument('--seed', dest='seed', type=int, default=None, help='With -g/-A: random seed; the same seed gives the same passwords for any -j.')
+    parser.add_argument('--approx', dest='approx', type=int, nargs='?', const=0, default=None, metavar='K', help='With -n/-p/-A: approximate the top K n-grams in fixed memory (Count-Min Sketch) instead of counting all of them exactly; K defaults to the -p value.')
+    parser.add_argument('--sketch-error', dest='sketch_error', type=float, default=1e-5, help='With --approx: maximum overcount as a fraction of all counted n-grams (sketch size grows as 1/error).')
+    parser.add_argument('--update', dest='update', type=str, default=None, help='Count the -f wordlist and merge it into this existing model (saved in place, or to -o).')
+    parser.add_argument('--save-ngrams', dest='save_ngrams', type=str, default=None, help='With -A: also save the sorted n-gram counts to this file.')
+    parser.add_argument('--order', dest='order', type=int, choices=range(MIN_ORDER, MAX_ORDER + 1), default=None, help='With -m/-A: build an order-K model (next character given the previous K-1) instead of the first-order markov matrix.')
+    parser.add_argument('--resume', dest='resume', action='store_true', help='With -n/-A: checkpoint the counting stages and the model under %s, and continue from the checkpoints of an interrupted run with the same input and flags.' % settings.CHECKPOINT_PATH)
+    parser.add_argument('--checkpoint-interval', dest='checkpoint_interval', type=float, default=CHECKPOINT_INTERVAL, help='With --resume: seconds between checkpoints.')
+    parser.add_argument('--metrics', dest='metrics', action='append', default=None, metavar='SINK', help='Report progress metrics to SINK: stderr, jsonl:<file> or prom:<file> (Prometheus text file). Repeatable.')
+    parser.add_argument('--metrics-interval', dest='metrics_interval', type=float, default=1.0, help='Seconds between metric reports.')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Debug logging.')
     parser.add_argument('-A', dest='all', type=str, help='Run entire framework on provied wordlist.')
     args = parser.parse_args()
 
-    ngg = None
-    nga = None
-    ng_save_file = None
-    mm_save_file = None
-    if args and (args.filepath or args.all):
-        fp = args.filepath if args.filepath else args.all
-        ngg = NGramGenerator(fp)
-        # nga = NGramAnalyzer(fp)
-    else:
+    logging.basicConfig(level=logging.DEBUG if (args.verbose or settings.DEBUG) else logging.WARNING)
+    if args.metrics:
+        try:
+            metrics.enable([make_sink(spec) for spec in args.metrics], interval=args.metrics_interval)
+        except AttributeError as e:
+            parser.error(str(e))
+
+    if not (args and (args.filepath or args.all)):
         parser.print_usage()
         exit()
 
-    # Generator functions
-    if args.genngrams or args.all:
-        ngg.run()
-
-        counter = NGramCounter(ngg.destination_file)
-        counter.count_ngrams()
-
-        ng_save_file = '%sRESULT_%s.%s' % (
-            settings.RESULT_PATH,
-            hashlib.sha256(str(time.time()).encode('utf-8')).hexdigest()[:10],
-            settings.EXT_NG_COUNTS
-        )
+    approx_top_k = None
+    if args.approx is not None:
+        approx_top_k = args.approx if args.approx else (args.print_n if args.print_n else 100000)
 
-        if args.outfile and args.outfile is not None:
-            ng_save_file = args.outfile
+    wordlist = args.all if args.all else args.filepath
+    checkpoint_dir = checkpoint_directory(wordlist) if args.resume else None
+    try:
+        pipeline = Pipeline(wordlist, workers=args.workers, memory_budget=args.memory_budget, use_db=args.sqlite,
+                            two_stage=args.two_stage, order=args.order, approx_top_k=approx_top_k,
+                            sketch_error=args.sketch_error, checkpoint_dir=checkpoint_dir,
+                            checkpoint_interval=args.checkpoint_interval)
+    except AttributeError as e:
+        parser.error(str(e))
 
-        logger.debug('Saving sorted ngrams to \'%s\'...' % ng_save_file)
-        with open(ng_save_file, 'w+', encoding='utf-8') as f:
-            printed = False
-            for chunk in counter.get_next_top_db_ngrams(n=counter.chunk_size):
-                if args.print_n and args.print_n > 0 and not printed:
-                    top_ngrams = chunk[:min(args.print_n, counter.chunk_size)]
-                    for ng, ct in top_ngrams:
-                        print('%s:%s' % (ng, ct))
-                    printed = True
-
-                for ng, ct in chunk:
-                    f.write('%s\t%s\n' % (ng, ct))
-        logger.debug('Done.')
+    # A resumed -A run whose model was already saved goes straight to generating passwords
+    resumed_model = pipeline.resume_model() if args.all and args.resume and not args.update else None
 
+    # Generator functions
+    ngram_counts = None
+    ng_save_file = None
+    if (args.genngrams or args.all) and not resumed_model:
+        if args.genngrams and not args.all:
+            ng_save_file = args.outfile if args.outfile else result_path(settings.EXT_NG_COUNTS)
+        elif args.save_ngrams:
+            ng_save_file = args.save_ngrams
+
+        # An order-K model built by -A only needs n-grams up to length K
+        ngram_counts = pipeline.count(sort=bool(ng_save_file or args.print_n),
+                                      max_size=args.order if args.all else None)
+        if args.print_n and args.print_n > 0:
+            ngram_counts = print_top(ngram_counts, args.print_n)
+        if ng_save_file:
+            ngram_counts = write_ngram_counts(ngram_counts, ng_save_file)
+
+        if not args.all:
+            for _ in ngram_counts:
+                pass
+            logger.debug('Done.')
 
     # Analysis functions
-    if args.markov or args.all:
-
-        mm_save_file = '%sRESULT_%s.%s' % (
-            settings.RESULT_PATH,
-            hashlib.sha256(str(time.time()).encode('utf-8')).hexdigest()[:10],
-            settings.EXT_MODEL
-        )
-
-        if args.outfile and args.outfile is not None:
-            mm_save_file = args.outfile
-
-        nga = NGramAnalyzer(ng_save_file if ng_save_file else ngg.filepath)
-        char_freqs, mm = nga.generate_markov_matrix(savefile=mm_save_file)
+    mm_save_file = None
+    if args.update:
+        if args.order or model_type(args.update) != 'markov':
+            parser.error('--update only supports first-order markov models.')
+
+        # Count only the new file (-f) and merge it into the existing model
+        mm_save_file = args.outfile if args.outfile else args.update
+        base_model = MarkovModel.load(args.update, mmap=False)
+        new_model = pipeline.build_model()
+        pipeline.model = base_model.merge(new_model)
+
+        tmp_file = '%s.tmp' % mm_save_file
+        pipeline.model.save(tmp_file)
+        os.replace(tmp_file, mm_save_file)
+        logger.debug('Updated model saved to %s' % mm_save_file)
+
+    elif resumed_model:
+        mm_save_file = resumed_model
+        logger.debug('Resumed with the model saved to %s' % mm_save_file)
+
+    elif args.markov or args.all:
+        mm_save_file = args.outfile if args.outfile else result_path(settings.EXT_MODEL)
+
+        if args.all:
+            pipeline.build_model(ngram_counts, savefile=mm_save_file)
+        else:
+            nga = NGramAnalyzer(ng_save_file if ng_save_file else args.filepath)
+            pipeline.build_model(nga.iter_ngram_counts(), savefile=mm_save_file)
 
     if args.genpw or args.all:
         num_pws = args.genpws if args.genpws else 100
         pw_len = args.genpw if args.genpw else 10
-        if not nga:
-            nga = NGramAnalyzer(args.all if args.all else args.filepath)
 
-        if args.filepath:
-            mm_save_file = args.filepath
+        if pipeline.model is None:
+            pipeline.load_model(args.filepath)
+        if args.enumerate and not isinstance(pipeline.model, MarkovModel):
+            parser.error('--enumerate only supports first-order markov models.')
 
         validator = None
         if args.validate:
             valid_fp = args.validate if args.validate else args.all
-            validator = PasswordVerifier()
-            validator.init_classifier(valid_fp, pw_len=pw_len)
+            validator = PasswordVerifier(backend=args.validator_backend, features=args.features)
+            validator.init_classifier(valid_fp, chunk_size=args.validator_sample, pw_len=pw_len)
+            if validator.training_stats:
+                stats = validator.training_stats
+                sys.stderr.write('Trained %s validator on %s of %s passwords (%.1fs, peak RSS %s)\n' % (
+                    stats['backend'], stats['trained_on'], stats['passwords'], stats['seconds'],
+                    format_mb(stats['peak_rss_mb'])))
+
+        known = None
+        if args.exclude is not None:
+            model_path = mm_save_file if mm_save_file else args.filepath
+            exclude_fp = args.exclude if args.exclude else args.all
+            if exclude_fp:
+                known = wordlist_filter(exclude_fp, model_path, error_rate=args.fp_rate)
+            elif os.path.isfile(bloom_path(model_path)):
+                known = BloomFilter.load(bloom_path(model_path))
+            else:
+                parser.error('--exclude needs a wordlist: no Bloom filter was saved next to %s.' % model_path)
+
+        # -o names the model or n-gram file when one is built, else the password list
+        pw_save_file = None if (args.all or args.genngrams or args.markov or args.update) else args.outfile
 
-        gen_pws = []
         logger.debug('Generating Strings... (Depending on verification values this may take a while)')
-        while len(gen_pws) <= num_pws:
-            # pw = nga.generate_pw_from_mm(pw_len, prune=False, threshold=0.07, filepath=mm_save_file)
-            pw = nga.generate_pw_from_mm(pw_len, prune=False, threshold=0.2, filepath=mm_save_file)
-            if validator:
-                keep = validator.classify_passwords([pw])[0]
-                if keep:
-                    gen_pws.append(pw)
-                    print(pw)
-            else:
-                gen_pws.append(pw)
-                print(pw)
+        if args.enumerate:
+            batches = pipeline.enumerate(num_pws, pw_len, validator=validator, known=known, min_prob=args.min_prob,
+                                         batch_size=GEN_BATCH_SIZE)
+        else:
+            batches = pipeline.generate(num_pws, pw_len, validator=validator, known=known, unique=args.unique,
+                                        error_rate=args.fp_rate, batch_size=GEN_BATCH_SIZE, seed=args.seed,
+                                        prune=False, threshold=0.2)
+        with LineWriter(pw_save_file) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+
+        stats = pipeline.stats
+        sys.stderr.write('Generated %s passwords from %s candidates (%.0f candidates/s%s)\n' % (
+            stats['accepted'], stats['candidates'], stats['candidates'] / max(stats['seconds'], 1e-9),
+            ', seed=%s' % stats['seed'] if stats['seed'] is not None else ''))
+        if stats['classified']:
+            sys.stderr.write('Validator accepted %s of %s candidates (acceptance rate=%.3f)\n' % (
+                stats['validated'], stats['classified'], float(stats['validated']) / stats['classified']))
+        if stats['excluded']:
+            sys.stderr.write('Excluded %s candidates found in the wordlist or generated before\n' % stats['excluded'])
+
+    if checkpoint_dir:
+        # The run completed: nothing left to resume
+        remove_checkpoints(checkpoint_dir)
 
     end_time = time.time()
+    metrics.close()
     logger.debug('Runtime: %s' % (end_time - start_time, ))
 
@@ -0,0 +1,115 @@
+
+import sys
+import argparse
+import logging
+
+import settings
+from engine.client import ServiceClient
+
+"""
+    Run the generation/validation service, or send it requests (see engine.service).
+
+    The models are loaded once by "serve"; the client commands only import the standard library, so a request costs
+    milliseconds instead of the seconds of a cold ngram_analysis run.
+
+    USAGE:
+        python pwservice.py serve -f mm.model -V rockyou.txt -c pw_ngrams.ngcounts [--socket <path> | --port N]
+        python pwservice.py generate -g 10 -G 50 [--seed 1] [--enumerate] [--exclude]
+        python pwservice.py classify <passwords file or ->
+        python pwservice.py compare <words file or ->
+        python pwservice.py reload          (or send the service SIGHUP)
+        python pwservice.py status
+"""
+
+
+def read_words(filepath):
+    f = sys.stdin if filepath == '-' else open(filepath, encoding='utf-8')
+    with f:
+        return [line.strip('\r\n') for line in f if line.strip('\r\n')]
+
+
+def serve(args):
+    # The heavy imports (numpy, scipy, sklearn) are only needed by the service itself
+    import asyncio
+    import functools
+    from engine.service import ModelService, ServiceModels
+    from engine.metrics import metrics, make_sink
+
+    if args.metrics:
+        metrics.enable([make_sink(spec) for spec in args.metrics])
+    loader = functools.partial(ServiceModels.load, model_path=args.filepath, validate=args.validate,
+                               ngram_counts=args.ngram_counts, validator_backend=args.validator_backend,
+                               features=args.features, validator_sample=args.validator_sample)
+    service = ModelService(loader, workers=args.workers)
+    address = '127.0.0.1:%s' % args.port if args.port is not None else args.socket
+    asyncio.run(service.serve(socket_path=args.socket, port=args.port,
+                              ready=lambda: sys.stderr.write('Serving on %s\n' % address)))
+    metrics.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Long-lived password generation/validation service and its client.')
+    parser.add_argument('--socket', dest='socket', type=str, default=settings.SERVICE_SOCKET, help='Unix domain socket of the service.')
+    parser.add_argument('--port', dest='port', type=int, default=None, help='Use this localhost TCP port instead of the socket.')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Debug logging.')
+    commands = parser.add_subparsers(dest='command')
+
+    serve_parser = commands.add_parser('serve', help='Load the models and serve requests until interrupted.')
+    serve_parser.add_argument('-f', dest='filepath', type=str, default=None, help='Markov model for generate requests.')
+    serve_parser.add_argument('-V', dest='validate', type=str, default=None, help='Password file the validator is trained on.')
+    serve_parser.add_argument('-c', dest='ngram_counts', type=str, default=None, help='Counted n-gram file for compare requests.')
+    serve_parser.add_argument('--validator', dest='validator_backend', choices=('svm', 'sgd', 'iforest'), default='svm', help='Classifier backend of the validator.')
+    serve_parser.add_argument('--features', dest='features', choices=('hashed', 'ord100'), default='ord100', help='Password encoding of the validator.')
+    serve_parser.add_argument('--validator-sample', dest='validator_sample', type=int, default=100000, help='Number of passwords sampled from the -V file to train the validator on.')
+    serve_parser.add_argument('-j', '--workers', dest='workers', type=int, default=4, help='Requests handled at the same time.')
+    serve_parser.add_argument('--metrics', dest='metrics', action='append', default=None, metavar='SINK', help='Report request metrics to SINK: stderr, jsonl:<file> or prom:<file>. Repeatable.')
+
+    generate_parser = commands.add_parser('generate', help='Generate passwords.')
+    generate_parser.add_argument('-g', dest='length', type=int, default=10, help='Password length.')
+    generate_parser.add_argument('-G', dest='count', type=int, default=100, help='Number of passwords.')
+    generate_parser.add_argument('--seed', dest='seed', type=int, default=None, help='Random seed.')
+    generate_parser.add_argument('--enumerate', dest='enumerate', action='store_true', help='The most likely passwords, in descending probability.')
+    generate_parser.add_argument('--min-prob', dest='min_prob', type=float, default=None, help='With --enumerate: stop at passwords less likely than this.')
+    generate_parser.add_argument('--exclude', dest='exclude', action='store_true', help='Drop passwords in the Bloom filter saved next to the model.')
+    generate_parser.add_argument('--no-validate', dest='validate', action='store_false', help='Skip the validator.')
+
+    classify_parser = commands.add_parser('classify', help='Print every password with 1 (accepted) or 0.')
+    classify_parser.add_argument('wordlist', type=str, help='Passwords, one per line (- for stdin).')
+
+    compare_parser = commands.add_parser('compare', help='Print the known n-grams of every word.')
+    compare_parser.add_argument('wordlist', type=str, help='Words, one per line (- for stdin).')
+
+    commands.add_parser('reload', help='Reload the models from their files.')
+    commands.add_parser('status', help='Print the loaded models and the number of requests served.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if (args.verbose or settings.DEBUG) else logging.WARNING)
+
+    if args.command is None:
+        parser.print_usage()
+        exit()
+    if args.command == 'serve':
+        serve(args)
+        exit()
+
+    try:
+        with ServiceClient(socket_path=args.socket, port=args.port) as client:
+            if args.command == 'generate':
+                passwords = client.generate(length=args.length, count=args.count, seed=args.seed,
+                                            enumerate=args.enumerate, min_prob=args.min_prob, exclude=args.exclude,
+                                            validate=args.validate)
+                sys.stdout.write(''.join('%s\n' % pw for pw in passwords))
+            elif args.command == 'classify':
+                passwords = read_words(args.wordlist)
+                for pw, accepted in zip(passwords, client.classify(passwords)):
+                    print('%s\t%s' % (pw, int(accepted)))
+            elif args.command == 'compare':
+                for result in client.compare(read_words(args.wordlist)):
+                    print('%s\t%s/%s known n-grams\t%s' % (
+                        result['word'], len(result['known']), result['ngrams'],
+                        ' '.join('%s:%s' % (ng, count) for ng, count in result['known'])))
+            else:
+                print(client.request(args.command))
+    except (OSError, ValueError) as e:
+        parser.exit(1, 'Error: %s\n' % e)
@@ -3,6 +3,7 @@
 RESOURCE_PATH = 'resources/'
 RESULT_PATH = 'results/'
 VALIDATOR_PATH = 'validators/'
+CHECKPOINT_PATH = 'results/checkpoints/'
 
 # System Variables
 EXT_MODEL = 'model'
@@ -12,8 +13,16 @@ EXT_VALIDATOR = 'validator'
 
 DB_NAME = 'ng_counts.db'
 
+# Validator cache limits (least recently used models are evicted first)
+VALIDATOR_CACHE_MAX_ENTRIES = 20
+VALIDATOR_CACHE_MAX_MB = 2048
+
+# Default socket of the generation/validation service (pwservice.py)
+SERVICE_SOCKET = 'results/pwanalysis.sock'
+
 # Config Variables
-DEBUG = True
+# Default for the command line's debug logging (-v turns it on for a single run)
+DEBUG = False
 
 
 
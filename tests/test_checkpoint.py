@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+import functools
+import multiprocessing
+
+from unittest import mock
+
+import numpy as np
+
+import settings
+from engine.pipeline import Pipeline
+from engine.checkpoint import Checkpoint
+from engine.reader import iter_line_chunks
+
+# Stages can only resume at block boundaries: small blocks give a small input many checkpoints
+BLOCK_SIZE = 128
+
+# Exit status of a run killed at a checkpoint
+CRASHED = 3
+
+# (pipeline parameters, stages checkpointed in order) of every resumable counting flow
+FLOWS = [
+    ({}, ['count_wordlist']),
+    ({'two_stage': True}, ['ngram_generator', 'count_ngrams']),
+    ({'use_db': True}, ['count_wordlist_db']),
+    ({'use_db': True, 'two_stage': True}, ['ngram_generator', 'count_ngrams_db']),
+]
+
+
+def _count(params, checkpoint_dir):
+    pipeline = Pipeline('words.txt', chunk_size=40, checkpoint_dir=checkpoint_dir, checkpoint_interval=0, **params)
+    return dict(pipeline.count(sort=True))
+
+
+def _build_model(params, checkpoint_dir):
+    pipeline = Pipeline('words.txt', chunk_size=40, checkpoint_dir=checkpoint_dir, checkpoint_interval=0, **params)
+    pipeline.build_model(savefile='words.model')
+
+
+def _crash_at(stage, save, params, checkpoint_dir, run=_count):
+    """
+    Child process: run, and exit without any cleanup when stage records its save-th checkpoint.
+    """
+    record = Checkpoint.record
+    saves = {}
+
+    def record_or_exit(checkpoint, state):
+        saves[checkpoint.stage] = saves.get(checkpoint.stage, 0) + 1
+        if checkpoint.stage == stage and saves[stage] == save:
+            os._exit(CRASHED)
+        return record(checkpoint, state)
+
+    Checkpoint.record = record_or_exit
+    run(params, checkpoint_dir)
+    os._exit(0)
+
+
+class CheckpointResumeTest(unittest.TestCase):
+    """
+    A run killed at any checkpoint of any stage and rerun with the same checkpoint directory gives the counts of an
+    uninterrupted run.
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        os.makedirs(settings.RESULT_PATH)
+        patcher = mock.patch('engine.base.iter_line_chunks', functools.partial(iter_line_chunks, block_size=BLOCK_SIZE))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        rng = np.random.default_rng(0)
+        alphabet = np.array(list('abcdefgh12'))
+        with open('words.txt', 'w', encoding='utf-8') as f:
+            for _ in range(200):
+                f.write('%s\n' % ''.join(rng.choice(alphabet, size=rng.integers(3, 9))))
+        self.expected = _count({}, None)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def crash(self, stage, save, params, run=_count):
+        """
+        Run in a child process killed at the save-th checkpoint of stage, in a new working directory (the database
+        and n-gram files of a killed run are left behind).
+        """
+        workdir = os.path.join(self.tmp, '%s_%s_%s' % (stage, save, len(os.listdir(self.tmp))))
+        os.makedirs(os.path.join(workdir, settings.RESULT_PATH))
+        shutil.copy2(os.path.join(self.tmp, 'words.txt'), workdir)
+        os.chdir(workdir)
+
+        child = multiprocessing.get_context('fork').Process(target=_crash_at,
+                                                            args=(stage, save, params, 'checkpoints', run))
+        child.start()
+        child.join()
+        self.assertEqual(child.exitcode, CRASHED)
+
+    def assert_resumes(self, params, stage, save):
+        self.crash(stage, save, params)
+        self.assertEqual(_count(params, 'checkpoints'), self.expected)
+
+    def test_resume_every_stage(self):
+        for params, stages in FLOWS:
+            for stage in stages:
+                # At the first checkpoint, after one, and further in the input
+                for save in (1, 2, 5):
+                    with self.subTest(params=params, stage=stage, save=save):
+                        self.assert_resumes(params, stage, save)
+
+    def test_resume_model(self):
+        expected = Pipeline('words.txt', chunk_size=40).build_model()
+
+        # Killed before the model's checkpoint: nothing to resume, the rerun counts and builds it again
+        self.crash('model', 1, {}, run=_build_model)
+        self.assertIsNone(Pipeline('words.txt', checkpoint_dir='checkpoints').resume_model())
+        _build_model({}, 'checkpoints')
+
+        pipeline = Pipeline('words.txt', checkpoint_dir='checkpoints')
+        self.assertEqual(pipeline.resume_model(), os.path.abspath('words.model'))
+        self.assertEqual(pipeline.model.alphabet, expected.alphabet)
+        np.testing.assert_allclose(pipeline.model.to_csr().toarray(), expected.to_csr().toarray())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import itertools
+import unittest
+import numpy as np
+
+from engine.model import MarkovModel
+from engine.enumeration import MarkovEnumerator
+
+
+def _brute_force(alphabet, first, trans, length):
+    """
+    :return: {password: probability} of every possible password, with the enumerator's restart rule
+    """
+    trans = trans.copy()
+    dead = trans.sum(axis=1) == 0
+    trans[dead] = first
+    trans = trans / trans.sum(axis=1, keepdims=True)
+    first = first / first.sum()
+    probs = {}
+    for codes in itertools.product(range(len(alphabet)), repeat=length):
+        prob = first[codes[0]]
+        for a, b in zip(codes, codes[1:]):
+            prob *= trans[a, b]
+        if prob > 0:
+            probs[''.join(alphabet[c] for c in codes)] = prob
+    return probs
+
+
+class MarkovEnumeratorTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.alphabet = list('abcdef')
+        self.trans = rng.random((6, 6))
+        self.trans[self.trans < 0.3] = 0
+        # A character without transitions (restarts) and one that never starts a password
+        self.trans[3] = 0
+        self.first = rng.random(6)
+        self.first[2] = 0
+        self.model = MarkovModel(self.alphabet, self.first, MarkovModel._normalize(self.trans))
+
+    def test_matches_brute_force(self):
+        for length in (1, 3, 5):
+            expected = _brute_force(self.alphabet, self.first, self.trans, length)
+            enumerated = list(MarkovEnumerator(self.model, length, band_size=20))
+
+            passwords = [pw for pw, _ in enumerated]
+            self.assertEqual(len(passwords), len(set(passwords)))
+            self.assertEqual(set(passwords), set(expected))
+            for pw, prob in enumerated:
+                self.assertAlmostEqual(prob, expected[pw], delta=1e-12)
+            probs = [prob for _, prob in enumerated]
+            self.assertTrue(all(a >= b * (1 - 1e-9) for a, b in zip(probs, probs[1:])))
+
+    def test_min_prob(self):
+        expected = _brute_force(self.alphabet, self.first, self.trans, 4)
+        enumerated = [pw for pw, _ in MarkovEnumerator(self.model, 4, min_prob=0.01)]
+        self.assertEqual(sorted(enumerated), sorted(pw for pw, prob in expected.items() if prob >= 0.01))
+
+    def test_uniform_ties(self):
+        # Every password is equally likely: one tie class of 10^5 passwords, far more than a band holds
+        alphabet = list('0123456789')
+        model = MarkovModel(alphabet, np.ones(10), MarkovModel._normalize(np.ones((10, 10))))
+        enumerator = MarkovEnumerator(model, 5, band_size=100, chunk_size=16)
+
+        passwords = []
+        for codes, _ in enumerator.iter_bands():
+            self.assertLessEqual(len(codes), enumerator.band_size + enumerator.chunk_size * len(alphabet))
+            passwords.extend(enumerator.decode(codes))
+        self.assertEqual(passwords, [''.join(pw) for pw in itertools.product(alphabet, repeat=5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import Counter
+
+import numpy as np
+
+from engine.ngram_model import NGramModel, NGramSampler, CONTEXT_BASE
+from engine.utils import iter_ngrams
+
+
+def _ngram_counts(order, seed):
+    """
+    Counts of random words, with a share of the longest n-grams dropped so that some contexts are only known
+    shortened (and sampling has to back off).
+    """
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list('zyxabc12'))
+    words = [''.join(rng.choice(alphabet, size=rng.integers(2, 8))) for _ in range(300)]
+    counts = Counter(iter_ngrams(words, min_size=1, max_size=order))
+    return [(ng, ng_count) for ng, ng_count in counts.items() if len(ng) < order or rng.random() < 0.5]
+
+
+def _transitions(ngram_counts, threshold=None):
+    """
+    Reference table: {context: {next character: count}}, with the transitions below threshold (share of their
+    context's total) and the contexts left empty dropped.
+    """
+    transitions = {}
+    for ng, ng_count in ngram_counts:
+        if len(ng) > 1:
+            transitions.setdefault(ng[:-1], Counter())[ng[-1]] += ng_count
+    if threshold is not None:
+        for context, nexts in list(transitions.items()):
+            total = sum(nexts.values())
+            kept = {ch: count for ch, count in nexts.items() if float(count) / total >= threshold}
+            if kept:
+                transitions[context] = kept
+            else:
+                del transitions[context]
+    return transitions
+
+
+def _history(model, prefixes):
+    """
+    Packed context codes of the prefixes, laid out as in NGramSampler.generate_codes.
+    """
+    index = {ch: i for i, ch in enumerate(model.alphabet)}
+    history = np.zeros((model.order, len(prefixes)), dtype=np.int64)
+    for col, prefix in enumerate(prefixes):
+        for m in range(1, min(model.order, len(prefix) + 1)):
+            for ch in prefix[-m:]:
+                history[m, col] = history[m, col] * CONTEXT_BASE + index[ch] + 1
+    return history
+
+
+class NGramModelTest(unittest.TestCase):
+
+    def test_packed_contexts(self):
+        model = NGramModel.from_ngram_counts([('b', 1), ('ba', 2), ('bac', 3), ('a', 1), ('c', 1)], order=3)
+        self.assertEqual(model.alphabet, ['a', 'b', 'c'])
+        # 'ba': b (index 1) in the second digit, the most recent character a (index 0) in the lowest one
+        self.assertEqual(model.contexts.tolist(), [2, 2 * CONTEXT_BASE + 1])
+        self.assertEqual(model.next_chars.tolist(), [0, 2])
+        self.assertEqual(model.next_counts.tolist(), [2, 3])
+
+    def test_independent_of_count_order(self):
+        counts = _ngram_counts(4, 0)
+        model = NGramModel.from_ngram_counts(counts, order=4)
+        shuffled = NGramModel.from_ngram_counts(counts[::-1], order=4)
+        self.assertEqual(model.alphabet, shuffled.alphabet)
+        for name in ('first', 'contexts', 'indptr', 'next_chars', 'next_counts'):
+            np.testing.assert_array_equal(getattr(model, name), getattr(shuffled, name))
+
+    def test_backoff_to_longest_known_context(self):
+        counts = _ngram_counts(4, 1)
+        model = NGramModel.from_ngram_counts(counts, order=4)
+        sampler = NGramSampler(model, mutation_rate=0.0, seed=0)
+        transitions = _transitions(counts)
+
+        prefixes = [''.join(p) for p in np.random.default_rng(2).choice(model.alphabet, size=(500, 5))]
+        for pos in (1, 2, 3, 5):
+            rows = sampler._find_rows(_history(model, [p[:pos] for p in prefixes]), pos)
+            for prefix, row in zip(prefixes, rows.tolist()):
+                known = [prefix[pos-m:pos] for m in range(min(model.order - 1, pos), 0, -1)
+                         if prefix[pos-m:pos] in transitions]
+                if not known:
+                    self.assertEqual(row, -1)
+                    continue
+                nexts = model.next_chars[model.indptr[row]:model.indptr[row+1]]
+                self.assertEqual(set(model.alphabet[i] for i in nexts), set(transitions[known[0]]))
+
+    def test_generated_transitions(self):
+        for prune, threshold in ((False, None), (True, 0.3)):
+            counts = _ngram_counts(3, 3)
+            model = NGramModel.from_ngram_counts(counts, order=3)
+            sampler = NGramSampler(model, prune=prune, threshold=threshold or 0.1, mutation_rate=0.0, seed=4)
+            transitions = _transitions(counts, threshold)
+            starts = set(model.alphabet[i] for i in np.nonzero(model.first)[0])
+
+            for password in sampler.generate_batch(2000, 6):
+                self.assertIn(password[0], starts)
+                for pos in range(1, len(password)):
+                    known = [password[pos-m:pos] for m in (2, 1) if pos >= m and password[pos-m:pos] in transitions]
+                    # Without a known context, the password restarts from the first-character distribution
+                    allowed = transitions[known[0]] if known else starts
+                    self.assertIn(password[pos], allowed, (password, pos, prune))
+
+    def test_save_load(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            model = NGramModel.from_ngram_counts(_ngram_counts(3, 5), order=3)
+            path = os.path.join(tmp, 'ngram.model')
+            model.save(path)
+            loaded = NGramModel.load(path)
+            self.assertEqual((loaded.order, loaded.alphabet), (model.order, model.alphabet))
+            for name in ('first', 'contexts', 'indptr', 'next_chars', 'next_counts'):
+                np.testing.assert_array_equal(getattr(loaded, name), getattr(model, name))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from engine.pipeline import Pipeline
+from engine.parallel import ShardedNGramCounter, find_shards, partition_of
+from engine.reader import read_counts
+
+
+class ShardedNGramCounterTest(unittest.TestCase):
+    """
+    Counting with N worker processes (byte-range shards, crc32 hash partitions) gives the counts of -j 1.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.wordlist = os.path.join(self.tmp, 'words.txt')
+        rng = np.random.default_rng(0)
+        alphabet = np.array(list('abcdefgh12!'))
+        words = [''.join(rng.choice(alphabet, size=rng.integers(1, 12))) for _ in range(3000)]
+        # Empty lines, carriage returns, non-ASCII words and no newline at the end of the file
+        words[10:13] = ['', 'crlf\r', 'пароль']
+        with open(self.wordlist, 'w', encoding='utf-8', newline='') as f:
+            f.write('\n'.join(words))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_shards_cover_lines(self):
+        with open(self.wordlist, 'rb') as f:
+            data = f.read()
+        for num_shards in (1, 2, 3, 7, 64):
+            shards = find_shards(self.wordlist, num_shards)
+            self.assertEqual(shards[0][0], 0)
+            self.assertEqual(shards[-1][1], len(data))
+            for (_, end), (start, _) in zip(shards, shards[1:]):
+                self.assertEqual(end, start)
+                self.assertEqual(data[end-1:end], b'\n')
+
+    def test_matches_single_process(self):
+        for max_size in (None, 3):
+            expected = list(Pipeline(self.wordlist, workers=1, chunk_size=100).count(sort=True, max_size=max_size))
+            for workers in (2, 3, 4):
+                with self.subTest(workers=workers, max_size=max_size):
+                    pipeline = Pipeline(self.wordlist, workers=workers, chunk_size=100, tmp_dir=self.tmp)
+                    self.assertEqual(list(pipeline.count(sort=True, max_size=max_size)), expected)
+
+    def test_partitions(self):
+        counter = ShardedNGramCounter(self.wordlist, workers=3, chunk_size=100, tmp_dir=self.tmp)
+        partitions = counter.count_wordlist(max_size=2)
+        for part_id, path in enumerate(partitions):
+            self.assertTrue(all(partition_of(ng, 3) == part_id for ng, _ in read_counts(path)))
+        list(counter.get_next_top_ngrams(partitions))
+        self.assertFalse(any(os.path.exists(path) for path in partitions))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import numpy as np
+
+from sklearn.svm import OneClassSVM
+
+from engine.features import OrdEncoder, HashedNGramEncoder
+from engine.validation import svm_decision_function, SV_BLOCK, ROW_BLOCK
+
+
+def _passwords(n, seed):
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list('abcdefghijklmnopqrstuvwxyz0123456789!@#'))
+    return [''.join(rng.choice(alphabet, size=rng.integers(4, 13))) for _ in range(n)]
+
+
+class SvmDecisionFunctionTest(unittest.TestCase):
+    """
+    svm_decision_function replaces libsvm's scoring of OneClassSVM: it has to give the same decision values.
+    """
+
+    def assert_matches(self, features, gamma):
+        train = features[:600]
+        svm = OneClassSVM(kernel='rbf', gamma=gamma).fit(train)
+        expected = svm.decision_function(features)
+        np.testing.assert_allclose(svm_decision_function(svm, features), expected, rtol=1e-9, atol=1e-9)
+
+    def test_dense_features(self):
+        self.assert_matches(OrdEncoder().encode(_passwords(1000, 0)), 'auto')
+
+    def test_sparse_features(self):
+        self.assert_matches(HashedNGramEncoder().encode(_passwords(1000, 1)), 1.0)
+
+    def test_several_blocks(self):
+        # More passwords and support vectors than fit in a single block of either
+        features = HashedNGramEncoder(n_features=256).encode(_passwords(ROW_BLOCK + 500, 2))
+        svm = OneClassSVM(kernel='rbf', gamma=1.0).fit(features[:2 * SV_BLOCK + 500])
+        self.assertGreater(svm.support_vectors_.shape[0], SV_BLOCK)
+        np.testing.assert_allclose(svm_decision_function(svm, features), svm.decision_function(features),
+                                   rtol=1e-9, atol=1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
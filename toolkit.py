@@ -3,67 +3,76 @@
 import Levenshtein
 import collections, argparse
 
-from engine import utils
+from engine.reader import read_lines
+from engine.similarity import SimilarityIndex, nearest_distances, summarize
 
 
 class ToolKit(object):
 
     def get_file(self, filepath):
-        with open(filepath, 'r', encoding='utf-8') as f:
-            str_list = utils.get_file(f)
-        return str_list
+        """
+        All non-empty lines of a (possibly compressed) wordlist.
+        """
+        return read_lines(filepath)
 
     def get_charcount(self, str_list):
         char_count = collections.Counter(''.join(str_list))
         return char_count
 
-    def calc_similarity(self, gen_words, ref_words):
-        # TODO: IDEA: Not implemented -- using ratio from Levenshtein library instead
-        #   Iterate through all words in the generated list and compare each generated word to ALL of the reference words
-        #   Generate a matrix for this comparison with all Levenshtein values
-        #   Use the comparison matrix to make claims about each word:
-        #       I.e. "This word is similar to x% of the reference material -- based on some threshold level of L. value
-        #   Aggregate the individual comparisons and normalize to make a general claim about the generated dataset
-        #       I.e. "This collection of words is similar to 40% of the reference material"
-        #           This would require the threshold value set in such a way that that it is agnostic of word length
-        #               percentage of characters similar? -- might get difficult with words of different lengths
-        #               NOTE: L.value as some ratio between total characters in words: len(word1) + len(word2)
-        # comp_matrix = []
-        # for word in gen_words:
-        #     result = [Levenshtein.distance(word, s) for s in ref_words]
-        pass
-
+    def similarity(self, gen_words, ref_words):
+        """
+        Levenshtein similarity ratio (0.0 to 1.0) between two word lists, treating each list as a sequence of words.
+        """
+        return Levenshtein.seqratio(gen_words, ref_words)
+
+    def calc_similarity(self, gen_words, ref_words, max_distance=2, workers=None):
+        """
+        Edit distance from every generated word to its nearest reference word (see engine.similarity), capped at
+        max_distance + 1.
+        :return: (distances, nearest reference word or None) aligned with gen_words, and the summary dict of
+            engine.similarity.summarize ("x% of the generated words are within d edits of the reference")
+        """
+        index = SimilarityIndex(ref_words, max_distance=max_distance, workers=workers)
+        distances, nearest = nearest_distances(gen_words, index, workers=workers)
+        nearest_words = [index.words[i] if i >= 0 else None for i in nearest.tolist()]
+        return distances, nearest_words, summarize(distances, max_distance)
 
 
 if __name__ == "__main__":
     """
-    Compare character counts and distributions between two list of passwords
-    USAGE:  python toolkit.py <file1> <file2>
-    OUTPUT: A ratio of similarity between the two wordlist files (Range of 0.0 to 1.0)
+    Compare a generated wordlist against a reference wordlist
+    USAGE:  python toolkit.py <generated file> <reference file> [-d 2] [-j N] [-o distances.tsv]
+    OUTPUT: The share of generated words within 0..d edits of their nearest reference word
+            (--ratio: the Levenshtein ratio of the two lists as word sequences, 0.0 to 1.0)
     """
 
-    parser = argparse.ArgumentParser(description='Basic comparator for wordlists. Calculates the ratio of similarity.')
-    parser.add_argument('file1', type=str)
-    parser.add_argument('file2', type=str)
+    parser = argparse.ArgumentParser(description='Basic comparator for wordlists. Calculates how close the generated words are to the reference words.')
+    parser.add_argument('file1', type=str, help='Generated wordlist.')
+    parser.add_argument('file2', type=str, help='Reference wordlist.')
+    parser.add_argument('-d', '--max-distance', dest='max_distance', type=int, default=2, help='Largest edit distance looked for (larger distances are reported as "more than d").')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=None, help='Worker processes (default: all cores).')
+    parser.add_argument('-o', dest='outfile', type=str, default=None, help='Write "word<TAB>distance<TAB>nearest reference word" for every generated word to this file.')
+    parser.add_argument('--ratio', dest='ratio', action='store_true', help='Print the Levenshtein ratio of the two lists instead (slow on large lists).')
 
     args = parser.parse_args()
 
-    generated_word_file = ""
-    reference_word_file = ""
-    if args.file1 and args.file2:
-        generated_word_file = args.file1
-        reference_word_file = args.file2
-    else:
-        parser.print_help()
-        exit()
-
     tk = ToolKit()
 
-    ref_word_list = tk.get_file(reference_word_file)
-    gen_word_list = tk.get_file(generated_word_file)
-
-    print(Levenshtein.seqratio(gen_word_list, ref_word_list))
-
-
+    ref_word_list = tk.get_file(args.file2)
+    gen_word_list = tk.get_file(args.file1)
 
+    if args.ratio:
+        print(tk.similarity(gen_word_list, ref_word_list))
+        exit()
 
+    distances, nearest_words, summary = tk.calc_similarity(gen_word_list, ref_word_list,
+                                                           max_distance=args.max_distance, workers=args.workers)
+    print('Compared %s generated words against %s reference words' % (summary['words'], len(set(ref_word_list))))
+    for distance, share in summary['within'].items():
+        print('%6.2f%% within %s edit%s' % (share * 100, distance, '' if distance == 1 else 's'))
+    print('%6.2f%% more than %s edits away' % (summary['histogram'][args.max_distance + 1] * 100, args.max_distance))
+
+    if args.outfile:
+        with open(args.outfile, 'w', encoding='utf-8') as f:
+            for word, distance, nearest in zip(gen_word_list, distances.tolist(), nearest_words):
+                f.write('%s\t%s\t%s\n' % (word, distance, nearest if nearest is not None else ''))